@@ -1,14 +1,88 @@
 from .utils import path
+from .utils import version_key
 import logging
+import pkg_resources
 import pkginfo
 import re
+import tarfile
 import time
 import traceback
+import zipfile
 
 
 logger = logging.getLogger(__name__)
 
 
+class StoredInfo(object):
+    """
+    Stand in for a pkginfo distribution built from stored pkgdata
+    """
+    def __init__(self, name, version, requires_python=None, sortkey=None,
+                 metadata_static=False):
+        self.name = name
+        self.version = version
+        self.requires_python = requires_python
+        self.sortkey = sortkey
+        self.metadata_static = metadata_static
+
+    @classmethod
+    def from_pkgdata(cls, pkgdata):
+        return cls(pkgdata['name'], pkgdata['version'],
+                   pkgdata.get('requires_python'),
+                   pkgdata.get('sortkey'),
+                   pkgdata.get('metadata_static', False))
+
+
+class ArchiveLimitExceeded(RuntimeError):
+    """
+    Inspecting an archive went over a time, memory or size limit
+    """
+
+
+class ExtractedInfo(pkginfo.Distribution):
+    """
+    pkginfo distribution parsed from metadata bytes already pulled out
+    of an archive by `ArchiveUtil.extract_metadata`
+    """
+    # (dependency links, requirements) when gathered in the same pass
+    depinfo = None
+
+    def __init__(self, filename, data, metadata_version=None, depinfo=None):
+        self.filename = filename
+        self.metadata_version = metadata_version
+        self.data = data
+        self.depinfo = depinfo
+        self.extractMetadata()
+
+    def read(self):
+        return self.data
+
+
+class Ingestion(object):
+    """
+    Everything learned about one archive as it enters the index: the
+    path (with its digests), the parsed pkginfo and the root pkgdata.
+
+    Created once per upload and handed along from the event to the
+    index, so the archive is hashed and parsed a single time.
+    """
+    def __init__(self, path, pkginfo=None, pkgdata=None):
+        self.path = path
+        self.pkginfo = pkginfo
+        self.pkgdata = pkgdata
+
+    @property
+    def digests(self):
+        return self.path.digests
+
+    @property
+    def md5(self):
+        return self.path.md5hex
+
+    def __repr__(self):
+        return '<Ingestion %s>' % self.path
+
+
 class ArchiveUtil(object):
     """
     A pickeable object we can pass via mp queues
@@ -38,17 +112,308 @@ class ArchiveUtil(object):
         if match:
             return match.groupdict()['ext']
 
-    def pkginfo_to_pkgdata(self, arch, pkgi):
+    @staticmethod
+    def requires_python_of(pkgi):
+        spec = getattr(pkgi, 'requires_python', None)
+        return isinstance(spec, str) and spec.strip() or None
+
+    def pkginfo_to_pkgdata(self, arch, pkgi, depinfo=None):
         start = time.time()
+        if depinfo is None:
+            depinfo = getattr(pkgi, 'depinfo', None) or self.depinfo_for_file(arch, pkgi)
+        deplinks, requires = depinfo
         return dict(name=pkgi.name,
                     version=pkgi.version,
                     filename=str(arch.name),
+                    size=arch.size,
+                    sha256=arch.sha256hex,
+                    requires_python=self.requires_python_of(pkgi),
+                    sortkey=version_key(pkgi.version),
+                    metadata_static=self.metadata_is_static(arch, pkgi),
+                    requires=requires,
+                    dependency_links=deplinks,
                     added=start)
 
+    depinfo_files = ('.egg-info/dependency_links.txt', '.egg-info/requires.txt')
+
+    @staticmethod
+    def depinfo_from_pkgdata(pkgdata):
+        """
+        (dependency links, requirements) stored at ingestion, or None
+        for archives indexed before they were
+        """
+        if pkgdata and 'requires' in pkgdata:
+            return pkgdata.get('dependency_links', []), pkgdata['requires']
+
+    @staticmethod
+    def requires_from_dist(requires_dist):
+        """
+        requires.txt style lines from wheel Requires-Dist, skipping
+        those only needed for an extra or whose environment marker does
+        not hold here
+        """
+        requires = []
+        for spec in requires_dist or ():
+            spec, _, marker = spec.partition(';')
+            marker = marker.strip()
+            if 'extra' in marker:
+                continue
+            if marker:
+                try:
+                    if not pkg_resources.evaluate_marker(marker):
+                        continue
+                except SyntaxError:
+                    logger.warning("Invalid marker for %s: %s", spec.strip(), marker)
+            requires.append(spec.replace('(', '').replace(')', '').replace(' ', ''))
+        return requires
+
+    def depinfo_for_file(self, arch, pkgi=None):
+        """
+        (dependency links, requirements) of an archive: a wheel's
+        Requires-Dist, or for an sdist the Requires-Dist its core
+        metadata declares, else its egg-info files.
+        """
+        filename = str(arch)
+        if filename.endswith('.whl'):
+            if pkgi is None:
+                pkgi = pkginfo.wheel.Wheel(filename)
+            return [], self.requires_from_dist(getattr(pkgi, 'requires_dist', ()))
+
+        found = {}
+        try:
+            if filename.endswith('.zip'):
+                with zipfile.ZipFile(filename) as archive:
+                    for info in archive.infolist():
+                        for tail in self.depinfo_files:
+                            if tail not in found and info.filename.endswith(tail):
+                                self.check_expansion(info.file_size, filename)
+                                found[tail] = archive.read(info)
+            elif self.extension_of(filename) in ('.gz', '.tgz', '.bz2'):
+                # stream the members rather than listing (and so
+                # decompressing) the whole archive up front
+                with tarfile.open(filename, 'r|*') as archive:
+                    for member in archive:
+                        self.check_expansion(archive.offset + member.size, filename)
+                        for tail in self.depinfo_files:
+                            if tail not in found and member.name.endswith(tail):
+                                found[tail] = archive.extractfile(member).read()
+                        if len(found) == len(self.depinfo_files):
+                            break
+        except (tarfile.TarError, zipfile.BadZipfile, EOFError, IOError) as e:
+            logger.error("Could not read dependencies of %s: %s", filename, e)
+        return self.sdist_depinfo(pkgi, found)
+
+    def sdist_depinfo(self, pkgi, found, complete=True):
+        """
+        (dependency links, requirements) of an sdist from its core
+        metadata's Requires-Dist when declared (see `declared_requires`),
+        else from the egg-info files `found`. None if those files may
+        not all have been read (`complete`).
+        """
+        declared = self.declared_requires(pkgi) if pkgi is not None else None
+        if declared is not None:
+            return self.depinfo_from_files(found)[0], self.requires_from_dist(declared)
+        if complete:
+            return self.depinfo_from_files(found)
+        return None
+
+    @classmethod
+    def depinfo_from_files(cls, found):
+        """
+        (dependency links, requirements) from the contents of the
+        egg-info files found (tail -> bytes)
+        """
+        deplinks, requires = [found.get(tail, b'').decode('utf-8', 'replace') \
+                              for tail in cls.depinfo_files]
+        return [x.strip() for x in deplinks.split('\n') if x.strip()],\
+               [x.strip() for x in requires.split('\n') if x.strip() and not x.startswith('[')]
+
+    @staticmethod
+    def metadata_version_of(pkgi):
+        """
+        (major, minor) of the core metadata, or None
+        """
+        try:
+            return tuple(int(x) for x in str(pkgi.metadata_version).split('.')[:2])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def dynamic_of(pkgi):
+        dynamic = getattr(pkgi, 'dynamic', None)
+        return set(x.lower() for x in dynamic if isinstance(x, str)) \
+               if isinstance(dynamic, (list, tuple)) else set()
+
+    @classmethod
+    def declared_requires(cls, pkgi):
+        """
+        Requires-Dist of the core metadata when it can be taken as the
+        full list: 2.1+ listing some, or 2.2+ not marking them dynamic.
+        None otherwise.
+        """
+        version = cls.metadata_version_of(pkgi) or (0, 0)
+        requires_dist = getattr(pkgi, 'requires_dist', None)
+        requires_dist = isinstance(requires_dist, (list, tuple)) and list(requires_dist) or []
+        if version >= (2, 1) and requires_dist:
+            return requires_dist
+        if version >= (2, 2) and 'requires-dist' not in cls.dynamic_of(pkgi):
+            return requires_dist
+        return None
+
+    @classmethod
+    def metadata_is_static(cls, arch, pkgi):
+        """
+        Whether the archive's core metadata can be trusted as is by an
+        installer (PEP 658): always for wheels, for sdists only when
+        PEP 643 (Metadata-Version 2.2+) says the dependencies are not
+        dynamic.
+        """
+        if str(arch).endswith('.whl'):
+            return True
+        if str(arch).endswith('.egg'):
+            return False
+        version = cls.metadata_version_of(pkgi)
+        return version is not None and version >= (2, 2) \
+               and not cls.dynamic_of(pkgi) & set(('requires-dist', 'requires-python'))
+
+    fast_extract = True
+    # decompressed bytes an archive may expand to while inspected
+    max_bytes = None
+    killed = 0
+
+    def check_expansion(self, consumed, filename):
+        if self.max_bytes is not None and consumed > self.max_bytes:
+            raise ArchiveLimitExceeded("%s expands past %s bytes" % (filename, self.max_bytes))
+
+    def expanded_size(self, filename):
+        """
+        Decompressed size of an archive, giving up past `max_bytes`
+        """
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as archive:
+                size = sum(x.file_size for x in archive.infolist())
+            self.check_expansion(size, filename)
+            return size
+
+        with tarfile.open(filename, 'r|*') as archive:
+            for member in archive:
+                self.check_expansion(archive.offset + member.size, filename)
+            return archive.offset
+
+    @staticmethod
+    def _is_metadata(data):
+        return data is not None and b'Metadata-Version' in data
+
+    def _zip_metadata(self, filename, ext):
+        """
+        Only the central directory and the metadata member (plus an
+        sdist's egg-info dependency files) are read
+
+        :returns: (metadata bytes or None, egg-info tail -> bytes,
+                  True: the egg-info files were all looked for)
+        """
+        found = {}
+        with zipfile.ZipFile(filename) as archive:
+            names = archive.namelist()
+            if ext == '.whl':
+                candidates = [x for x in names if x.count('/') == 1 \
+                              and x.endswith('.dist-info/METADATA')]
+            elif ext == '.egg':
+                candidates = [x for x in names if x == 'EGG-INFO/PKG-INFO']
+            else:
+                candidates = sorted((x for x in names if x.count('/') <= 1 \
+                                     and x.split('/')[-1] == 'PKG-INFO'), key=len)
+            if len(candidates) != 1 and ext != '.zip':
+                return None, found, True
+            for name in candidates:
+                self.check_expansion(archive.getinfo(name).file_size, filename)
+                data = archive.read(name)
+                if self._is_metadata(data):
+                    break
+            else:
+                return None, found, True
+
+            if ext == '.zip':
+                for tail in self.depinfo_files:
+                    name = next((x for x in names if x.endswith(tail)), None)
+                    if name is not None:
+                        self.check_expansion(archive.getinfo(name).file_size, filename)
+                        found[tail] = archive.read(name)
+            return data, found, True
+
+    def _tar_metadata(self, filename):
+        """
+        Stream members until a top level PKG-INFO turns up, picking up
+        the egg-info dependency files on the way. A directory's members
+        are contiguous in a tar, so the egg-info files were all seen if
+        the egg-info directory was passed before PKG-INFO.
+
+        :returns: (metadata bytes or None, egg-info tail -> bytes,
+                  True: the egg-info files were all looked for)
+        """
+        data, found = None, {}
+        egginfo = None  # None: not yet seen, True: inside, False: passed
+        with tarfile.open(filename, 'r|*') as archive:
+            for member in archive:
+                self.check_expansion(archive.offset + member.size, filename)
+                in_egginfo = '.egg-info/' in member.name
+                if in_egginfo:
+                    egginfo = True
+                elif egginfo:
+                    egginfo = False
+
+                parts = member.name.lstrip('./').split('/')
+                if data is None and len(parts) <= 2 and parts[-1] == 'PKG-INFO' \
+                       and member.isfile():
+                    content = archive.extractfile(member).read()
+                    if self._is_metadata(content):
+                        data = content
+                        break
+                elif in_egginfo and member.isfile():
+                    for tail in self.depinfo_files:
+                        if tail not in found and member.name.endswith(tail):
+                            found[tail] = archive.extractfile(member).read()
+        return data, found, egginfo is False or len(found) == len(self.depinfo_files)
+
+    def extract_metadata(self, filename):
+        """
+        Targeted read of an archive's core metadata. For sdists the
+        dependency info is gathered in the same pass (`depinfo`),
+        unless the egg-info files lie past PKG-INFO and Requires-Dist
+        is not declared; `depinfo_for_file` then reads them.
+
+        :returns: an `ExtractedInfo`, or None when unsure (the caller
+                  falls back to pkginfo)
+        """
+        ext = self.extension_of(filename)
+        try:
+            if ext in ('.zip', '.egg', '.whl'):
+                data, found, complete = self._zip_metadata(filename, ext)
+            elif ext in ('.gz', '.tgz', '.bz2'):
+                data, found, complete = self._tar_metadata(filename)
+            else:
+                return None
+            if data is not None:
+                info = ExtractedInfo(filename, data)
+                if ext in ('.zip', '.gz', '.tgz', '.bz2'):
+                    info.depinfo = self.sdist_depinfo(info, found, complete)
+                return info
+        except ArchiveLimitExceeded:
+            raise
+        except Exception as e:
+            logger.debug("Fast metadata extraction failed for %s: %s", filename, e)
+        return None
+
     def pkginfo_from_file(self, path, handle_error=None):
         ext = self.extension_of(path)
         not_recognized = False
         try:
+            if self.fast_extract:
+                info = self.extract_metadata(path)
+                if info is not None and info.name and info.version:
+                    return info
+            if ext is not None and self.max_bytes is not None:
+                self.expanded_size(path)
             if ext is not None:
                 if ext in set(('.gz','.tgz', '.bz2', '.zip')):
                     return pkginfo.sdist.SDist(path)
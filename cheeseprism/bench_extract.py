@@ -0,0 +1,77 @@
+"""
+Compare targeted metadata extraction against pkginfo on a corpus of
+archives:
+
+  python -m cheeseprism.bench_extract path/to/archives [more/dirs] [-n 3]
+"""
+from .archiveutil import ArchiveUtil
+from .utils import path
+import argparse
+import logging
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def corpus(dirs, at=ArchiveUtil()):
+    for dirpath in dirs:
+        for fp in path(dirpath).walkfiles():
+            if at.extension_of(fp):
+                yield fp
+
+
+def timed(func, archives, repeat):
+    """
+    :returns: (best total seconds over `repeat` runs, results)
+    """
+    best, results = None, None
+    for _ in range(repeat):
+        start = time.time()
+        out = []
+        for fp in archives:
+            try:
+                info = func(fp)
+                out.append(info and (info.name, info.version))
+            except Exception as e:
+                out.append(e.__class__.__name__)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best, results = elapsed, out
+    return best, results
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('dirs', nargs='+')
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.WARN)
+
+    archives = list(corpus(args.dirs))
+    if not archives:
+        print("No archives found")
+        return 1
+
+    pkginfo_at, fast_at = ArchiveUtil(), ArchiveUtil()
+    pkginfo_at.fast_extract = False
+
+    slow, expected = timed(pkginfo_at.pkginfo_from_file, archives, args.repeat)
+    fast, actual = timed(fast_at.pkginfo_from_file, archives, args.repeat)
+    extracted = sum(1 for fp in archives if fast_at.extract_metadata(fp) is not None)
+    mismatched = [fp for fp, a, b in zip(archives, expected, actual) if a != b]
+
+    print("archives:      %s (%0.1f MB)" % (len(archives),
+                                           sum(fp.size for fp in archives) / 1024.0 ** 2))
+    print("pkginfo:       %0.3f s" % slow)
+    print("targeted:      %0.3f s (%0.1fx)" % (fast, fast and slow / fast or 0))
+    print("fell back:     %s" % (len(archives) - extracted))
+    print("mismatched:    %s" % len(mismatched))
+    for fp in mismatched:
+        print("  %s" % fp)
+    return mismatched and 2 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
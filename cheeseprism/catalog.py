@@ -0,0 +1,141 @@
+"""
+SQLite backed catalog of archive metadata (an alternative to index.json)
+"""
+from .journal import DataJournal
+from .utils import normalize_name
+from .utils import path
+from collections.abc import Mapping
+import json
+import logging
+import sqlite3
+import sys
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCatalog(Mapping):
+    """
+    Stores the md5 -> pkgdata map in an indexed sqlite file.
+
+    Behaves as a read only mapping so it may stand in for the dict
+    loaded from index.json; membership tests and per project lookups
+    hit indexes rather than loading the whole catalog.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS archives (
+        md5 TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        name TEXT,
+        version TEXT,
+        filename TEXT,
+        added REAL,
+        size INTEGER,
+        sha256 TEXT,
+        pkgdata TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS archives_project ON archives (project);
+    CREATE INDEX IF NOT EXISTS archives_added ON archives (added);
+    """
+
+    def __init__(self, dbpath):
+        self.path = path(dbpath)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(self.schema)
+            self.conn.commit()
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def __contains__(self, md5):
+        return bool(self.query('SELECT 1 FROM archives WHERE md5 = ?', md5))
+
+    def __getitem__(self, md5):
+        rows = self.query('SELECT pkgdata FROM archives WHERE md5 = ?', md5)
+        if not rows:
+            raise KeyError(md5)
+        return json.loads(rows[0][0])
+
+    def __iter__(self):
+        return iter([md5 for md5, in self.query('SELECT md5 FROM archives')])
+
+    def __len__(self):
+        return self.query('SELECT count(*) FROM archives')[0][0]
+
+    def items(self):
+        return [(md5, json.loads(data)) for md5, data \
+                in self.query('SELECT md5, pkgdata FROM archives')]
+
+    def values(self):
+        return [json.loads(data) for data, in self.query('SELECT pkgdata FROM archives')]
+
+    @staticmethod
+    def row(md5, pkgdata):
+        return (md5, normalize_name(pkgdata['name']),
+                pkgdata['name'], pkgdata.get('version'),
+                pkgdata.get('filename'), pkgdata.get('added'),
+                pkgdata.get('size'), pkgdata.get('sha256'),
+                json.dumps(pkgdata))
+
+    def update(self, **data):
+        rows = [self.row(md5, pkgdata) for md5, pkgdata in data.items() \
+                if pkgdata is not None]
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO archives VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        return data
+
+    def remove(self, *md5s):
+        with self.lock:
+            self.conn.executemany('DELETE FROM archives WHERE md5 = ?',
+                                  [(md5,) for md5 in md5s])
+            self.conn.commit()
+
+    def versions(self, project):
+        """
+        pkgdata for every archive of `project` (any spelling)
+        """
+        rows = self.query('SELECT pkgdata FROM archives WHERE project = ?',
+                          normalize_name(project))
+        return [json.loads(data) for data, in rows]
+
+    def changed_since(self, timestamp):
+        """
+        Names of projects with archives added after `timestamp`
+        """
+        rows = self.query('SELECT DISTINCT name FROM archives WHERE added > ?',
+                          timestamp)
+        return set(name for name, in rows)
+
+    def data_from_path(self, datafile=None):
+        """
+        Stand in for `IndexManager.data_from_path`
+        """
+        return self
+
+    def migrate(self, datafile):
+        """
+        One shot import of an existing index.json (and journal)
+        """
+        data = DataJournal.read(datafile)
+        self.update(**data)
+        logger.info("Migrated %s archives from %s to %s", len(data), datafile, self.path)
+        return len(data)
+
+
+def main(argv=sys.argv):
+    """
+    Usage: cheeseprism-catalog path/to/index.json path/to/index.db
+    """
+    if len(argv) != 3:
+        print(main.__doc__.strip())
+        return 1
+    logging.basicConfig(level=logging.INFO)
+    SQLiteCatalog(argv[2]).migrate(argv[1])
+    return 0
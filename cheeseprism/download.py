@@ -0,0 +1,84 @@
+"""
+Streaming downloads over a shared, pooled http session
+"""
+from .utils import path
+from .utils import write_stream
+from requests.adapters import HTTPAdapter
+import hashlib
+import logging
+import requests
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Downloader(object):
+    """
+    Holds a keep-alive `requests.Session` shared by every download so
+    connections to the same host are reused.
+    """
+    pool_size = 10
+    retries = 2
+    timeout = 60
+
+    def __init__(self, pool_size=None, timeout=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size or self.pool_size,
+                              pool_maxsize=pool_size or self.pool_size,
+                              max_retries=self.retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if timeout is not None:
+            self.timeout = timeout
+
+    @staticmethod
+    def hashes_from_url(url):
+        """
+        Digest from a `#md5=...` (or any hashlib algorithm) fragment
+        """
+        fragment = url.partition('#')[2]
+        expected = {}
+        for part in fragment.split('&'):
+            name, _, value = part.partition('=')
+            if name in hashlib.algorithms_guaranteed and value:
+                expected[name] = value
+        return expected
+
+    def fetch(self, url, dest, expected=None):
+        """
+        Stream `url` to `dest` via a temp file beside it, checking the
+        bytes against `expected` (hash name -> hex) and any hash
+        fragment on the url before moving it into place.
+
+        :returns: `dest` with its digests primed
+        """
+        expected = dict(self.hashes_from_url(url), **(expected or {}))
+        expected = dict((name, value) for name, value in expected.items() \
+                        if value and name in hashlib.algorithms_guaranteed)
+        target_url = url.split('#', 1)[0]
+        logger.info('Downloading: %s', target_url)
+        with self.session.get(target_url, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            return write_stream(path(dest), resp.raw, expected=expected)
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def downloader():
+    """
+    The process wide `Downloader`
+    """
+    global _downloader
+    if _downloader is None:
+        with _downloader_lock:
+            if _downloader is None:
+                _downloader = Downloader()
+    return _downloader
+
+
+def fetch(url, dest, expected=None):
+    return downloader().fetch(url, dest, expected=expected)
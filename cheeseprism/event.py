@@ -1,3 +1,4 @@
+from .archiveutil import Ingestion
 from zope.interface import Attribute
 from zope.interface import Interface
 from zope.interface import implements
@@ -20,6 +21,7 @@ class IPackageEvent(IIndexEvent):
     An event involving a package
     """
     path = Attribute('Path to package')
+    ingest = Attribute('Ingestion: path, pkginfo and pkgdata gathered so far')
 
 
 class IPackageAdded(IPackageEvent):
@@ -57,9 +59,10 @@ class PackageEvent(object):
         self.version = version
         self.im = index_manager
         self.path = path
+        self.ingest = Ingestion(path)
 
         if self.name is None and self.path:
-            info = self.im.pkginfo_from_file(path, self.im.move_on_error)
+            info = self.ingest.pkginfo = self.im.pkginfo_from_file(path, self.im.move_on_error)
             self.name = info.name
             self.version = info.version
 
@@ -3,12 +3,25 @@ Classes, subscribers and functions for dealing with index management
 """
 from . import event
 from .archiveutil import ArchiveUtil
+from .archiveutil import StoredInfo
+from .catalog import SQLiteCatalog
 from .desc import template
 from .desc import updict
 from .jenv import EnvFactory
+from .journal import DataJournal
+from .projects import ProjectMap
+from .sandbox import SandboxedArchiveUtil
+from .scheduler import LeafScheduler
 from .utils import benchmark
+from .utils import compressed_exts
+from .utils import normalize_name
 from .utils import path
+from .utils import version_key
+from .utils import write_atomic
+from .utils import write_precompressed
+from collections import Counter
 from contextlib import contextmanager
+from datetime import datetime
 from functools import partial
 from more_itertools import chunked
 from pyramid import threadlocal
@@ -17,10 +30,13 @@ from pyramid.events import subscriber
 from pyramid.path import DottedNameResolver as dnr
 from pyramid.settings import asbool
 from threading import Thread
+import bisect
+import futures
+import hashlib
 import json
 import logging
 import operator
-import pkg_resources
+import os
 import re
 import threading
 import time
@@ -45,29 +61,41 @@ class IndexManager(object):
                         index_title=def_index_title,
                         description="Welcome to the CheesePrism")
     datafile_name = "index.json"
+    simple_json_name = "index.v1_json"
+    simple_api_version = "1.1"
+    metadata_ext = ".metadata"
+    fingerprint_dir = ".fingerprints"
+    catalog_name = "index.db"
     index_data_lock = threading.Lock()
 
     leaf_template = template('leaf.html')
     home_template = template('home.html')
 
     at = archive_tool = ArchiveUtil()
-    _move_on_error = at.move_on_error
+    _move_on_error = staticmethod(at.move_on_error)
 
     pkginfo_to_pkgdata = at.pkginfo_to_pkgdata
     pkginfo_from_file = at.pkginfo_from_file
     extension_of = at.extension_of
     leaf_locks = {}
+    project_maps = {}
+    registry_key = 'cp.index'
+    registry_lock = threading.Lock()
 
     def __init__(self, index_path, template_env=None,
                  arch_baseurl='/index/', urlbase='', index_data={},
                  leaf_data={}, error_folder='_errors', executor=None,
-                 logger=None, write_html=True):
+                 logger=None, write_html=True, datastore='json',
+                 compact_every=1000, io_executor=None, precompress=False,
+                 json_api=False, leaf_debounce=0, archive_tool=None):
 
         if logger is None:
             self.log = logging.getLogger('.'.join((__name__, self.__class__.__name__)))
 
         self.urlbase = urlbase
         self.write_html = write_html
+        self.precompress = precompress
+        self.json_api = json_api
         self.arch_baseurl = arch_baseurl
         self.template_env = template_env
 
@@ -87,20 +115,73 @@ class IndexManager(object):
 
             self.error_folder.makedirs()
 
+        if archive_tool is not None:
+            self.at = self.archive_tool = archive_tool
+            self.pkginfo_from_file = archive_tool.pkginfo_from_file
         self.move_on_error = partial(self._move_on_error, self.error_folder)
         self.arch_to_add_map = partial(self.at.arch_to_add_map,
                                        error_handler=self.move_on_error)
         self.executor = executor
+        self.io_executor = io_executor or executor
+        self._root_data = None
+        self.root_data_lock = threading.Lock()
+        self._template_version = None
+        self.leaf_stats = Counter()
+        self.leaf_scheduler = None
+        if leaf_debounce > 0:
+            self.leaf_scheduler = LeafScheduler(self.flush_leaf, leaf_debounce)
+
+        self.journal = self.catalog = None
+        if datastore == 'sqlite':
+            self.catalog = SQLiteCatalog(self.path / self.catalog_name)
+            if not len(self.catalog) and self.datafile_path.exists():
+                self.catalog.migrate(self.datafile_path)
+            self.data_from_path = self.catalog.data_from_path
+        elif datastore == 'journal':
+            self.journal = DataJournal(self.datafile_path, compact_every)
+        elif DataJournal.count_entries(self.datafile_path + DataJournal.suffix):
+            # switching back from journal mode: fold in what's left
+            DataJournal(self.datafile_path).compact()
+
+    @classmethod
+    def for_registry(cls, registry):
+        """
+        The long lived manager stored in the registry (see
+        `wsgiapp.main`), created on first use.
+        """
+        index = registry.get(cls.registry_key)
+        if index is None:
+            with cls.registry_lock:
+                index = registry.get(cls.registry_key)
+                if index is None:
+                    index = registry[cls.registry_key] = cls.from_registry(registry)
+        return index
+
+    @classmethod
+    def reload(cls, registry):
+        """
+        Replace the registry's manager (and drop its caches), say after
+        the settings have changed.
+        """
+        with cls.registry_lock:
+            old = registry.get(cls.registry_key)
+            if old is not None:
+                cls.project_maps.pop(old.path.abspath(), None)
+                if old.leaf_scheduler is not None:
+                    old.leaf_scheduler.close()
+            index = registry[cls.registry_key] = cls.from_registry(registry)
+        return index
 
     @classmethod
     def from_registry(cls, registry):
         settings = registry.settings
         executor = registry['cp.executor']
         env = registry['cp.index_templates']
-        return cls.from_settings(settings, executor, env)
+        return cls.from_settings(settings, executor, env,
+                                 io_executor=registry.get('cp.io_executor'))
 
     @classmethod
-    def from_settings(cls, settings, executor=None, env=None):
+    def from_settings(cls, settings, executor=None, env=None, io_executor=None):
         file_root = path(settings['cheeseprism.file_root'])
         if not file_root.exists():
             file_root.makedirs()
@@ -108,15 +189,28 @@ class IndexManager(object):
         urlbase = settings.get('cheeseprism.urlbase', '')
         write_html = asbool(settings.get('cheeseprism.write_html', 'true'))
         abu = settings.get('cheeseprism.archive.urlbase', '..')
-        idx_tmplt = settings.get('cheeseprism.index_templates', '')
-        env = EnvFactory.from_str(idx_tmplt)
+        if env is None:
+            env = EnvFactory.from_str(settings.get('cheeseprism.index_templates', ''))
+        datastore = settings.get('cheeseprism.datastore', 'json')
+        compact_every = int(settings.get('cheeseprism.journal.compact_every', 1000))
+        precompress = asbool(settings.get('cheeseprism.precompress', False))
+        json_api = asbool(settings.get('cheeseprism.json_api', False))
+        leaf_debounce = float(settings.get('cheeseprism.leaf_debounce', 0))
+        archive_tool = SandboxedArchiveUtil.from_settings(settings)
 
         return cls(settings['cheeseprism.file_root'],
                    urlbase=urlbase,
                    arch_baseurl=abu,
                    template_env=env,
                    executor=executor,
-                   write_html=write_html)
+                   write_html=write_html,
+                   datastore=datastore,
+                   compact_every=compact_every,
+                   io_executor=io_executor,
+                   precompress=precompress,
+                   json_api=json_api,
+                   leaf_debounce=leaf_debounce,
+                   archive_tool=archive_tool)
 
     @property
     def default_env_factory(self):
@@ -127,27 +221,105 @@ class IndexManager(object):
         return (x for x in self.path.files() if self.archive_tool.EXTS.match(x))
 
     def projects_from_archives(self):
+        """
+        Archives grouped by project, using the stored root data where
+        it matches the archive on disk and parsing only the rest.
+        """
         with benchmark('-- collected projects'):
-            projects = {}
-            paths = (self.path / item for item in self.files)
-            arch_info = partial(pki_ff, handle_error=self.move_on_error)
-            results = [info for info in self.executor.map(arch_info, paths)]
-            for itempath, info in results:
+            data = self.data_from_path(self.datafile_path)
+            stored = dict((x['filename'], x) for x in data.values() if x)
+            projects, unknown = {}, []
+            for itempath in self.files:
+                pkgdata = stored.get(itempath.name)
+                if pkgdata is None or pkgdata.get('size', itempath.size) != itempath.size:
+                    unknown.append(itempath)
+                    continue
+                info = StoredInfo.from_pkgdata(pkgdata)
+                projects.setdefault(info.name, []).append((info, itempath))
+
+            arch_info = partial(pki_ff, handle_error=self.move_on_error,
+                                func=self.at.pkginfo_from_file)
+            for itempath, info in self.executor.map(arch_info, unknown):
+                if info is None:
+                    continue
                 projects.setdefault(info.name, []).append((info, itempath))
 
         with benchmark('-- sorted projects'):
-            return sorted(projects.items())
+            items = sorted(projects.items())
+            self.project_map.reset(items)
+            return items
+
+    @property
+    def project_map(self):
+        """
+        The `ProjectMap` for this file root, shared by all managers of
+        the same root and built on first use.
+        """
+        pmap = self.project_maps.setdefault(self.path.abspath(), ProjectMap())
+        if not pmap.built:
+            with benchmark('-- built project map'):
+                pmap.build(self.data_from_path(self.datafile_path), self.files)
+        return pmap
 
-    def regenerate_leaf(self, leafname):
-        files = self.path.files('%s-*.*' %leafname)
+    def refresh_project_map(self):
+        """
+        If the file root has changed since the last listing, map
+        archives that arrived without an event (copied in by hand, say)
+        and drop those that have gone.
+        """
+        pmap = self.project_map
+        mtime = self.path.stat().st_mtime_ns
+        if mtime == pmap.mtime:
+            return pmap
 
         pki_ff = partial(self.at.pkginfo_from_file, handle_error=self.move_on_error)
-        versions = [(pki_ff(self.path / item), item) for item in files]
-        versions.sort(key=lambda x: pkg_resources.parse_version(x[0].version))
+        for filename in pmap.unknown(x.name for x in self.files):
+            info = pki_ff(self.path / filename)
+            if info is not None:
+                pmap.add(info.name, filename)
+        pmap.mtime = mtime
+        return pmap
+
+    def leaf_archives(self, leafname, refresh=True):
+        """
+        Paths for the archives belonging to exactly `leafname`
+        """
+        pmap = refresh and self.refresh_project_map() or self.project_map
+        files = (self.path / fn for fn in pmap.archives(leafname))
+        return [fp for fp in files if fp.exists()]
+
+    def regenerate_leaf(self, leafname, refresh=True, ingested=(), stored=None):
+        """
+        Rewrite a leaf from its archives. Pass `refresh=False` when
+        the project map is known to be current (ie. from events).
+
+        Archives with an `Ingestion` in `ingested` reuse its pkginfo
+        and hashed path, and those in `stored` (filename -> pkgdata)
+        that still match their size use it, rather than being parsed
+        again.
+        """
+        files = self.leaf_archives(leafname, refresh=refresh)
+        known = dict((str(x.path.name), x) for x in ingested if x.pkginfo is not None)
+        stored = stored or {}
 
+        pki_ff = partial(self.at.pkginfo_from_file, handle_error=self.move_on_error)
+        versions = []
+        for item in files:
+            pkgdata = stored.get(item.name)
+            if item.name in known:
+                versions.append((known[item.name].pkginfo, known[item.name].path))
+            elif pkgdata is not None and pkgdata.get('size', item.size) == item.size:
+                versions.append((StoredInfo.from_pkgdata(pkgdata), item))
+            else:
+                versions.append((pki_ff(self.path / item), item))
+        versions = [(info, item) for info, item in versions if info is not None]
         return self.write_leaf(self.path / leafname, versions)
 
-    def regenerate_all(self):
+    def regenerate_all(self, force=False):
+        """
+        Rewrite the home page and every leaf; leaves whose inputs are
+        unchanged are skipped unless `force` is true.
+        """
         items = self.projects_from_archives()
         if self.write_html is False:
             yield None
@@ -156,16 +328,42 @@ class IndexManager(object):
                 yield self.write_index_home(items)
 
         with benchmark('-- regenerated index'):
-            yield [self.write_leaf(self.path / key, value) for key, value in items]
-
-    def write_index_home(self, items):
+            before = self.leaf_stats.copy()
+            leaves = [self.write_leaf(self.path / key, value, force=force) for key, value in items]
+            stats = self.leaf_stats - before
+            self.log.info("Leaves rebuilt: %s, skipped (unchanged): %s",
+                          stats['rebuilt'], stats['skipped'])
+            yield leaves
+
+    def write_index_home(self, items=None):
+        """
+        Write the root index.html for `items` (as returned by
+        `projects_from_archives`) or for every project in the project
+        map.
+        """
         self.log.info('Write index home: %s', self.home_file)
+        if items is None:
+            names = self.project_map.names()
+        else:
+            names = [key for key, value in items]
         data = self.index_data.copy()
         data['packages'] = [dict(name=key, url=str(path(self.urlbase) / key )) \
-                            for key, value in items]
-        self.home_file.write_text(self.home_template.render(**data))
+                            for key in names]
+        self.write_output(self.home_file, self.home_template.render(**data))
+
+        if self.json_api is True:
+            doc = dict(meta={'api-version': self.simple_api_version},
+                       projects=[dict(name=key) for key in names])
+            self.write_output(self.path / self.simple_json_name, json.dumps(doc))
         return self.home_file
 
+    def write_output(self, target, text):
+        """
+        Atomically write a generated page, with compressed siblings if
+        `precompress` is on.
+        """
+        return write_precompressed(target, text, compress=self.precompress)
+
     def _leaf_html(self, leafdir, tversions, indexhtml="index.html"):
         title = "%s:%s" %(self.index_data['title'], leafdir.name)
         leafhome = leafdir / indexhtml
@@ -173,9 +371,46 @@ class IndexManager(object):
             package_title=leafdir.name,
             title=title,
             versions=tversions)
-        leafhome.write_text(text)
+        self.write_output(leafhome, text)
         return leafhome
 
+    @staticmethod
+    def upload_time(timestamp):
+        return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _leaf_simple_json(self, leafdir, leafdata):
+        """
+        Write the PEP 691 json page for a leaf beside its index.html
+        """
+        files = []
+        for datum in leafdata:
+            metadata = datum.get('core_metadata')
+            metadata = metadata and dict(sha256=metadata) or False
+            entry = {'filename': datum['filename'],
+                     'url': str(path(self.arch_baseurl) / datum['filename']),
+                     'hashes': dict((algo, datum[algo]) for algo in ('sha256', 'md5') \
+                                    if datum.get(algo)),
+                     'requires-python': datum.get('requires_python'),
+                     'core-metadata': metadata,
+                     'dist-info-metadata': metadata}
+            if datum.get('size') is not None:
+                entry['size'] = datum['size']
+            if datum.get('mtime'):
+                entry['upload-time'] = self.upload_time(datum['mtime'])
+            files.append(entry)
+
+        versions = []
+        for datum in leafdata:
+            if datum['version'] not in versions[-1:]:
+                versions.append(datum['version'])
+        doc = dict(meta={'api-version': self.simple_api_version},
+                   name=normalize_name(leafdir.name),
+                   versions=versions,
+                   files=files)
+        target = leafdir / self.simple_json_name
+        self.write_output(target, json.dumps(doc))
+        return target
+
     def _leaf_html_free(self, leafdir, versions, indexhtml="index.html"):
         leafhome = leafdir / indexhtml
         if not leafdir.exists():
@@ -185,6 +420,7 @@ class IndexManager(object):
         if leafhome.exists():
             self.log.info("HTML FREE: Removing %s", str(leafhome))
             leafhome.remove_p()
+            [path(leafhome + ext).remove_p() for ext in compressed_exts]
 
         for filepath in versions:
             target = leafdir / filepath.name
@@ -203,19 +439,77 @@ class IndexManager(object):
         return dict(url=url, name=archive.name)
 
     def leaf_values_from_map(self, leafname, leafdata):
-        name = leafdata['name']
+        name = leafdata['filename']
         url = str(path(self.arch_baseurl) / name)
-        return dict(url=url, name=name)
+        if leafdata.get('sha256'):
+            url = '%s#sha256=%s' % (url, leafdata['sha256'])
+        return dict(url=url, name=name,
+                    requires_python=leafdata.get('requires_python'),
+                    core_metadata=leafdata.get('core_metadata'))
+
+    def write_core_metadata(self, fpath, dist):
+        """
+        Write the archive's core metadata to `<archive>.metadata` in
+        the file root (PEP 658), once per archive. The sidecar carries
+        the archive's mtime, so an archive replaced under the same name
+        gets a fresh one. A `StoredInfo` is parsed for it only if the
+        stored data says the metadata is static.
+
+        :returns: sha256 of the metadata file or None
+        """
+        sidecar = self.path / (fpath.name + self.metadata_ext)
+        archive_mtime = fpath.stat().st_mtime_ns
+        if sidecar.exists():
+            if sidecar.stat().st_mtime_ns == archive_mtime:
+                return hashlib.sha256(sidecar.bytes()).hexdigest()
+            sidecar.remove_p()
+
+        if isinstance(dist, StoredInfo):
+            # parse only archives the stored data says have some
+            if not dist.metadata_static:
+                return None
+            dist = self.at.pkginfo_from_file(fpath, handle_error=self.move_on_error)
+
+        if not hasattr(dist, 'read') or not self.at.metadata_is_static(fpath, dist):
+            return None
+
+        try:
+            raw = dist.read()
+        except Exception:
+            self.log.exception("Could not read metadata for %s", fpath)
+            return None
+
+        if not raw:
+            return None
+        write_atomic(sidecar, raw)
+        os.utime(sidecar, ns=(archive_mtime, archive_mtime))
+        return hashlib.sha256(raw).hexdigest()
+
+    @staticmethod
+    def sortkey(datum):
+        """
+        The stored sort key of a leaf entry (computed for entries
+        written before keys were stored)
+        """
+        key = datum.get('sortkey')
+        if key is None:
+            key = datum['sortkey'] = version_key(datum['version'])
+        return key
 
     def leafdata(self, fpath, dist):
+        sortkey = isinstance(dist, StoredInfo) and dist.sortkey or version_key(dist.version)
         return dict(filename=str(fpath.name),
                     md5=fpath.md5hex,
+                    sha256=fpath.sha256hex,
                     size=fpath.size,
+                    requires_python=self.at.requires_python_of(dist),
                     name=dist.name,
                     version=dist.version,
                     mtime=fpath.mtime,
                     ctime=fpath.ctime,
-                    atime=fpath.ctime)
+                    atime=fpath.ctime,
+                    sortkey=sortkey,
+                    core_metadata=self.write_core_metadata(fpath, dist))
 
     getmd5 = staticmethod(operator.itemgetter('md5'))
 
@@ -224,15 +518,43 @@ class IndexManager(object):
         """
         Append a single version to leafjson
 
+        :returns: leafjson as dict
+        """
+        return self.add_versions_to_leafjson([(fpath, dist)], leafname, indexjson)
+
+    def add_versions_to_leafjson(self, versions, leafname,
+                                 indexjson="index.json"):
+        """
+        Insert (fpath, dist) `versions` into leafjson, in version
+        order, in one write
+
         :returns: leafjson as dict
         """
         leafdir = self.path / leafname
         leafjson = leafdir / indexjson
         with self.lock_leaf_json(leafname, leafjson) as leafdata:
-            if fpath.name in set([x['filename'] for x in leafdata]):
-                self.log.warning("%s - Attempt to add duplicate to %s", fpath, leafjson)
-                return leafdata
-            leafdata.append(self.leafdata(fpath, dist))
+            present = dict((x['filename'], x.get('md5')) for x in leafdata)
+            unkeyed = [x for x in leafdata if 'sortkey' not in x]
+            if unkeyed:
+                # written in upload order before keys were stored
+                leafdata.sort(key=self.sortkey)
+            keys = [self.sortkey(x) for x in leafdata]
+
+            for fpath, dist in versions:
+                name = str(fpath.name)
+                if name in present:
+                    if present[name] == fpath.md5hex:
+                        self.log.warning("%s - Attempt to add duplicate to %s", fpath, leafjson)
+                        continue
+                    # replaced under the same name: drop the stale entry
+                    self.log.info("%s - Replacing changed archive in %s", fpath, leafjson)
+                    leafdata[:] = [x for x in leafdata if x['filename'] != name]
+                    keys = [self.sortkey(x) for x in leafdata]
+                present[name] = fpath.md5hex
+                datum = self.leafdata(fpath, dist)
+                idx = bisect.bisect_right(keys, datum['sortkey'])
+                keys.insert(idx, datum['sortkey'])
+                leafdata.insert(idx, datum)
         return leafdata
 
     @contextmanager
@@ -244,26 +566,43 @@ class IndexManager(object):
             try:
                 yield leafdata
             finally:
-                with open(leafjson, 'w') as jsonout:
-                    json.dump(leafdata, jsonout)
+                self.write_output(leafjson, json.dumps(leafdata))
 
     def add_version_to_leaf(self, fpath, leafname,
                             indexjson="index.json",
-                            indexhtml="index.html"):
+                            indexhtml="index.html",
+                            dist=None):
         """
         Most minimally, add a package version to a leaf node
 
+        `dist` is the already parsed pkginfo for `fpath`, if any.
+
+        :returns: leafjson as dict
+        """
+        return self.add_versions_to_leaf([(fpath, dist)], leafname, indexjson, indexhtml)
+
+    def add_versions_to_leaf(self, versions, leafname,
+                             indexjson="index.json",
+                             indexhtml="index.html"):
+        """
+        Add several (fpath, dist) `versions` to a leaf node with a
+        single json write and render. A dist of None is parsed here.
+
         :returns: leafjson as dict
         """
         leafdir = self.path / leafname
         assert leafdir.exists(), "Leafdir missing: %s" %leafdir
-        dist = self.at.pkginfo_from_file(fpath, handle_error=self.move_on_error)
-        leafdata = self.add_version_to_leafjson(fpath, dist, leafname, indexjson="index.json")
+        versions = [(fpath, dist is None \
+                     and self.at.pkginfo_from_file(fpath, handle_error=self.move_on_error) \
+                     or dist) for fpath, dist in versions]
+        leafdata = self.add_versions_to_leafjson(versions, leafname, indexjson="index.json")
 
         if self.write_html is True:
             self._leaf_html(leafdir,
                             (self.leaf_values_from_map(leafname, datum) for datum in leafdata),
                             indexhtml="index.html")
+            if self.json_api is True:
+                self._leaf_simple_json(leafdir, leafdata)
         else:
             versions = (self.path / x['filename'] for x in leafdata) #@@ maybe on link what needs to be?
             linked = [x for x in \
@@ -277,8 +616,18 @@ class IndexManager(object):
                                               leafdir / indexjson,
                                               active_archives))
             leafdata = self.cleanup_leafdata(leafdir, leafdir / indexjson)
+
+        self.write_fingerprint(leafdir, self.leaf_fingerprint(leafdata))
         return leafdata
 
+    def flush_leaf(self, leafname, versions):
+        """
+        Write (fpath, dist) `versions` gathered by the leaf scheduler
+        """
+        self.leaf_stats['coalesced'] += len(versions) - 1
+        with benchmark("%s - rebuilt (%s versions)" % (leafname, len(versions))):
+            return self.add_versions_to_leaf(versions, leafname)
+
     def cleanup_leafdata(self, leafdir, leafjson):
         with self.lock_leaf_json(str(leafdir.name), leafjson) as leafdata:
             missing = [idx for idx, fn in enumerate(x['filename'] for x in leafdata) if not (leafdir / fn).exists()]
@@ -307,40 +656,125 @@ class IndexManager(object):
 
         return removed, archive_missing
 
+    @property
+    def template_version(self):
+        """
+        Digest of the leaf template sources
+        """
+        if self._template_version is None:
+            env, digest = self.template_env, hashlib.sha1()
+            for name in (self.leaf_name, 'base.html'):
+                digest.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+            self._template_version = digest.hexdigest()
+        return self._template_version
+
+    def leaf_fingerprint(self, leafdata):
+        """
+        Digest of everything that goes into a leaf: its archives (name,
+        md5, version), the templates and the settings used to render.
+        """
+        archives = sorted((x['filename'], x['md5'], x['version']) for x in leafdata)
+        inputs = [archives, self.template_version, self.write_html, self.json_api,
+                  self.precompress, self.arch_baseurl, self.index_data.get('title')]
+        return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    def fingerprint_path(self, leafdir):
+        """
+        Where a leaf's fingerprint is kept: beside the leaves rather
+        than among the files served from them
+        """
+        return self.path / self.fingerprint_dir / leafdir.name
+
+    def write_fingerprint(self, leafdir, fingerprint):
+        fpfile = self.fingerprint_path(leafdir)
+        fpfile.parent.makedirs_p()
+        fpfile.write_text(fingerprint)
+        return fpfile
+
+    def leaf_is_current(self, leafdir, fingerprint, indexjson="index.json", indexhtml="index.html"):
+        fpfile = self.fingerprint_path(leafdir)
+        outputs = [leafdir / indexjson]
+        if self.write_html is True:
+            outputs.append(leafdir / indexhtml)
+            if self.json_api is True:
+                outputs.append(leafdir / self.simple_json_name)
+        return fpfile.exists() and all(x.exists() for x in outputs) \
+               and fpfile.text() == fingerprint
+
     #@@ combine with regenerate_leaf
-    def write_leaf(self, leafdir, versions, indexjson="index.json", indexhtml="index.html"):
+    def write_leaf(self, leafdir, versions, indexjson="index.json", indexhtml="index.html",
+                   force=False):
+        """
+        Write a leaf's html (or links) and json, unless its fingerprint
+        shows nothing has changed since the last write.
+        """
         leafjson = leafdir / indexjson
         versions = list(versions)
+        leafdata = [self.leafdata(fpath, dist) for dist, fpath in versions]
+        leafdata.sort(key=self.sortkey)
+        fingerprint = self.leaf_fingerprint(leafdata)
+
+        if not force and self.leaf_is_current(leafdir, fingerprint, indexjson, indexhtml):
+            self.leaf_stats['skipped'] += 1
+            return leafjson
 
         if not leafdir.exists(): leafdir.makedirs()
 
         if self.write_html is True:
-            tversions = (self.leaf_values_from_archive(leafdir.name, archive)\
-                         for info, archive in versions)
+            tversions = (self.leaf_values_from_map(leafdir.name, datum) for datum in leafdata)
             self._leaf_html(leafdir, tversions, indexhtml="index.html")
+            if self.json_api is True:
+                self._leaf_simple_json(leafdir, leafdata)
         else:
             [x for x in self._leaf_html_free(leafdir, (y for x, y in versions), indexhtml="index.html")]
 
         with self.leaf_locks.setdefault(leafdir.name, threading.Lock()):
-            with open(leafjson, 'w') as jsonout:
-                leafdata = [self.leafdata(fpath, dist) for dist, fpath in versions]
-                json.dump(leafdata, jsonout)
+            self.write_output(leafjson, json.dumps(leafdata))
 
         leafjson.utime((time.time(), time.time()))
+        self.write_fingerprint(leafdir, fingerprint)
+        self.leaf_stats['rebuilt'] += 1
         return leafjson
 
+    @staticmethod
+    def stat_key(fpath):
+        if fpath.exists():
+            st = fpath.stat()
+            return st.st_mtime_ns, st.st_size
+
+    def root_data(self):
+        """
+        The root data (md5 -> pkgdata), reloaded only when the datafile
+        or its journal has changed. Treat as read only.
+        """
+        if self.catalog is not None:
+            return self.catalog
+
+        key = (self.stat_key(self.datafile_path),
+               self.stat_key(self.datafile_path + DataJournal.suffix))
+        with self.root_data_lock:
+            if self._root_data is None or self._root_data[0] != key:
+                self._root_data = key, self.data_from_path(self.datafile_path)
+            return self._root_data[1]
+
     @staticmethod
     def data_from_path(datafile):
         datafile = path(datafile)
-        if datafile.exists():
-            with open(datafile) as stream:
-                return json.load(stream)
-        else:
+        if not datafile.exists():
             logging.error("No datafile found for %s", datafile)
             datafile.write_text("{}")
-        return {}
+        return DataJournal.read(datafile)
 
     def _write_datafile(self, **data):
+        if self.catalog is not None:
+            return self.catalog.update(**data)
+
+        if self.journal is not None:
+            self.journal.append(**data)
+            if self.journal.needs_compaction:
+                self.journal.compact()
+            return data
+
         if self.datafile_path.exists():
             newdata = data
             with open(self.datafile_path) as root:
@@ -358,15 +792,41 @@ class IndexManager(object):
                 return self._write_datafile(**data)
         return self._write_datafile(**data)
 
+    def forget_data(self, *md5s):
+        """
+        Drop entries from the root data
+        """
+        with self.index_data_lock:
+            if self.catalog is not None:
+                return self.catalog.remove(*md5s)
+
+            if self.journal is not None:
+                return self.journal.append(**dict.fromkeys(md5s))
+
+            data = self.data_from_path(self.datafile_path)
+            for md5 in md5s:
+                data.pop(md5, None)
+            with open(self.datafile_path, 'w') as root:
+                json.dump(data, root)
+            return data
+
     def reg_data(self, arch):
         pkgdata = self.arch_to_add_map(arch)
         return arch.md5hex, pkgdata,
 
-    def register_archive(self, arch, registry=None):
+    def register_archive(self, arch, registry=None, ingest=None):
         """
         Adds an archive to the master data store (index.json)
+
+        An `ingest` (see `archiveutil.Ingestion`) carrying the parsed
+        pkginfo spares parsing the archive again; its pkgdata is set.
         """
-        md5, pkgdata = self.reg_data(arch)
+        if ingest is not None and ingest.pkginfo is not None:
+            if ingest.pkgdata is None:
+                ingest.pkgdata = self.at.pkginfo_to_pkgdata(ingest.path, ingest.pkginfo)
+            md5, pkgdata = ingest.md5, ingest.pkgdata
+        else:
+            md5, pkgdata = self.reg_data(arch)
         self.write_datafile(**{md5:pkgdata})
         return pkgdata, md5
 
@@ -387,31 +847,66 @@ class IndexManager(object):
         new = []
 
         archs_g = self.group_by_magnitude([x for x in archs])
+        killed = self.at.killed
         with benchmark("Rebuilt root index.json"):
             for archs in archs_g:
                 with self.index_data_lock:
                     new.extend(self._update_data(archs, datafile))
 
+        killed = self.at.killed - killed
+        if killed:
+            self.log.warning("Quarantined %s archives over inspection limits", killed)
+
+        if self.journal is not None and len(self.journal):
+            with self.index_data_lock:
+                self.journal.compact()
+
         pkgs = len(set(x['name'] for x in new))
         self.log.info("Inspected %s versions for %s packages" %(len(new), pkgs))
         return new
 
     def _update_data(self, archs, datafile):
+        """
+        Hash archives on the io executor, then parse only the ones not
+        yet in the index on the (possibly process based) executor.
+        """
         data = self.data_from_path(datafile)
         new = []
-        exe = self.executor
 
-        read = self.archive_tool
-        archdata = [(arch, data) for arch in archs]
-        for md5, pkgdata in exe.map(read, archdata):
+        archs = [isinstance(arch, path) and arch or path(arch) for arch in archs]
+        md5s = self.io_executor.map(operator.attrgetter('md5hex'), archs)
+        todo = [arch for arch, md5 in zip(archs, md5s) if md5 not in data]
+
+        if isinstance(self.executor, futures.ProcessPoolExecutor):
+            # workers count quarantined archives on their own copy of
+            # the archive tool: bring the counts back with the results
+            counted = partial(count_killed, func=self.arch_to_add_map, at=self.at)
+            results = list(self.executor.map(counted, todo))
+            self.at.killed += sum(killed for pkgdata, killed in results)
+            pkgdatas = [pkgdata for pkgdata, killed in results]
+        else:
+            pkgdatas = self.executor.map(self.arch_to_add_map, todo)
+
+        added = {}
+        for arch, pkgdata in zip(todo, pkgdatas):
             if pkgdata is not None:
-                data[md5] = pkgdata
+                added[arch.md5hex] = pkgdata
                 new.append(pkgdata)
 
-        self.write_datafile(with_lock=False, **data)
+        if added or (self.catalog is None and not self.datafile_path.exists()):
+            self.write_datafile(with_lock=False, **added)
         return new
 
 
+def count_killed(arch, func=None, at=None):
+    """
+    `func(arch)` and how many archives `at` quarantined meanwhile
+    """
+    killed = at.killed
+    pkgdata = func(arch)
+    return pkgdata, at.killed - killed
+
+
 def pki_ff(path, handle_error=None, func=IndexManager.at.pkginfo_from_file):
     return path, func(path, handle_error=handle_error)
 
@@ -421,18 +916,41 @@ def rebuild_leaf(event):
     #@@ consider index as a registry bound utility
     reg = threadlocal.get_current_registry()
     fpath, name, index = event.path, event.name, event.im
+    ingest = getattr(event, 'ingest', None)
 
-    index.register_archive(event.path, registry=reg)
+    index.register_archive(event.path, registry=reg, ingest=ingest)
+    index.project_map.add(name, fpath.name)
     ppath = index.path / event.name
 
     logger.debug("Adding %s" %(event.path))
+    dist = ingest and ingest.pkginfo or None
     if ppath.exists():
+        if index.leaf_scheduler is not None:
+            index.leaf_scheduler.schedule(name, (fpath, dist))
+            return ppath
+
         with benchmark("%s - rebuilt" %(event.name)):
-            return index.add_version_to_leaf(fpath, name)
+            return index.add_version_to_leaf(fpath, name, dist=dist)
 
     with benchmark("%s - new leaf" %name):
-        return index.regenerate_leaf(name)
+        return index.regenerate_leaf(name, refresh=False,
+                                     ingested=ingest and [ingest] or ())
+
+
 
+@subscriber(event.IPackageRemoved)
+def forget_archive(event):
+    index = event.im
+    filename = str(event.path.name)
+    index.project_map.remove(event.name, filename)
+    (index.path / (filename + index.metadata_ext)).remove_p()
+    md5s = [md5 for md5, pkgdata in index.root_data().items() \
+            if pkgdata and pkgdata['filename'] == filename]
+    if md5s:
+        index.forget_data(*md5s)
+    if (index.path / event.name).exists():
+        with benchmark("%s - removed %s" % (event.name, event.path.name)):
+            return index.regenerate_leaf(event.name, refresh=False)
 
 
 @subscriber(event.IIndexUpdate)
@@ -454,16 +972,20 @@ def bulk_add_pkgs(index, new_pkgs):
         for data in new_pkgs:
             leaves.add(data['name'])
             archs.append(index.path / data['filename'])
+            index.project_map.add(data['name'], data['filename'])
 
-        bm.name = "Added & registered %s archives and rebuilt %s leaves"\
-           %(len(archs), len(leaves))
-
+        stored = dict((x['filename'], x) for x in index.root_data().values() if x)
+        before = index.leaf_stats.copy()
         for leaf in leaves:
             try:
-                index.regenerate_leaf(leaf)
+                index.regenerate_leaf(leaf, refresh=False, stored=stored)
             except Exception:
                 logger.exception('Issue building leaf for %s', leaf)
 
+        stats = index.leaf_stats - before
+        bm.name = "Added & registered %s archives, rebuilt %s leaves (%s unchanged)"\
+           %(len(archs), stats['rebuilt'], stats['skipped'])
+
     return leaves, archs
 
 
@@ -472,9 +994,14 @@ def bulk_update_index_at_start(event):
         logger.info("--> Checking and updating index")
         reg = event.app.registry
 
-        index = IndexManager.from_registry(reg)
+        index = IndexManager.for_registry(reg)
         logger.info("-- %s pkg in %s", len([x for x in index.files]), index.path.abspath())
 
+        sample = float(reg.settings.get('cheeseprism.digest_cache.verify', 0))
+        if sample and path.digest_cache is not None:
+            with benchmark('-- verified digest cache'):
+                path.digest_cache.verify(index.files, sample)
+
         new_pkgs = index.update_data()
 
         logger.info("-- Bulk add %d packages", len(new_pkgs))
@@ -482,8 +1009,7 @@ def bulk_update_index_at_start(event):
 
         home_file = index.path / index.root_index_file
         if index.write_html is True and (not home_file.exists() or len(leaves)):
-            items = index.projects_from_archives()
-            index.write_index_home(items)
+            index.write_index_home()
 
         return leaves, archs
 
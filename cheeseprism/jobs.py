@@ -0,0 +1,145 @@
+"""
+Background processing of uploads (`cheeseprism.async_upload`)
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from pyramid import threadlocal
+import logging
+import queue
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    One queued unit of work and the time spent in each of its stages
+    """
+    states = QUEUED, PROCESSING, DONE, FAILED = ('queued', 'processing', 'done', 'failed')
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = self.QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.stages[name] = time.time() - start
+
+    def as_dict(self):
+        return dict(id=self.id,
+                    name=self.name,
+                    state=self.state,
+                    error=self.error,
+                    created=self.created,
+                    started=self.started,
+                    finished=self.finished,
+                    stages=list(self.stages.items()))
+
+
+class JobQueue(object):
+    """
+    A bounded queue of jobs worked by a few daemon threads.
+
+    `submit` raises `queue.Full` rather than blocking when the queue
+    is at capacity. Finished jobs are remembered (up to `keep`) so
+    their status may be polled.
+    """
+    registry_key = 'cp.jobs'
+    Full = queue.Full
+
+    def __init__(self, maxsize=100, workers=1, keep=1000, registry=None):
+        self.queue = queue.Queue(maxsize)
+        self.keep = keep
+        self.registry = registry
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, name='cp-jobs-%s' % i) \
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def from_settings(cls, settings, registry=None):
+        return cls(maxsize=int(settings.get('cheeseprism.async_upload.queue_size', 100)),
+                   workers=int(settings.get('cheeseprism.async_upload.workers', 1)),
+                   registry=registry)
+
+    def submit(self, job, func, *args, **kw):
+        """
+        Queue `func(job, *args, **kw)` for `job` (a `Job`)
+
+        :returns: `job`
+        """
+        with self.lock:
+            self.jobs[job.id] = job
+        try:
+            self.queue.put_nowait((job, func, args, kw))
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_finished(self):
+        with self.lock:
+            finished = [key for key, job in self.jobs.items() \
+                        if job.state in (Job.DONE, Job.FAILED)]
+            for key in finished[:max(len(finished) - self.keep, 0)]:
+                del self.jobs[key]
+
+    def run(self, job, func, args, kw):
+        job.state, job.started = Job.PROCESSING, time.time()
+        if self.registry is not None:
+            threadlocal.manager.push(dict(registry=self.registry, request=None))
+        try:
+            func(job, *args, **kw)
+            job.state = Job.DONE
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job.id, job.name)
+            job.state, job.error = Job.FAILED, str(e)
+        finally:
+            if self.registry is not None:
+                threadlocal.manager.pop()
+            job.finished = time.time()
+            logger.info("Job %s (%s) %s: %s", job.id, job.name, job.state,
+                        ", ".join("%s %0.3fs" % x for x in job.stages.items()))
+        self.forget_finished()
+        return job
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.run(*item)
+            finally:
+                self.queue.task_done()
+
+    def close(self, wait=True):
+        """
+        Let the workers finish what's queued, then stop them
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
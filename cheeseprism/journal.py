@@ -0,0 +1,132 @@
+"""
+Append-only journal for the root index data (md5 -> pkgdata)
+"""
+from .utils import path
+import json
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class DataJournal(object):
+    """
+    Records updates to the root index data as json lines next to the
+    snapshot (index.json).
+
+    Readers replay the journal over the snapshot (see `read`);
+    `compact` folds the journal back into the snapshot and starts a
+    fresh journal.
+    """
+    suffix = '.journal'
+
+    def __init__(self, snapshot, compact_every=1000):
+        self.snapshot = path(snapshot)
+        self.path = path(self.snapshot + self.suffix)
+        self.compact_every = compact_every
+        self.entries = self.count_entries(self.path)
+
+    def __len__(self):
+        return self.entries
+
+    @staticmethod
+    def count_entries(journal):
+        if not path(journal).exists():
+            return 0
+        with open(journal) as stream:
+            return sum(1 for line in stream if line.strip())
+
+    @property
+    def needs_compaction(self):
+        return self.entries >= self.compact_every
+
+    def append(self, **data):
+        """
+        Writes a single journal entry: O(1) regardless of the size of
+        the snapshot.
+        """
+        with open(self.path, 'a') as stream:
+            stream.write(json.dumps(data) + '\n')
+            stream.flush()
+        self.entries += 1
+        return data
+
+    @classmethod
+    def replay(cls, snapshot, data):
+        """
+        Apply the journal for `snapshot` to `data` in place; an entry
+        of None removes that key
+        """
+        journal = path(snapshot + cls.suffix)
+        if not journal.exists():
+            return data
+
+        with open(journal) as stream:
+            for lineno, line in enumerate(stream):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # most likely a partial write from a crash
+                    logger.error("Skipping bad journal entry %s:%s", journal, lineno)
+                    continue
+                for key, value in entry.items():
+                    if value is None:
+                        data.pop(key, None)
+                    else:
+                        data[key] = value
+        return data
+
+    @classmethod
+    def read(cls, snapshot):
+        """
+        The snapshot with its journal applied.
+
+        A compaction between reading the two would pair the old
+        snapshot with the truncated journal, so the read is repeated
+        if the snapshot was replaced meanwhile.
+        """
+        snapshot = path(snapshot)
+        while True:
+            data, inode = {}, None
+            if snapshot.exists():
+                with open(snapshot) as stream:
+                    inode = os.fstat(stream.fileno()).st_ino
+                    data = json.load(stream)
+            cls.replay(snapshot, data)
+            if cls.inode(snapshot) == inode:
+                return data
+            logger.debug("%s was compacted while being read, reading again", snapshot)
+
+    @staticmethod
+    def inode(fpath):
+        try:
+            return os.stat(fpath).st_ino
+        except OSError:
+            return None
+
+    def compact(self, data=None):
+        """
+        Write the snapshot (atomically) with the journal applied and
+        truncate the journal.
+        """
+        if data is None:
+            data = self.load()
+
+        fd, tmp = tempfile.mkstemp(dir=self.snapshot.parent,
+                                   prefix='.%s.' % self.snapshot.name)
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(data, stream)
+        os.rename(tmp, self.snapshot)
+
+        with open(self.path, 'w'):
+            pass
+        logger.info("Compacted %s journal entries into %s", self.entries, self.snapshot)
+        self.entries = 0
+        return data
+
+    def load(self):
+        return self.read(self.snapshot)
@@ -1,16 +1,19 @@
 from cheeseprism.index import IndexManager
 from functools import partial
+from .download import fetch
+from .utils import DigestMismatch
+from .utils import normalize_name
 from .utils import path
 from pip.exceptions import DistributionNotFound
 from pip.index import PackageFinder
 from pip.locations import build_prefix, src_prefix
 from pip.req import RequirementSet, parse_requirements
 from urllib.error import HTTPError
+import futures
 import logging
 import requests
-import tarfile
 import tempfile
-import zipfile
+import threading
 
 
 logger = logging.getLogger(__name__)
@@ -21,7 +24,8 @@ class RequirementDownloader(object):
     pkginfo_from_file = IndexManager.pkginfo_from_file
     parse_requirements = staticmethod(parse_requirements)
 
-    def __init__(self, req_set, finder=None, upgrade=False, seen=None):
+    def __init__(self, req_set, finder=None, upgrade=False, seen=None,
+                 depcache=None, workers=5):
         #@@ start with req_set??
         self.req_set = req_set
         self.upgrade = False
@@ -33,6 +37,13 @@ class RequirementDownloader(object):
         if self.seen is None:
             self.seen = set()
         self.errors = []
+        # md5 -> pkgdata (ie. the root index data) holding dependency
+        # info extracted at ingestion
+        self.depcache = {} if depcache is None else depcache
+        self.depinfo = {}
+        self.workers = workers
+        self.claimed = set()
+        self.lock = threading.Lock()
 
     # toupe for pip
     options = type('Options', (), dict(skip_requirements_regex='',
@@ -77,36 +88,56 @@ class RequirementDownloader(object):
             return None
         
     @classmethod
-    def depinfo_for_file(cls, filename):
-        if filename.endswith('.zip'):
-            archive = zipfile.ZipFile(filename)
-            names = archive.namelist()
-            read = partial(cls.readzip, archive)
-        elif filename.endswith('gz') \
-          or filename.endswith('bz2'):
-            archive = tarfile.TarFile.open(filename)
-            names = archive.getnames()
-            read = partial(cls.readtar, archive)
-        elif filename.endswith('whl'):
-            return [], [],
-        else:
+    def depinfo_for_file(cls, filename, pkginfo=None):
+        if not IndexManager.at.extension_of(filename):
             logger.error("Unrecognized file type: %s", filename)
             return [], [],
-        
-        dl_file = cls.find_file(names, '.egg-info/dependency_links.txt')
-        reqs_file = cls.find_file(names, '.egg-info/requires.txt')        
-        deplinks = dl_file and read(dl_file) or ''
-        requires = reqs_file and read(reqs_file) or ''
-        return [x.strip() for x in deplinks.split('\n') if x],\
-               [x.strip() for x in requires.split('\n') if x and not x.startswith('[')]
+        return getattr(pkginfo, 'depinfo', None) \
+               or IndexManager.at.depinfo_for_file(filename, pkginfo)
+
+    def dependencies(self, md5, outfile=None, pkginfo=None):
+        """
+        (dependency links, requirements) for the archive with `md5`:
+        from the cache when it has been indexed, else (given `outfile`)
+        read from the archive once.
+        """
+        depinfo = IndexManager.at.depinfo_from_pkgdata(self.depcache.get(md5)) \
+                  or self.depinfo.get(md5)
+        if depinfo is None and outfile is not None:
+            depinfo = self.depinfo[md5] = self.depinfo_for_file(outfile, pkginfo)
+        return depinfo
+
+    @staticmethod
+    def dist_key(name, filename):
+        """
+        (normalized name, version) guessed from an archive filename
+        """
+        name = normalize_name(name)
+        base = str(filename)
+        ext = IndexManager.at.extension_of(base)
+        if ext:
+            base = base[:-len(ext)]
+            if base.endswith('.tar'):
+                base = base[:-4]
+        if ext == '.whl':
+            parts = base.split('-')
+            return name, len(parts) > 1 and parts[1] or base
+        if normalize_name(base).startswith(name + '-'):
+            return name, base[len(name) + 1:]
+        return name, base
+
+    def requirements_from(self, pkg, deplinks, reqs):
+        content = "\n".join(reqs)
+        req_set, _ = self.req_set_from_file(self.temp_req(pkg, content),
+                                            self.download_dir,
+                                            deplinks=deplinks)
+        return req_set
 
     def download_url(self, link):
-        target_url = link.url.split('#', 1)[0]
-        resp = requests.get(target_url)
-        logger.info('Downloading: %s' %target_url)
-        outfile = self.download_dir / link.filename
-        outfile.write_bytes(resp.content)
-        # requests.iter_content
+        """
+        Stream `link` into the download dir, verifying its hash fragment
+        """
+        outfile = fetch(link.url, self.download_dir / link.filename)
         pkginfo = self.pkginfo_from_file(outfile)
         return pkginfo, outfile
 
@@ -117,6 +148,18 @@ class RequirementDownloader(object):
             fp.write_text(content)
         return fp
 
+    def claim(self, key):
+        """
+        Claim a (normalized name, version) for this resolution; False
+        if it was already claimed, which also breaks dependency cycles
+        """
+        with self.lock:
+            if key in self.claimed:
+                logger.debug('Already resolving: %s-%s', *key)
+                return False
+            self.claimed.add(key)
+        return True
+
     def handle_requirement(self, req, finder):
         """
         Download requirement, return a new requirement set of
@@ -136,14 +179,23 @@ class RequirementDownloader(object):
             self.errors.append(msg)
             return
         
+        key = self.dist_key(req.name, url.filename)
+        if not self.claim(key):
+            return
+
         if url.hash in self.seen:
             logger.debug('Seen: %s', url)
             self.skip.append(url)
-            return 
-            
+            # already indexed: follow its dependencies from the cache
+            depinfo = self.dependencies(url.hash)
+            if depinfo is None or not depinfo[1]:
+                return
+            pkg = "%s-%s" % key
+            return None, None, self.requirements_from(pkg, *depinfo)
+
         try:
             pkginfo, outfile = self.download_url(url)
-        except HTTPError as e:
+        except (HTTPError, requests.RequestException, DigestMismatch) as e:
             msg = "Issue with download: %s" %e
             logger.error(msg)
             self.errors.append("%s: %s" %(req, msg)) 
@@ -157,37 +209,44 @@ class RequirementDownloader(object):
             return
 
         self.seen.add(outfile.md5hex)
-        deplinks, reqs = self.depinfo_for_file(outfile)
+        deplinks, reqs = self.dependencies(outfile.md5hex, outfile, pkginfo)
         if not reqs:
             return pkginfo, outfile, None
-        
-        content = "\n".join(reqs)
+
         pkg = "%s-%s" %(pkginfo.name, pkginfo.version)
-        req_set, _ = self.req_set_from_file(self.temp_req(pkg, content),
-                                            self.download_dir,
-                                            deplinks=deplinks)
-        return pkginfo, outfile, req_set,
+        return pkginfo, outfile, self.requirements_from(pkg, deplinks, reqs),
 
     pkg_finder_class = PackageFinder
     index_urls = ['https://pypi.python.org/simple']
 
     def download_all(self, req_set=None, finder=None):
+        """
+        Resolve and download breadth first: each level of requirements
+        is handled concurrently on up to `workers` threads, the
+        dependencies found making up the next level.
+        """
         if req_set is None:
             req_set = self.req_set
         if finder is None:
             finder = self.finder or self.package_finder(None)
 
-        for req in list(req_set.requirements.values()):
-            output = self.handle_requirement(req, finder)
-            if output is None:
-                continue
-            self.seen.add(req)
-            pkginfo, outfile, req_set = output
-            yield pkginfo, outfile
-            if req_set is not None:
-                logger.info("Dependencies determined: %s" %list(req_set.requirements.keys()))
-                for pkginfo, outfile in self.download_all(req_set, finder):
-                    yield pkginfo, outfile
+        level = list(req_set.requirements.values())
+        with futures.ThreadPoolExecutor(max(self.workers, 1)) as executor:
+            while level:
+                handle = partial(self.handle_requirement, finder=finder)
+                jobs = dict((executor.submit(handle, req), req) for req in level)
+                level = []
+                for job in futures.as_completed(jobs):
+                    output = job.result()
+                    if output is None:
+                        continue
+                    self.seen.add(jobs[job])
+                    pkginfo, outfile, deps = output
+                    if pkginfo is not None:
+                        yield pkginfo, outfile
+                    if deps is not None:
+                        logger.info("Dependencies determined: %s" %list(deps.requirements.keys()))
+                        level.extend(deps.requirements.values())
 
     @classmethod
     def package_finder(cls, deplinks, index_urls=None):
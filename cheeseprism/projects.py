@@ -0,0 +1,100 @@
+"""
+In memory index of which archives belong to which project
+"""
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProjectMap(object):
+    """
+    Maps project name -> archive filenames for a single file root.
+
+    Built from the root data and a single directory listing, then kept
+    current by the package events so leaf rebuilds don't need to scan
+    the file root. `mtime` records the file root's mtime as of the
+    last listing, so a changed directory can be detected cheaply.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.projects = {}
+        self.filenames = {}
+        self.built = False
+        self.mtime = None
+
+    def build(self, data, files):
+        """
+        Populate from root data (md5 -> pkgdata) for the `files`
+        actually present in the file root.
+        """
+        present = set(str(x.name) for x in files)
+        with self.lock:
+            self.projects, self.filenames = {}, {}
+            for pkgdata in data.values():
+                if pkgdata and pkgdata['filename'] in present:
+                    self._add(pkgdata['name'], pkgdata['filename'])
+            self.built = True
+        logger.debug("Project map: %s archives for %s projects",
+                     len(self.filenames), len(self.projects))
+        return self
+
+    def reset(self, items):
+        """
+        Populate from `projects_from_archives` style output
+        """
+        with self.lock:
+            self.projects, self.filenames = {}, {}
+            for name, versions in items:
+                for info, arch in versions:
+                    self._add(name, str(arch.name))
+            self.built = True
+        return self
+
+    def __contains__(self, name):
+        return name in self.projects
+
+    def __len__(self):
+        return len(self.projects)
+
+    def _add(self, name, filename):
+        self.projects.setdefault(name, set()).add(filename)
+        self.filenames[filename] = name
+
+    def add(self, name, filename):
+        with self.lock:
+            self._add(name, str(filename))
+
+    def remove(self, name, filename):
+        filename = str(filename)
+        with self.lock:
+            name = self.filenames.pop(filename, name)
+            archives = self.projects.get(name, set())
+            archives.discard(filename)
+            if not archives:
+                self.projects.pop(name, None)
+
+    def unknown(self, present):
+        """
+        Drop archives missing from `present` (filenames from a fresh
+        listing) and return those in `present` not yet mapped.
+        """
+        present = set(str(x) for x in present)
+        with self.lock:
+            gone = [fn for fn in self.filenames if fn not in present]
+            new = [fn for fn in present if fn not in self.filenames]
+        for filename in gone:
+            self.remove(None, filename)
+        return new
+
+    def project_of(self, filename):
+        return self.filenames.get(str(filename))
+
+    def archives(self, name):
+        with self.lock:
+            return sorted(self.projects.get(name, ()))
+
+    def names(self):
+        with self.lock:
+            return sorted(self.projects)
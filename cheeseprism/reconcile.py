@@ -0,0 +1,209 @@
+"""
+Targeted repair of the root data and leaves after the file root
+changed behind the index's back
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class IndexDiff(object):
+    """
+    Archives in the file root vs entries in the root data:
+
+    - `added`: paths with no entry
+    - `removed`: (md5, pkgdata) entries whose archive is gone
+    - `modified`: (path, [(md5, pkgdata)]) archives whose entries no
+      longer match them (size, or mtime and digest)
+    """
+    def __init__(self, added=(), removed=(), modified=()):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.modified = list(modified)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def __str__(self):
+        return "added: %s, removed: %s, modified: %s" \
+               % (sorted(str(x.name) for x in self.added),
+                  sorted(x['filename'] for md5, x in self.removed),
+                  sorted(str(x.name) for x, stale in self.modified))
+
+
+class Reconciler(object):
+    """
+    Computes the exact difference between the file root and the root
+    data and repairs only the affected entries and leaves.
+    """
+    # archive path -> (mtime, md5) last found to match its entry, so a
+    # touched but unchanged archive is hashed once rather than each poll
+    verified = {}
+
+    def __init__(self, index):
+        self.index = index
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.time() - start
+
+    def changed(self, fpath, md5, pkgdata):
+        """
+        Whether `fpath` differs from its entry: by size, or, if written
+        since it was indexed (and not verified since), by digest.
+        Entries from before `added` was recorded are checked by size
+        only.
+        """
+        if pkgdata.get('size', fpath.size) != fpath.size:
+            return True
+        added = pkgdata.get('added')
+        if not added or fpath.mtime <= added:
+            return False
+        checked = fpath.mtime, md5
+        if self.verified.get(str(fpath)) == checked:
+            return False
+        if fpath.md5hex != md5:
+            return True
+        self.verified[str(fpath)] = checked
+        return False
+
+    def stored(self):
+        """
+        filename -> [(md5, pkgdata)] from the root data
+        """
+        stored = {}
+        for md5, pkgdata in self.index.root_data().items():
+            if pkgdata:
+                stored.setdefault(pkgdata['filename'], []).append((md5, pkgdata))
+        return stored
+
+    @staticmethod
+    def stale(fpath, entries):
+        current = fpath.md5hex
+        return [(md5, pkgdata) for md5, pkgdata in entries if md5 != current]
+
+    def diff(self):
+        with self.timed('diff'):
+            stored = self.stored()
+            diff = IndexDiff()
+            for fpath in self.index.files:
+                entries = stored.pop(str(fpath.name), None)
+                if not entries:
+                    diff.added.append(fpath)
+                    continue
+                if len(entries) == 1 and not self.changed(fpath, *entries[0]):
+                    continue
+                stale = self.stale(fpath, entries)
+                if stale:
+                    diff.modified.append((fpath, stale))
+
+            for entries in stored.values():
+                diff.removed.extend(entries)
+        return diff
+
+    def diff_written(self, fpaths):
+        """
+        The diff for archives known to have just been written (so
+        always compared by digest)
+        """
+        with self.timed('diff'):
+            stored = self.stored()
+            diff = IndexDiff()
+            for fpath in fpaths:
+                entries = stored.get(str(fpath.name))
+                if not entries:
+                    diff.added.append(fpath)
+                    continue
+                stale = self.stale(fpath, entries)
+                if stale:
+                    diff.modified.append((fpath, stale))
+        return diff
+
+    def repair(self, diff):
+        """
+        Drop stale entries, index new and changed archives and rebuild
+        the leaves of every project touched.
+
+        :returns: a report of what changed and the time for each step
+        """
+        index = self.index
+        pmap = index.project_map
+        projects_before = pmap.names()
+
+        stale = list(diff.removed)
+        [stale.extend(entries) for fpath, entries in diff.modified]
+        leaves = set(pkgdata['name'] for md5, pkgdata in stale)
+
+        with self.timed('forget'):
+            if stale:
+                index.forget_data(*set(md5 for md5, pkgdata in stale))
+            for md5, pkgdata in diff.removed:
+                pmap.remove(pkgdata['name'], pkgdata['filename'])
+                self.verified.pop(str(index.path / pkgdata['filename']), None)
+                (index.path / (pkgdata['filename'] + index.metadata_ext)).remove_p()
+
+        with self.timed('register'):
+            archs = diff.added + [fpath for fpath, entries in diff.modified]
+            new = archs and index.update_data(pkgdatas=OrderedDict.fromkeys(archs)) or []
+            for pkgdata in new:
+                pmap.add(pkgdata['name'], pkgdata['filename'])
+                leaves.add(pkgdata['name'])
+
+            # a replacement may already be registered (ie. by an upload)
+            # and may even belong to another project
+            current = index.root_data()
+            for fpath, entries in diff.modified:
+                pkgdata = current.get(fpath.md5hex)
+                if pkgdata:
+                    pmap.remove(None, fpath.name)
+                    pmap.add(pkgdata['name'], fpath.name)
+                    leaves.add(pkgdata['name'])
+
+        with self.timed('leaves'):
+            before = index.leaf_stats.copy()
+            for leaf in sorted(leaves):
+                if not pmap.archives(leaf) and not (index.path / leaf).exists():
+                    continue
+                try:
+                    index.regenerate_leaf(leaf, refresh=False)
+                except Exception:
+                    logger.exception('Issue building leaf for %s', leaf)
+            stats = index.leaf_stats - before
+
+        with self.timed('home'):
+            if index.write_html is True and pmap.names() != projects_before:
+                index.write_index_home()
+
+        return dict(added=sorted(str(x.name) for x in diff.added),
+                    removed=sorted(pkgdata['filename'] for md5, pkgdata in diff.removed),
+                    modified=sorted(str(fpath.name) for fpath, entries in diff.modified),
+                    leaves=sorted(leaves),
+                    rebuilt=stats['rebuilt'],
+                    timings=list(self.timings.items()))
+
+    def reconcile(self, diff=None):
+        """
+        Diff (unless given one) and repair
+
+        :returns: the repair report, or None if nothing had changed
+        """
+        if diff is None:
+            diff = self.diff()
+        if not diff:
+            return None
+        report = self.repair(diff)
+        logger.info("Reconciled %s: %s added, %s removed, %s modified; "
+                    "%s leaves rebuilt (%s)", self.index.path,
+                    len(report['added']), len(report['removed']), len(report['modified']),
+                    report['rebuilt'],
+                    ", ".join("%s %0.3fs" % x for x in report['timings']))
+        return report
@@ -20,13 +20,12 @@ def request_funcs():
         return request.index.path
 
     def index(request):
-        return IndexManager.from_registry(request.registry)
+        return IndexManager.for_registry(request.registry)
 
     def index_data_path(request):
         return request.index.datafile_path
 
     def index_data(request):
-        return request.index.data_from_path(request.index.path \
-                                            / request.index_data_path)
+        return request.index.root_data()
 
     return locals()
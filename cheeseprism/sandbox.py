@@ -0,0 +1,147 @@
+"""
+Archive inspection in resource limited subprocesses
+(`cheeseprism.sandbox`)
+"""
+from .archiveutil import ArchiveLimitExceeded
+from .archiveutil import ArchiveUtil
+from pyramid.settings import asbool
+import logging
+import multiprocessing
+import resource
+import threading
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+
+def inspect(conn, filename, cpu_seconds, memory, max_bytes):
+    """
+    Runs in the child: parse `filename` and its dependency info under
+    rlimits and send back ('ok', pkginfo) or ('error', exception
+    class, message, traceback)
+    """
+    try:
+        if cpu_seconds:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+        if memory:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        at = ArchiveUtil()
+        at.max_bytes = max_bytes
+        info = at.pkginfo_from_file(filename)
+        if getattr(info, 'depinfo', None) is None:
+            info.depinfo = at.depinfo_for_file(filename, info)
+        conn.send(('ok', info))
+    except BaseException as e:
+        conn.send(('error', e.__class__.__name__, str(e), traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def start_context():
+    """
+    Children are started from a forkserver (or spawned): forking the
+    multithreaded app directly could leave a child holding a copy of
+    some other thread's lock (logging, sqlite) and stall until killed.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class SandboxedArchiveUtil(ArchiveUtil):
+    """
+    An `ArchiveUtil` whose `pkginfo_from_file` runs in a child process
+    limited to `cpu_seconds` of cpu, `wall_seconds` of wall clock,
+    `memory` bytes of address space and archives expanding to at most
+    `max_bytes`. Archives over a limit are handed to `handle_error`
+    (ie. moved to the error folder) and counted in `killed`.
+    """
+    context = start_context()
+    # run in the child; must be importable
+    inspect = staticmethod(inspect)
+
+    def __init__(self, cpu_seconds=10, wall_seconds=30, memory=1024 * 1024 ** 2,
+                 max_bytes=512 * 1024 ** 2):
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory = memory
+        self.max_bytes = max_bytes
+        self.killed = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :returns: a sandboxed util if `cheeseprism.sandbox` is set, else None
+        """
+        if not asbool(settings.get('cheeseprism.sandbox', False)):
+            return None
+        mb = 1024 ** 2
+        return cls(cpu_seconds=int(settings.get('cheeseprism.sandbox.cpu_seconds', 10)),
+                   wall_seconds=float(settings.get('cheeseprism.sandbox.wall_seconds', 30)),
+                   memory=int(settings.get('cheeseprism.sandbox.memory_mb', 1024)) * mb,
+                   max_bytes=int(settings.get('cheeseprism.sandbox.max_mb', 512)) * mb)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def run(self, filename):
+        """
+        :returns: pkginfo for `filename`
+        :raises: `ArchiveLimitExceeded` or RuntimeError
+        """
+        parent, child = self.context.Pipe(duplex=False)
+        proc = self.context.Process(target=self.inspect,
+                                    args=(child, str(filename), self.cpu_seconds,
+                                          self.memory, self.max_bytes))
+        proc.start()
+        child.close()
+        try:
+            if not parent.poll(self.wall_seconds):
+                proc.kill()
+                raise ArchiveLimitExceeded("%s: inspection took over %ss"
+                                           % (filename, self.wall_seconds))
+            try:
+                result = parent.recv()
+            except EOFError:
+                result = None
+        finally:
+            parent.close()
+            proc.join()
+
+        if result is None:
+            # killed by the kernel: cpu (SIGXCPU/SIGKILL) or memory
+            raise ArchiveLimitExceeded("%s: inspection died (exit code %s)"
+                                       % (filename, proc.exitcode))
+        if result[0] == 'ok':
+            return result[1]
+
+        _, name, msg, tb = result
+        logger.debug("Inspecting %s failed:\n%s", filename, tb)
+        if name in ('ArchiveLimitExceeded', 'MemoryError'):
+            raise ArchiveLimitExceeded("%s: %s %s" % (filename, name, msg))
+        raise RuntimeError("%s: %s %s" % (filename, name, msg))
+
+    def pkginfo_from_file(self, path, handle_error=None):
+        try:
+            return self.run(path)
+        except ArchiveLimitExceeded as e:
+            with self.lock:
+                self.killed += 1
+            logger.error("Quarantining %s: %s", path, e)
+            if handle_error is not None:
+                return handle_error(e, path)
+            raise
+        except Exception as e:
+            if handle_error is not None:
+                return handle_error(e, path)
+            raise
@@ -0,0 +1,84 @@
+"""
+Debounced leaf rebuilds (`cheeseprism.leaf_debounce`)
+"""
+import atexit
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class LeafScheduler(object):
+    """
+    Collects updates per leaf and hands them to `flush(name, items)`
+    once `window` seconds have passed since the first of them arrived,
+    so a burst of uploads to one project becomes a single leaf write.
+
+    Whatever is pending is flushed at interpreter exit (or `close`).
+    """
+    def __init__(self, flush, window):
+        self.flush = flush
+        self.window = window
+        self.lock = threading.Lock()
+        # signalled as flushes finish
+        self.idle = threading.Condition(self.lock)
+        self.active = 0
+        self.pending = {}
+        self.timers = {}
+        self.coalesced = 0
+        self.flushes = 0
+        atexit.register(self.flush_all)
+
+    def schedule(self, name, item):
+        with self.lock:
+            if name in self.pending:
+                self.pending[name].append(item)
+                self.coalesced += 1
+                return False
+            self.pending[name] = [item]
+            timer = self.timers[name] = threading.Timer(self.window, self.run, (name,))
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def run(self, name):
+        with self.lock:
+            items = self.pending.pop(name, None)
+            self.timers.pop(name, None)
+            if not items:
+                return
+            self.active += 1
+            self.flushes += 1
+        try:
+            return self.flush(name, items)
+        except Exception:
+            logger.exception("Rebuild of %s (%s updates) failed", name, len(items))
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def flush_all(self):
+        """
+        Flush everything pending and wait for flushes already running
+        on timer threads
+        """
+        with self.lock:
+            names = list(self.pending)
+            for name in names:
+                self.timers.pop(name).cancel()
+        flushed = [self.run(name) for name in names]
+        with self.lock:
+            self.idle.wait_for(lambda: not self.active)
+        return flushed
+
+    def close(self):
+        """
+        Flush all and drop the exit hook
+        """
+        atexit.unregister(self.flush_all)
+        return self.flush_all()
+
+    def __len__(self):
+        return len(self.pending)
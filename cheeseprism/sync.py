@@ -1,8 +1,17 @@
 from . import utils
 from .index import IndexManager
 from .index import bulk_add_pkgs
+from .reconcile import Reconciler
 from .utils import path
+from .watch import FileRootWatcher
+from .watch import Inotify
+from collections import OrderedDict
 from threading import Thread
+from urllib.parse import unquote
+import atexit
+import hashlib
+import itertools
+import json
 import logging
 import os
 import time
@@ -10,29 +19,119 @@ import time
 logger = logging.getLogger(__name__)
 
 
-def sync_folder(index, folder):
+class SourceManifest(object):
+    """
+    (size, mtime, md5) for each archive under a source folder, kept
+    beside the index between syncs so a sync only hashes files that
+    are new or changed since the last one.
+
+    Folders are walked recursively, which covers both the flat
+    `PIP_DOWNLOAD_CACHE` layout and pip's nested wheel cache.
+    """
+    def __init__(self, folder, store, exts):
+        self.folder = path(folder)
+        self.store = path(store)
+        self.exts = exts
+        self.entries = self.load()
+        self.hashed = 0
+
+    @classmethod
+    def for_folder(cls, folder, index):
+        key = hashlib.sha1(str(path(folder).abspath()).encode('utf-8')).hexdigest()[:12]
+        return cls(folder, index.path / ('.sync-%s.json' % key), index.archive_tool.EXTS)
+
+    def load(self):
+        if not self.store.exists():
+            return {}
+        try:
+            with open(self.store) as stream:
+                return json.load(stream)
+        except ValueError:
+            logger.error("Ignoring unreadable sync manifest %s", self.store)
+            return {}
+
+    def save(self):
+        return utils.write_atomic(self.store, json.dumps(self.entries).encode('utf-8'))
+
+    @staticmethod
+    def target_name(fpath):
+        """
+        The archive's filename in the index: the last url segment of a
+        legacy pip download cache name, otherwise the name itself
+        """
+        return unquote(str(path(fpath).name).rsplit('%2F', 1)[-1])
+
+    def scan(self):
+        """
+        :returns: [(path, md5)] for every archive under the folder
+        """
+        if not self.folder.exists():
+            logger.error("Sync folder %s does not exist", self.folder)
+            return []
+
+        found, entries = [], {}
+        for fpath in self.folder.walkfiles():
+            if not self.exts.match(self.target_name(fpath)):
+                continue
+            st = fpath.stat()
+            key = str(self.folder.relpathto(fpath))
+            entry = self.entries.get(key)
+            if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+                entry = [st.st_size, st.st_mtime_ns, fpath.md5hex]
+                self.hashed += 1
+            entries[key] = entry
+            found.append((fpath, entry[2]))
+
+        if entries != self.entries:
+            self.entries = entries
+            self.save()
+        return found
+
+
+def sync_folder(index, folders):
+    """
+    Copy archives from `folders` (one folder or several, scanned in
+    parallel) whose digests aren't yet in the index
+
+    :returns: paths of the archives copied into the index
+    """
+    if isinstance(folders, str):
+        folders = [folders]
+
     with utils.benchmark("Sync packages"):
-        EXTS = index.archive_tool.EXTS
-        candidates = dict((x.md5hex, x)\
-                          for x in folder.files()\
-                          if EXTS.match(x))
+        manifests = [SourceManifest.for_folder(folder, index) for folder in folders]
+        scans = list(index.io_executor.map(SourceManifest.scan, manifests))
 
-        current = dict((x.md5hex, x)\
-                       for x in index.files)
+        known = set(index.root_data())
+        present = set(str(x.name) for x in index.files)
+        copied = []
+        for cpath, md5 in itertools.chain(*scans):
+            name = SourceManifest.target_name(cpath)
+            if md5 in known or name in present:
+                continue
+            try:
+                with open(cpath, 'rb') as stream:
+                    copied.append(utils.write_stream(index.path / name, stream,
+                                                     expected=dict(md5=md5)))
+            except (IOError, utils.DigestMismatch):
+                logger.exception("Copying %s failed", cpath)
+                continue
+            known.add(md5)
+            present.add(name)
 
-        new = set(candidates) - set(current)
-        for md5 in new:
-            cpath = candidates.get(md5, None)
-            if cpath is None:
-                logger.error("missing md5: %s", md5)
-                break
-            _, name = cpath.rsplit('%2F', 1)
-            cpath.copy(index.path / name)
+        logger.info("Copied %s archives from %s (%s hashed)", len(copied),
+                    ", ".join(str(x) for x in folders), sum(x.hashed for x in manifests))
+    return copied
 
 
-def update_index(index, reg):
+def update_index(index, reg, archs=None):
+    """
+    Index `archs` (by default every archive in the file root) and
+    rebuild their leaves in bulk
+    """
     with utils.benchmark('Update index after sync'):
-        new_pkgs = index.update_data()
+        pkgdatas = None if archs is None else OrderedDict.fromkeys(archs)
+        new_pkgs = index.update_data(pkgdatas=pkgdatas)
         if index.path.exists(): #for testing
             pkgnames = [x['filename'] for x in new_pkgs]
             with utils.benchmark("New packages notifier: %s" %pkgnames):
@@ -40,7 +139,7 @@ def update_index(index, reg):
 
             if index.write_html is True \
               and not all((index.datafile_path.exists(), index.home_file.exists())):
-                index.write_index_home(index.projects_from_archives())
+                index.write_index_home()
 
             return leaves, archs
 
@@ -59,47 +158,56 @@ def wait_for_file(fp, sleep=0.2, max_tries=5):
     raise RuntimeError('%s not found in %ss' %(fp, max_tries * sleep))
 
 
-def sync_cache(index, registry):
-    pdc = path(os.environ.get('PIP_DOWNLOAD_CACHE'))
-    if not pdc.exists():
-        logger.error("Environmental var $PIP_DOWNLOAD_CACHE not set or %s not yet created" %pdc)
-        return pdc
+def source_folders(settings, environ=os.environ):
+    """
+    Folders to mirror: `cheeseprism.pipcache_mirror.folders` (whitespace
+    separated), else $PIP_DOWNLOAD_CACHE
+    """
+    folders = settings.get('cheeseprism.pipcache_mirror.folders', '').split()
+    if not folders and environ.get('PIP_DOWNLOAD_CACHE'):
+        folders = [environ['PIP_DOWNLOAD_CACHE']]
+    return [path(os.path.expanduser(x)) for x in folders]
+
+
+def sync_cache(index, registry, folders=None):
+    if folders is None:
+        folders = source_folders(registry.settings)
+    if not folders:
+        logger.error("No folders to mirror: set cheeseprism.pipcache_mirror.folders or $PIP_DOWNLOAD_CACHE")
+        return folders
 
     wait_for_file(index.path)
     wait_for_file(index.datafile_path)
-    sync_folder(index, pdc)
+    copied = sync_folder(index, folders)
     try:
-        update_index(index, registry)
+        update_index(index, registry, copied)
     except :
         logger.exception("sync_cache:update_index failed")
-
+    return copied
 
 
 def pip(config):
-    index = IndexManager.from_registry(config.registry)
-    thread = Thread(target=sync_cache, args=(index, config.registry), name='pip-updater')
+    index = IndexManager.for_registry(config.registry)
+    folders = source_folders(config.registry.settings)
+    thread = Thread(target=sync_cache, args=(index, config.registry, folders), name='pip-updater')
     thread.start()
 
 
-def dowatch(index, reg, pdc):
-    dfexists = index.datafile_path.exists()
-
-    assert dfexists
-    data = index.data_from_path(index.datafile_path)
-
-    index_reg = set()
-    for md5, info in data:
-        arch = path(info['filename'])
-        assert arch.exists(), "index.json: %s missing" %arch
-        index_reg.add((arch, arch.stat()))
+class Inconsistent(AssertionError):
+    """
+    index.json and the file root disagree; `diff` says how
+    """
+    def __init__(self, diff):
+        super(Inconsistent, self).__init__("index.json and filesystem do not match: %s" % diff)
+        self.diff = diff
 
-    fsreg = set()
-    for arch in index.files:
-        # this assertion should rarely fail unless someone is sleeping out
-        assert arch.exists(), "fs: %s missing" %arch
-        fsreg.add((arch, arch.stat()))
 
-    assert fsreg == index_reg, "index.json and filesystem do not match: %s" % index_reg ^ fsreg
+def dowatch(index, reg, pdc):
+    if index.catalog is None:
+        assert index.datafile_path.exists()
+    diff = Reconciler(index).diff()
+    if diff:
+        raise Inconsistent(diff)
 
 
 def index_watch(index, reg, interval=3, failint=3, pdc=None, dowatch=dowatch):
@@ -107,14 +215,14 @@ def index_watch(index, reg, interval=3, failint=3, pdc=None, dowatch=dowatch):
     while True:
         try:
             dowatch(index, reg, pdc)
-        except AssertionError:
-            logger.exception("Index fails consistency tests")
-            index.regenerate_all()
+        except AssertionError as e:
+            logger.warning("Index fails consistency tests: %s", e)
+            Reconciler(index).reconcile(getattr(e, 'diff', None))
         except KeyboardInterrupt:
             raise
         except Exception:
             logger.exception("Who watches the watchman's exceptions?")
-            time.sleep(3)
+            time.sleep(failint)
         finally:
             time.sleep(interval)
 
@@ -123,8 +231,30 @@ resolve = dnr(None).maybe_resolve
 
 
 def auto(config):
-    dowatch = resolve(config.registry.settings.get('cheeseprism.dowatch', 'cheeseprism.sync.dowatch'))
-    index = IndexManager.from_registry(config.registry)
-    thread = Thread(target=index_watch, args=(index, config.registry, path(os.environ['PIP_DOWNLOAD_CACHE'])), kwargs=dict(dowatch=dowatch))
+    """
+    Keep the index in step with the file root: watch it with inotify
+    where available (`cheeseprism.watcher = inotify`, the default),
+    otherwise or with `cheeseprism.watcher = poll` run the polling
+    `index_watch` loop.
+    """
+    settings = config.registry.settings
+    index = IndexManager.for_registry(config.registry)
+    watcher = settings.get('cheeseprism.watcher', 'inotify')
+    if watcher == 'inotify':
+        if Inotify.available():
+            rootwatcher = FileRootWatcher(config.registry)
+            thread = Thread(target=rootwatcher.run, name='index-watcher')
+            thread.daemon = True
+            thread.start()
+            atexit.register(rootwatcher.stop)
+            return rootwatcher
+        logger.warning("inotify is not available, polling %s", index.path)
+
+    dowatch = resolve(settings.get('cheeseprism.dowatch', 'cheeseprism.sync.dowatch'))
+    pdc = os.environ.get('PIP_DOWNLOAD_CACHE')
+    thread = Thread(target=index_watch, args=(index, config.registry),
+                    kwargs=dict(pdc=pdc and path(pdc), dowatch=dowatch),
+                    name='index-watcher')
+    thread.daemon = True
     thread.start()
     #@@ configure additional folders?
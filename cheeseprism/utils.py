@@ -1,22 +1,165 @@
 from pyramid.decorator import reify
 from path import path as path_base
 import functools
+import gzip
 import hashlib
 import logging
 import os
 import pkg_resources
+import random
 import re
+import sqlite3
+import tempfile
+import threading
 import time
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 logger = logging.getLogger(__name__)
 
 
+class DigestCache(object):
+    """
+    Persistent digests for files keyed by (device, inode, size,
+    mtime_ns), so unchanged files need not be rehashed across restarts.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS digests (
+        dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+        md5 TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        PRIMARY KEY (dev, ino, size, mtime_ns)
+    );
+    """
+
+    def __init__(self, dbpath):
+        self.path = dbpath
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(self.schema)
+            self.conn.commit()
+
+    @staticmethod
+    def key(filepath):
+        st = os.stat(filepath)
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    def get(self, key):
+        """
+        :returns: digests dict (as `path.digests`) or None
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT md5, sha256 FROM digests WHERE dev = ? '
+                                    'AND ino = ? AND size = ? AND mtime_ns = ?',
+                                    key).fetchone()
+        if row is not None:
+            return dict(md5=row[0], sha256=row[1], size=key[2])
+
+    def set(self, key, digests):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                              key + (digests['md5'], digests['sha256']))
+            self.conn.commit()
+
+    def discard(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM digests WHERE dev = ? AND ino = ? '
+                              'AND size = ? AND mtime_ns = ?', key)
+            self.conn.commit()
+
+    def verify(self, paths, sample=0.01, rand=random):
+        """
+        Rehash a random `sample` (a fraction) of `paths` that have a
+        cached digest, dropping and returning any that don't match.
+        """
+        cached = []
+        for filepath in paths:
+            key = self.key(filepath)
+            digests = self.get(key)
+            if digests is not None:
+                cached.append((path(filepath), key, digests))
+
+        if not cached:
+            return []
+
+        size = min(max(1, int(len(cached) * sample)), len(cached))
+        bad = []
+        for filepath, key, digests in rand.sample(cached, size):
+            actual = filepath.compute_digests()
+            if actual != digests:
+                logger.error("Digest mismatch for %s: cached %s, actual %s",
+                             filepath, digests, actual)
+                self.discard(key)
+                bad.append(filepath)
+
+        logger.info("Verified %s of %s cached digests: %s mismatched",
+                    size, len(cached), len(bad))
+        return bad
+
+
 class path(path_base):
+    digest_cache = None
+    chunk_size = 1024 * 1024
+    digest_names = ('md5', 'sha256')
 
     @reify
     def md5hex(self):
-        return self.read_md5_fast().encode('hex')
+        return self.digests['md5']
+
+    @reify
+    def sha256hex(self):
+        return self.digests['sha256']
+
+    @reify
+    def digests(self):
+        """
+        md5, sha256 (as hex) and size of the file, read in a single
+        pass and consulting the digest cache if one is configured.
+        """
+        if self.digest_cache is None:
+            return self.compute_digests()
+
+        key = self.digest_cache.key(self)
+        digests = self.digest_cache.get(key)
+        if digests is None:
+            digests = self.compute_digests()
+            self.digest_cache.set(key, digests)
+        return digests
+
+    def compute_digests(self):
+        """
+        Read through the file once in `chunk_size` blocks, updating
+        all of `digest_names`; memory use is bounded by chunk size.
+        """
+        hashes = [hashlib.new(name) for name in self.digest_names]
+        size = 0
+        with open(self, 'rb') as stream:
+            for chunk in iter(functools.partial(stream.read, self.chunk_size), b''):
+                size += len(chunk)
+                for m in hashes:
+                    m.update(chunk)
+        digests = dict((name, m.hexdigest()) for name, m in zip(self.digest_names, hashes))
+        digests['size'] = size
+        return digests
+
+    def set_digests(self, digests):
+        """
+        Prime the digests of a file whose bytes were hashed as they
+        were written (see `write_stream`), recording them in the digest
+        cache if one is configured.
+        """
+        self.__dict__['digests'] = digests
+        for name in self.digest_names:
+            self.__dict__.pop('%shex' % name, None)
+        if self.digest_cache is not None:
+            self.digest_cache.set(self.digest_cache.key(self), digests)
+        return self
 
     def read_md5_fast(self):
         """ Calculate the md5 hash for this file.
@@ -32,7 +175,9 @@ class path(path_base):
             that's available in the `hashlib` module.
         """
         m = hashlib.new(hash_name)
-        m.update(self.bytes())
+        with open(self, 'rb') as stream:
+            for chunk in iter(functools.partial(stream.read, self.chunk_size), b''):
+                m.update(chunk)
         return m
 
     def read_hash_fast(self, hash_name):
@@ -45,6 +190,95 @@ class path(path_base):
 
 
 
+def write_atomic(target, data):
+    """
+    Write `data` (bytes) to a temporary file beside `target` and
+    rename it into place.
+    """
+    target = path(target)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix='.%s.' % target.name)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, target)
+    except:
+        os.unlink(tmp)
+        raise
+    return target
+
+
+class DigestMismatch(ValueError):
+    """
+    Streamed bytes don't match the digest they were expected to have
+    """
+
+
+def write_stream(target, stream, chunk_size=path.chunk_size, expected=None):
+    """
+    Copy file-like `stream` to `target` in `chunk_size` blocks via a
+    temporary file beside it, hashing as the bytes go by.
+
+    `expected` maps hash names to hex digests the bytes must match;
+    on a mismatch nothing is written and `DigestMismatch` is raised.
+
+    :returns: `target` as a path with its digests primed
+    """
+    target = path(target)
+    expected = expected or {}
+    names = path.digest_names + tuple(x for x in sorted(expected) if x not in path.digest_names)
+    hashes = [hashlib.new(name) for name in names]
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix='.%s.' % target.name)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(functools.partial(stream.read, chunk_size), b''):
+                size += len(chunk)
+                for m in hashes:
+                    m.update(chunk)
+                out.write(chunk)
+
+        digests = dict((name, m.hexdigest()) for name, m in zip(names, hashes))
+        for name, hexdigest in expected.items():
+            if digests[name] != hexdigest.lower():
+                raise DigestMismatch("%s: %s %s, expected %s" % (target.name, name,
+                                                                 digests[name], hexdigest))
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, target)
+    except:
+        os.unlink(tmp)
+        raise
+
+    digests['size'] = size
+    return target.set_digests(dict((name, digests[name]) for name in path.digest_names + ('size',)))
+
+
+compressed_exts = ('.gz', '.br')
+
+
+def write_precompressed(target, text, compress=True):
+    """
+    Atomically write `text` to `target` along with `.gz` (and `.br`
+    if brotli is installed) siblings for nginx's `gzip_static` /
+    `brotli_static`. Stale siblings are removed when not compressing.
+    """
+    data = isinstance(text, bytes) and text or text.encode('utf-8')
+    target = path(target)
+    siblings = dict.fromkeys(compressed_exts)
+    if compress:
+        siblings['.gz'] = gzip.compress(data, 9, mtime=0)
+        if brotli is not None:
+            siblings['.br'] = brotli.compress(data)
+
+    for ext, compressed in siblings.items():
+        if compressed is None:
+            path(target + ext).remove_p()
+        else:
+            write_atomic(target + ext, compressed)
+
+    return write_atomic(target, data)
+
+
 def resource_spec(spec):
     """
     Loads resource from a string specifier.
@@ -120,6 +354,57 @@ def secure_filename(filename):
     return filename
 
 
+_normalize_re = re.compile(r'[-_.]+')
+
+
+def normalize_name(name):
+    """
+    PEP 503 normalized project name
+
+    >>> normalize_name('Foo_Bar.baz')
+    'foo-bar-baz'
+    """
+    return _normalize_re.sub('-', name).lower()
+
+
+_lowest, _highest = [-1], [1]
+
+
+@functools.lru_cache(maxsize=4096)
+def version_key(version):
+    """
+    A json serializable sort key ordering versions as
+    `pkg_resources.parse_version` does, infinities being tagged lists.
+    Keys are cached and shared: don't mutate them.
+
+    >>> sorted(['1.0', '1.0.dev1', '1.0rc1', '1.0.post1'], key=version_key)
+    ['1.0.dev1', '1.0rc1', '1.0', '1.0.post1']
+    """
+    version = str(version or '')
+    try:
+        parsed = pkg_resources.parse_version(version)
+    except ValueError:
+        parsed = None
+    if getattr(parsed, 'release', None) is None:
+        # not PEP 440: sorts before any valid version, as LegacyVersion did
+        return [-1, version]
+
+    release = list(parsed.release)
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+
+    pre = parsed.pre and [0] + list(parsed.pre) or _highest
+    if parsed.pre is None and parsed.post is None and parsed.dev is not None:
+        pre = _lowest
+    post = parsed.post is not None and [0, parsed.post] or _lowest
+    dev = parsed.dev is not None and [0, parsed.dev] or _highest
+    local = _lowest
+    if parsed.local:
+        local = [0, [part.isdigit() and [1, int(part)] or [0, part] \
+                     for part in parsed.local.split('.')]]
+    return [0, parsed.epoch, release, pre, post, dev, local]
+
+
 def strip_master(filename):
     """
     Create a secure filename and remove the string '-master'
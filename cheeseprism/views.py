@@ -2,18 +2,23 @@ from . import event
 from . import pipext
 from . import resources
 from . import utils
+from .download import fetch
+from .jobs import Job
+from .jobs import JobQueue
 from .rpc import PyPi
+from .utils import DigestMismatch
 from .utils import path
+from contextlib import contextmanager
 from functools import partial
 from pyramid.httpexceptions import HTTPFound
 from pyramid.i18n import TranslationStringFactory
 from pyramid.path import DottedNameResolver as dnr
 from pyramid.view import view_config
 from pyramid_jinja2 import renderer_factory
-from urllib.error import HTTPError
-from urllib.error import URLError
 from webob import exc
+import json
 import logging
+import os
 import pkg_resources
 import requests
 import tempfile
@@ -36,9 +41,8 @@ def instructions(context, request):
 def index_view(context, request):
     index = request.index
     data = index.index_data.copy()
-    items = index.projects_from_archives()
     data['packages'] = [dict(name=key, url=str(path(index.urlbase) / key )) \
-                        for key, value in items]
+                        for key in index.project_map.names()]
     return data
 
 
@@ -56,6 +60,9 @@ def simple(context, request):
 def upload(context, request):
     """
     The interface for disutils upload
+
+    With `cheeseprism.async_upload` the archive is stored and indexing
+    is queued; the response is a 202 pointing at the job's status.
     """
     if request.method == 'POST':
         if not hasattr(request.POST['content'], 'file'):
@@ -65,25 +72,105 @@ def upload(context, request):
         filename = fieldstorage.filename
         logger.info("%s posted", filename)
 
+        jobs = request.registry.get(JobQueue.registry_key)
+        if jobs is not None:
+            return queue_upload(context, request, jobs, fieldstorage)
+
         with bm("%s released" %filename):
             dest = path(request.file_root) / request.namer(filename)
-            dest.write_bytes(fieldstorage.file.read())
-            try:
-                request.registry.notify(event.PackageAdded(request.index, path=dest))
-                request.response.headers['X-Swalow-Status'] = 'SUCCESS'
-                try:
-                    for ep in pkg_resources.iter_entry_points('cheeseprism.on_upload'):
-                        func = ep.load()
-                        func(context, request, dest)
-                except Exception as e:
-                    logger.exception('Entry point %r failed', ep)
-                return request.response
-            except :
-                logger.exception("Processing of %s failed", filename)
-                raise
+            dest = utils.write_stream(dest, fieldstorage.file)
+            index_upload(request.registry, request.index, dest,
+                         context=context, request=request)
+            request.response.headers['X-Swalow-Status'] = 'SUCCESS'
+            return request.response
     return {}
 
 
+@contextmanager
+def unstaged(name):
+    yield
+
+
+def index_upload(registry, index, dest, stage=unstaged, context=None, request=None):
+    """
+    Announce a stored upload to the index and the
+    `cheeseprism.on_upload` entry points, timing each `stage`.
+
+    Queued uploads outlive their request, so the entry points get no
+    `context` or `request` for them.
+    """
+    try:
+        with stage('parse'):
+            added = event.PackageAdded(index, path=dest)
+        with stage('index'):
+            registry.notify(added)
+    except :
+        logger.exception("Processing of %s failed", dest.name)
+        raise
+
+    with stage('on_upload'):
+        try:
+            for ep in pkg_resources.iter_entry_points('cheeseprism.on_upload'):
+                func = ep.load()
+                func(context, request, dest)
+        except Exception as e:
+            logger.exception('Entry point %r failed', ep)
+    return dest
+
+
+def release_upload(staged, dest):
+    """
+    Move a queued upload from beside the file root into place
+    """
+    os.rename(staged, dest)
+    return dest.set_digests(staged.digests)
+
+
+def queue_upload(context, request, jobs, fieldstorage):
+    filename = fieldstorage.filename
+    job = Job(filename)
+    dest = path(request.file_root) / request.namer(filename)
+    # held under a hidden name until queued, so a rejected upload
+    # never replaces an archive already indexed under its name
+    with job.stage('store'):
+        staged = utils.write_stream(dest.parent / ('.%s.%s' % (dest.name, job.id)),
+                                    fieldstorage.file)
+
+    registry, index = request.registry, request.index
+
+    def index_job(job):
+        index_upload(registry, index, release_upload(staged, dest), job.stage)
+
+    try:
+        jobs.submit(job, index_job)
+    except jobs.Full:
+        logger.error("Upload queue full, rejecting %s", filename)
+        staged.remove_p()
+        return exc.HTTPServiceUnavailable('Upload queue is full, try again later')
+
+    response = request.response
+    response.status_int = 202
+    response.headers['X-Swalow-Status'] = 'QUEUED'
+    response.headers['Location'] = request.resource_url(context, 'jobs', job.id)
+    response.content_type = 'application/json'
+    response.text = json.dumps(job.as_dict())
+    return response
+
+
+@view_config(name='jobs', renderer='json', context=resources.App)
+def job_status(context, request):
+    """
+    State and stage timings of a queued upload: /jobs/<id>
+    """
+    jobs = request.registry.get(JobQueue.registry_key)
+    if jobs is None or len(request.subpath) != 1:
+        raise exc.HTTPNotFound()
+
+    job = jobs.get(request.subpath[0])
+    if job is None:
+        raise exc.HTTPNotFound()
+    return job.as_dict()
+
 
 @view_config(name='find-packages', renderer='find_packages.html', context=resources.App)
 def find_package(context, request):
@@ -117,18 +204,20 @@ def from_pypi(request, fpkgs='/find-packages'):
     details = candidates[0]
     url = details['url']
     filename = details['filename']
+    expected = details.get('digests') or dict(md5=details['md5_digest'])
     newfile = None
     try:
-        resp = requests.get(url)
-        newfile = request.file_root / filename
-        newfile.write_bytes(resp.content)
-    except HTTPError as e:
-        error = "HTTP Error: %d %s - %s" %(e.code, exc.status_map[e.code].title, url)
+        newfile = fetch(url, request.file_root / filename, expected=expected)
+    except requests.HTTPError as e:
+        error = "HTTP Error: %s - %s" %(e, url)
         logger.error(error)
         flash(error)
-    except URLError as e:
-        logger.error("URL Error: %s, %s", e.reason , url)
-        flash('Url error attempting to grab %s: %s' %(url, e.reason))
+    except requests.RequestException as e:
+        logger.error("URL Error: %s, %s", e, url)
+        flash('Url error attempting to grab %s: %s' %(url, e))
+    except DigestMismatch as e:
+        logger.error("Download corrupt: %s", e)
+        flash('Download of %s did not match its digest: %s' %(url, e))
 
     if newfile is not None:
         try:
@@ -167,11 +256,14 @@ def from_requirements(context, request):
         pkgdatas = {}
         rd_class = pipext.RequirementDownloader
         requirement_set, finder = rd_class.req_set_from_file(filename, request.file_root)
-        downloader = rd_class(requirement_set, finder, seen=set(request.index_data))
+        index_data = request.index_data
+        downloader = rd_class(requirement_set, finder, seen=set(index_data),
+                              depcache=index_data)
 
         for pkginfo, outfile in downloader.download_all():
             pkgdatas[outfile] = \
-                request.index.pkginfo_to_pkgdata(outfile, pkginfo)
+                request.index.pkginfo_to_pkgdata(outfile, pkginfo,
+                                                 depinfo=downloader.dependencies(outfile.md5hex))
             names.append(pkginfo.name)
 
         request.registry.notify(event.IndexUpdate(
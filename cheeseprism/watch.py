@@ -0,0 +1,242 @@
+"""
+Event driven watching of the file root (`cheeseprism.auto_sync`)
+"""
+from . import event
+from .index import IndexManager
+from .reconcile import Reconciler
+from collections import OrderedDict
+from pyramid import threadlocal
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+ADDED = IN_CLOSE_WRITE | IN_MOVED_TO
+REMOVED = IN_DELETE | IN_MOVED_FROM
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    return hasattr(libc, 'inotify_init1') and libc or None
+
+libc = load_libc()
+
+
+class Inotify(object):
+    """
+    A non recursive inotify watch on one directory
+    """
+    header = struct.Struct('iIII')
+    bufsize = 64 * 1024
+
+    def __init__(self, dirpath, mask=ADDED | REMOVED):
+        if libc is None:
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(str(dirpath)), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), str(dirpath))
+
+    @staticmethod
+    def available():
+        return libc is not None
+
+    def read(self, timeout=None):
+        """
+        :returns: [(mask, filename)] read within `timeout` seconds
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buf = os.read(self.fd, self.bufsize)
+        events, offset = [], 0
+        while offset < len(buf):
+            wd, mask, cookie, length = self.header.unpack_from(buf, offset)
+            offset += self.header.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileRootWatcher(object):
+    """
+    Turns changes to the file root into package events: archives
+    written or moved in become `PackageAdded`, archives deleted or
+    moved out become `PackageRemoved`, so only the affected leaves are
+    rebuilt.
+
+    Events are gathered for `settle` seconds before being applied, so
+    an upload's own `PackageAdded` gets there first. Archives already
+    in the project map that were written again are compared with the
+    root data by digest and, if replaced, repaired by a `Reconciler`.
+    """
+    settle = 1.0
+    timeout = 5.0
+
+    def __init__(self, registry, settle=None):
+        self.registry = registry
+        if settle is not None:
+            self.settle = settle
+        self.stopped = threading.Event()
+
+    @property
+    def index(self):
+        return IndexManager.for_registry(self.registry)
+
+    def is_archive(self, filename):
+        # skip temp files and precompressed pages (index.html.gz)
+        return not filename.startswith(('.', 'index.')) \
+               and self.index.archive_tool.EXTS.match(filename) is not None
+
+    def changes(self, events):
+        """
+        :returns: filename -> True (present) or False (gone), from the
+        last event seen for each archive
+        """
+        latest = OrderedDict()
+        for mask, filename in events:
+            if mask & IN_ISDIR or not self.is_archive(filename):
+                continue
+            latest.pop(filename, None)
+            latest[filename] = bool(mask & ADDED)
+        return latest
+
+    def package_event(self, index, filename, present):
+        """
+        :returns: a package event, the path of a known archive written
+        again, or None
+        """
+        fpath = index.path / filename
+        pmap = index.project_map
+        project = pmap.project_of(filename)
+        if present:
+            if not fpath.exists():
+                return None
+            if project is not None:
+                return fpath
+            info = index.pkginfo_from_file(fpath, index.move_on_error)
+            if info is None:
+                return None
+            added = event.PackageAdded(index, path=fpath, name=info.name, version=info.version)
+            added.ingest.pkginfo = info
+            return added
+
+        if project is None or fpath.exists():
+            return None
+        return event.PackageRemoved(index, path=fpath, name=project)
+
+    def apply(self, changes):
+        """
+        Notify a package event for each change not already known to
+        the index, and rewrite the home page if the set of projects
+        changed.
+        """
+        index = self.index
+        notified, rewritten = [], []
+        threadlocal.manager.push(dict(registry=self.registry, request=None))
+        try:
+            before = index.project_map.names()
+            for filename, present in changes.items():
+                try:
+                    pevent = self.package_event(index, filename, present)
+                    if isinstance(pevent, event.PackageEvent):
+                        self.registry.notify(pevent)
+                        notified.append(pevent)
+                    elif pevent is not None:
+                        rewritten.append(pevent)
+                except Exception:
+                    logger.exception("Handling change to %s failed", filename)
+
+            if rewritten:
+                self.repair(index, rewritten)
+
+            if notified and index.write_html is True \
+                   and index.project_map.names() != before:
+                index.write_index_home()
+        finally:
+            threadlocal.manager.pop()
+
+        if notified:
+            logger.info("File root changes: %s",
+                        ", ".join("%s %s" % (x.__class__.__name__, x.path.name) for x in notified))
+        return notified
+
+    def repair(self, index, rewritten):
+        """
+        Reindex known archives that were replaced in place
+        """
+        reconciler = Reconciler(index)
+        try:
+            return reconciler.reconcile(reconciler.diff_written(rewritten))
+        except Exception:
+            logger.exception("Reindexing %s failed", [str(x.name) for x in rewritten])
+
+    def resync(self):
+        """
+        Events were dropped; fall back to a full update
+        """
+        logger.warning("inotify queue overflowed, resyncing %s", self.index.path)
+        index = self.index
+        index.update_data()
+        return list(index.regenerate_all())
+
+    def run(self):
+        """
+        Watch the file root until `stop` is called
+        """
+        inotify = Inotify(self.index.path)
+        pending, deadline = [], None
+        try:
+            while not self.stopped.is_set():
+                timeout = deadline is None and self.timeout \
+                          or max(deadline - time.time(), 0)
+                events = inotify.read(timeout)
+                if events and deadline is None:
+                    deadline = time.time() + self.settle
+                pending.extend(events)
+
+                if deadline is None or time.time() < deadline:
+                    continue
+
+                try:
+                    if any(mask & IN_Q_OVERFLOW for mask, _ in pending):
+                        self.resync()
+                    else:
+                        self.apply(self.changes(pending))
+                except Exception:
+                    logger.exception("Who watches the watchman's exceptions?")
+                pending, deadline = [], None
+        finally:
+            inotify.close()
+
+    def stop(self):
+        self.stopped.set()
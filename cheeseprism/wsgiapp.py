@@ -1,11 +1,17 @@
+from .index import IndexManager
 from .jenv import EnvFactory
+from .jobs import JobQueue
+from .utils import DigestCache
+from .utils import path
 from cheeseprism.auth import BasicAuthenticationPolicy
 from cheeseprism.resources import App
 from pyramid.config import Configurator
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
 from pyramid.settings import asbool
+import atexit
 import futures
 import logging
+import os
 
 
 logger = logging.getLogger(__name__)
@@ -23,15 +29,26 @@ def main(global_config, **settings):
 
     setup_workers(config.registry)
 
+    digest_db = settings.get('cheeseprism.digest_cache', '')
+    if digest_db:
+        logger.info("Using digest cache: %s", digest_db)
+        path.digest_cache = DigestCache(digest_db)
+
     config.add_translation_dirs('locale/')
 
+    tempspec = settings.get('cheeseprism.index_templates', '')
+    config.registry['cp.index_templates'] = EnvFactory.from_str(tempspec)
+    config.registry['cp.index'] = IndexManager.from_registry(config.registry)
+
+    if asbool(settings.get('cheeseprism.async_upload', False)):
+        jobs = config.registry[JobQueue.registry_key] = \
+               JobQueue.from_settings(settings, registry=config.registry)
+        atexit.register(jobs.close)
+
     config.include('.request')
     config.include('.views')
     config.include('.index')
 
-    tempspec = settings.get('cheeseprism.index_templates', '')
-    config.registry['cp.index_templates'] = EnvFactory.from_str(tempspec)
-
     if asbool(settings.get('cheeseprism.pipcache_mirror', False)):
         config.include('.sync.pip')
 
@@ -54,20 +71,33 @@ def ping_proc(i):
 
 def setup_workers(registry):
     """
-    now thread only
+    Sets up `cp.executor` for cpu bound work (archive parsing) and
+    `cp.io_executor` for io bound work (hashing, copying).
+
+    With `cheeseprism.futures.type = process` archive parsing runs in
+    a process pool (one worker per core by default); otherwise both
+    are the same thread pool.
     """
     settings = registry.settings
 
-    registry['cp.executor_type'] = 'thread'
-
-    executor = futures.ThreadPoolExecutor
-
-    workers = int(settings.get('cheeseprism.futures.workers', 5))
-
-
-    logging.info("Starting thread executor w/ %s workers", workers)
-    executor = registry['cp.executor'] = executor(workers)
-
-    # -- This initializes our threads
+    etype = registry['cp.executor_type'] = settings.get('cheeseprism.futures.type', 'thread')
+    if etype not in ('thread', 'process'):
+        raise ValueError("Unknown executor type: %s" % etype)
+
+    default = etype == 'process' and (os.cpu_count() or 1) or 5
+    workers = int(settings.get('cheeseprism.futures.workers', default))
+    io_workers = int(settings.get('cheeseprism.futures.io_workers', 5))
+
+    if etype == 'process':
+        logger.info("Starting process executor w/ %s workers", workers)
+        executor = registry['cp.executor'] = futures.ProcessPoolExecutor(workers)
+        logger.info("Starting io thread executor w/ %s workers", io_workers)
+        registry['cp.io_executor'] = futures.ThreadPoolExecutor(io_workers)
+    else:
+        logger.info("Starting thread executor w/ %s workers", workers)
+        executor = registry['cp.executor'] = futures.ThreadPoolExecutor(workers)
+        registry['cp.io_executor'] = executor
+
+    # -- This initializes our workers
     workers = [str(pid) for pid in executor.map(ping_proc, list(range(workers)))]
     logger.info("workers: %s", " ".join(workers))
@@ -40,5 +40,7 @@ setup(name='CheesePrism',
       entry_points = """\
       [paste.app_factory]
       main = cheeseprism.wsgiapp:main
+      [console_scripts]
+      cheeseprism-catalog = cheeseprism.catalog:main
       """
       )
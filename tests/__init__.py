@@ -1 +1,42 @@
 #
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import io
+import tarfile
+import threading
+
+
+def make_sdist(dirpath, name, version, metadata='', metadata_version='1.1'):
+    """
+    Write a minimal sdist holding only PKG-INFO to `dirpath`
+    """
+    base = '%s-%s' % (name, version)
+    pkginfo = ("Metadata-Version: %s\nName: %s\nVersion: %s\n%s"
+               % (metadata_version, name, version, metadata)).encode('utf-8')
+    target = dirpath / ('%s.tar.gz' % base)
+    with tarfile.open(target, 'w:gz') as tar:
+        info = tarfile.TarInfo('%s/PKG-INFO' % base)
+        info.size = len(pkginfo)
+        tar.addfile(info, io.BytesIO(pkginfo))
+    return target
+
+
+@contextmanager
+def serve_directory(dirpath):
+    """
+    Serve `dirpath` over http on localhost for the duration
+
+    :yields: the base url
+    """
+    handler = partial(SimpleHTTPRequestHandler, directory=str(dirpath))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,57 @@
+from cheeseprism.utils import path
+import json
+import tempfile
+import unittest
+
+
+class SQLiteCatalogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.dir.rmtree_p()
+
+    def make_one(self):
+        from cheeseprism.catalog import SQLiteCatalog
+        return SQLiteCatalog(self.dir / 'index.db')
+
+    def pkgdata(self, name, version, added=1.0):
+        return dict(name=name, version=version, added=added, size=10,
+                    filename='%s-%s.tar.gz' % (name, version))
+
+    def test_update_and_lookup(self):
+        cat = self.make_one()
+        cat.update(abc=self.pkgdata('Foo_Bar', '1.0'),
+                   xyz=self.pkgdata('foo-bar', '1.1', added=5.0),
+                   qrs=self.pkgdata('other', '0.1'))
+        assert 'abc' in cat
+        assert 'nope' not in cat
+        assert cat['abc']['version'] == '1.0'
+        assert len(cat) == 3
+        assert set(cat) == set(('abc', 'xyz', 'qrs'))
+        assert set(x['version'] for x in cat.versions('foo.bar')) == set(('1.0', '1.1'))
+        assert cat.changed_since(2.0) == set(['foo-bar'])
+
+    def test_values_in_one_query(self):
+        cat = self.make_one()
+        cat.update(abc=self.pkgdata('foo', '1.0'), xyz=self.pkgdata('foo', '1.1'))
+        queries = []
+        query = cat.query
+        cat.query = lambda sql, *args: queries.append(sql) or query(sql, *args)
+        assert sorted(x['version'] for x in cat.values()) == ['1.0', '1.1']
+        assert len(queries) == 1
+
+    def test_remove(self):
+        cat = self.make_one()
+        cat.update(abc=self.pkgdata('foo', '1.0'))
+        cat.remove('abc')
+        assert 'abc' not in cat
+
+    def test_migrate(self):
+        datafile = self.dir / 'index.json'
+        datafile.write_text(json.dumps(dict(abc=self.pkgdata('foo', '1.0'))))
+        cat = self.make_one()
+        assert cat.migrate(datafile) == 1
+        assert cat['abc']['name'] == 'foo'
+        assert dict(cat.items()) == json.loads(datafile.text())
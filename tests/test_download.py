@@ -0,0 +1,61 @@
+from . import serve_directory
+from cheeseprism.download import Downloader
+from cheeseprism.utils import DigestMismatch
+from cheeseprism.utils import path
+import hashlib
+import pytest
+import requests
+import tempfile
+
+
+@pytest.fixture
+def dirs():
+    src, dest = path(tempfile.mkdtemp()), path(tempfile.mkdtemp())
+    (src / 'pkg-1.0.tar.gz').write_bytes(b'archive bytes' * 1000)
+    yield src, dest
+    src.rmtree()
+    dest.rmtree()
+
+
+def test_fetch(dirs):
+    src, dest = dirs
+    data = (src / 'pkg-1.0.tar.gz').bytes()
+    md5 = hashlib.md5(data).hexdigest()
+    with serve_directory(src) as url:
+        out = Downloader().fetch('%s/pkg-1.0.tar.gz#md5=%s' % (url, md5),
+                                 dest / 'pkg-1.0.tar.gz')
+    assert out.bytes() == data
+    assert out.__dict__['digests']['sha256'] == hashlib.sha256(data).hexdigest()
+    assert dest.files() == [out]
+
+
+def test_fetch_digest_mismatch(dirs):
+    src, dest = dirs
+    with serve_directory(src) as url:
+        with pytest.raises(DigestMismatch):
+            Downloader().fetch('%s/pkg-1.0.tar.gz' % url, dest / 'pkg-1.0.tar.gz',
+                               expected=dict(sha256='0' * 64))
+    assert dest.files() == []
+
+
+def test_fetch_missing(dirs):
+    src, dest = dirs
+    with serve_directory(src) as url:
+        with pytest.raises(requests.HTTPError):
+            Downloader().fetch('%s/nope-1.0.tar.gz' % url, dest / 'nope-1.0.tar.gz')
+    assert dest.files() == []
+
+
+def test_session_reused(dirs):
+    src, dest = dirs
+    dl = Downloader()
+    with serve_directory(src) as url:
+        for name in ('one.tar.gz', 'two.tar.gz'):
+            dl.fetch('%s/pkg-1.0.tar.gz' % url, dest / name)
+    assert len(dest.files()) == 2
+    assert dl.session.adapters['http://'].poolmanager.pools
+
+
+def test_hashes_from_url():
+    assert Downloader.hashes_from_url('http://x/a.tar.gz#md5=abc') == dict(md5='abc')
+    assert Downloader.hashes_from_url('http://x/a.tar.gz#egg=a') == {}
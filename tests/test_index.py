@@ -1,5 +1,7 @@
+from . import make_sdist
 from cheeseprism.utils import path
 from cheeseprism.utils import resource_spec
+from collections import Counter
 from itertools import count
 from mock import Mock
 from mock import patch
@@ -8,6 +10,7 @@ from stuf import stuf
 import futures
 import json
 import logging
+import os
 import subprocess
 import textwrap
 import unittest
@@ -93,6 +96,40 @@ class IndexTestCase(unittest.TestCase):
         assert data['hello'] == 'operator'
         assert self.im.data_from_path(self.im.datafile_path)['hello'] == 'operator'
 
+    def test_register_archive_journal(self):
+        """
+        journal datastore appends rather than rewriting index.json
+        """
+        from cheeseprism import index
+        self.im = self.make_one()
+        self.im = index.IndexManager(self.im.path, datastore='journal',
+                                     executor=self.im.executor)
+        pkgdata, md5 = self.im.register_archive(self.dummypath)
+        assert len(self.im.journal) == 1
+        assert self.im.data_from_path(self.im.datafile_path)[md5] == pkgdata
+
+        self.im.update_data()
+        assert len(self.im.journal) == 0
+        with open(self.im.datafile_path) as fd:
+            assert md5 in json.load(fd)
+
+    def test_register_archive_sqlite(self):
+        """
+        sqlite datastore migrates index.json and serves lookups
+        """
+        from cheeseprism import index
+        self.im = self.make_one()
+        self.im.write_datafile(seen={'name': 'seen', 'version': '1.0'})
+        self.im = index.IndexManager(self.im.path, datastore='sqlite',
+                                     executor=self.im.executor)
+        data = self.im.data_from_path(self.im.datafile_path)
+        assert 'seen' in data
+
+        pkgdata, md5 = self.im.register_archive(self.dummypath)
+        assert md5 in data
+        assert [x['filename'] for x in self.im.catalog.versions('dummypackage')] == \
+               [self.dummypath.name]
+
     def test_regenerate_index_write_html_false(self):
         im = self.make_one()
         im.write_html = False
@@ -134,6 +171,256 @@ class IndexTestCase(unittest.TestCase):
 
 
 
+    def test_projects_from_archives_uses_stored_data(self):
+        self.im = self.make_one()
+        self.im.register_archive(self.dummypath)
+        with patch('cheeseprism.index.pki_ff') as pkff:
+            items = self.im.projects_from_archives()
+        assert not pkff.called
+        assert [(name, [info.version for info, arch in versions]) for name, versions in items] \
+               == [('dummypackage', ['0.0dev'])]
+
+    def test_root_data_cached_until_datafile_changes(self):
+        self.im = self.make_one()
+        self.im.write_datafile(one={'name': 'one'})
+        data = self.im.root_data()
+        assert self.im.root_data() is data
+        self.im.write_datafile(two={'name': 'two'})
+        assert set(self.im.root_data()) == set(('one', 'two'))
+
+    def test_regenerate_all_skips_unchanged_leaves(self):
+        self.im = self.make_one()
+        home, leaves = self.im.regenerate_all()
+        leafhtml = self.im.path / 'dummypackage' / 'index.html'
+        mtime = leafhtml.mtime
+        assert self.im.leaf_stats['rebuilt'] == 1
+
+        home, leaves = self.im.regenerate_all()
+        assert self.im.leaf_stats['skipped'] == 1
+        assert leafhtml.mtime == mtime
+
+        home, leaves = self.im.regenerate_all(force=True)
+        assert self.im.leaf_stats['rebuilt'] == 2
+
+    def test_reconcile(self):
+        from cheeseprism.reconcile import Reconciler
+        self.im = self.make_one()
+        self.im.update_data()
+        home, leaves = self.im.regenerate_all()
+        assert Reconciler(self.im).reconcile() is None
+
+        other = make_sdist(self.im.path, 'other', '1.0')
+        self.im.update_data()
+        self.dum_whl.copy(self.im.path)
+        self.dummypath.remove()
+        make_sdist(self.im.path, 'other', '1.0', metadata='Summary: changed\n')
+
+        report = Reconciler(self.im).reconcile()
+        assert report['added'] == [self.dum_whl.name]
+        assert report['removed'] == [self.dummypath.name]
+        assert report['modified'] == [other.name]
+        assert report['leaves'] == ['dummypackage', 'other']
+        assert [name for name, secs in report['timings']] == \
+               ['diff', 'forget', 'register', 'leaves', 'home']
+
+        data = self.im.data_from_path(self.im.datafile_path)
+        assert sorted(x['filename'] for x in data.values()) == \
+               [self.dum_whl.name, other.name]
+        assert (self.im.path / other.name).md5hex in data
+        with open(self.im.path / 'dummypackage' / 'index.json') as fd:
+            assert [x['filename'] for x in json.load(fd)] == [self.dum_whl.name]
+        assert not Reconciler(self.im).diff()
+
+    def test_reconcile_replaced_in_place(self):
+        from cheeseprism.reconcile import Reconciler
+        self.im = self.make_one()
+        arch = make_sdist(self.im.path, 'other', '1.0')
+        self.im.update_data()
+        home, leaves = self.im.regenerate_all()
+        old = (self.im.path / arch.name).md5hex
+
+        make_sdist(self.im.path, 'other', '1.0', metadata='Summary: changed\n')
+        arch = self.im.path / arch.name
+        self.im.register_archive(arch)   # as an upload would
+
+        reconciler = Reconciler(self.im)
+        report = reconciler.reconcile(reconciler.diff_written([arch]))
+        assert report['modified'] == [arch.name]
+        data = self.im.data_from_path(self.im.datafile_path)
+        assert old not in data and arch.md5hex in data
+        assert self.im.project_map.archives('other') == [arch.name]
+        with open(self.im.path / 'other' / 'index.json') as fd:
+            assert [x['md5'] for x in json.load(fd)] == [arch.md5hex]
+
+    def test_parse_in_process_pool(self):
+        from cheeseprism import index
+        with futures.ProcessPoolExecutor(1) as executor:
+            self.im = index.IndexManager(self.new_path('procs'), executor=executor,
+                                         io_executor=futures.ThreadPoolExecutor(1))
+            self.dummy.copy(self.im.path)
+            # nothing stored yet, so every archive is parsed by the pool
+            items = self.im.projects_from_archives()
+            new = self.im.update_data()
+        assert [name for name, versions in items] == ['dummypackage']
+        assert [x['name'] for x in new] == ['dummypackage']
+
+    def test_update_data_quarantines(self):
+        from cheeseprism import index
+        from cheeseprism.sandbox import SandboxedArchiveUtil
+        at = SandboxedArchiveUtil(max_bytes=10)
+        self.im = index.IndexManager(self.new_path('quarantine'),
+                                     executor=futures.ThreadPoolExecutor(1),
+                                     archive_tool=at)
+        self.dummy.copy(self.im.path)
+        with self.assertLogs(self.im.log, 'WARNING') as logs:
+            assert self.im.update_data() == []
+        assert at.killed == 1
+        assert (self.im.error_folder / self.dummy.name).exists()
+        assert not (self.im.path / self.dummy.name).exists()
+        assert 'Quarantined 1 archives' in '\n'.join(logs.output)
+
+    def test_update_data_counts_killed_in_process_pool(self):
+        from cheeseprism import index
+        from cheeseprism.sandbox import SandboxedArchiveUtil
+        at = SandboxedArchiveUtil(max_bytes=10)
+        with futures.ProcessPoolExecutor(1) as executor:
+            self.im = index.IndexManager(self.new_path('killed'), executor=executor,
+                                         io_executor=futures.ThreadPoolExecutor(1),
+                                         archive_tool=at)
+            self.dummy.copy(self.im.path)
+            assert self.im.update_data() == []
+        assert at.killed == 1
+
+    def test_add_version_updates_fingerprint(self):
+        self.im = self.make_one()
+        self.im.regenerate_leaf('dummypackage')
+        fpfile = self.im.fingerprint_path(self.im.path / 'dummypackage')
+        before = fpfile.text()
+
+        distpath = here / path('dummypackage2/dist/dummypackage-0.1.tar.gz')
+        distpath.copy(self.im.path / distpath.name)
+        self.im.add_version_to_leaf(self.im.path / distpath.name, 'dummypackage')
+        assert fpfile.text() != before
+
+        self.im.regenerate_leaf('dummypackage')
+        assert self.im.leaf_stats['skipped'] == 1
+
+    def test_fingerprint_covers_output_settings(self):
+        self.im = self.make_one()
+        home, leaves = self.im.regenerate_all()
+        leafdir = self.im.path / 'dummypackage'
+        assert not leafdir.files('.*')
+        self.im.precompress = self.im.json_api = True
+        home, leaves = self.im.regenerate_all()
+        assert self.im.leaf_stats['rebuilt'] == 2
+        assert (leafdir / 'index.html.gz').exists()
+        assert (leafdir / self.im.simple_json_name).exists()
+
+    def test_regenerate_index_precompressed(self):
+        import gzip
+        self.im = self.make_one()
+        self.im.precompress = True
+        home, leaves = self.im.regenerate_all()
+        leafdir = self.im.path / 'dummypackage'
+        for target in (home, leafdir / 'index.html', leafdir / 'index.json'):
+            assert gzip.decompress((target + '.gz').bytes()) == target.bytes()
+
+    def test_core_metadata_sidecar_wheel(self):
+        """
+        PEP 658 metadata is written beside wheels and advertised
+        """
+        import hashlib
+        self.im = self.make_one(pkg='dum_whl')
+        self.im.regenerate_leaf('dummypackage')
+        sidecar = self.im.path / (self.dum_whl.name + '.metadata')
+        assert sidecar.exists()
+        assert b'Name: dummypackage' in sidecar.bytes()
+
+        digest = hashlib.sha256(sidecar.bytes()).hexdigest()
+        html = (self.im.path / 'dummypackage' / 'index.html').text()
+        assert 'data-core-metadata="sha256=%s"' % digest in html
+        assert 'data-dist-info-metadata="sha256=%s"' % digest in html
+
+    def test_core_metadata_sidecar_from_stored_data(self):
+        from cheeseprism.index import bulk_add_pkgs
+        self.im = self.make_one(pkg='dum_whl')
+        new_pkgs = self.im.update_data()
+        assert [x['metadata_static'] for x in new_pkgs] == [True]
+        bulk_add_pkgs(self.im, new_pkgs)
+        assert (self.im.path / (self.dum_whl.name + '.metadata')).exists()
+
+    def test_core_metadata_sidecar_skipped_for_old_sdist(self):
+        self.im = self.make_one()
+        self.im.regenerate_leaf('dummypackage')
+        assert not (self.im.path / (self.dummy.name + '.metadata')).exists()
+        assert 'data-core-metadata' not in (self.im.path / 'dummypackage' / 'index.html').text()
+
+    def test_core_metadata_sidecar_static_sdist(self):
+        self.im = self.make_one()
+        arch = make_sdist(self.im.path, 'static', '1.0')
+        info = self.im.pkginfo_from_file(arch)
+        info.metadata_version = '2.2'
+        assert self.im.write_core_metadata(arch, info)
+        assert (self.im.path / (arch.name + '.metadata')).exists()
+
+    def test_core_metadata_sidecar_follows_replaced_archive(self):
+        self.im = self.make_one()
+        arch = make_sdist(self.im.path, 'static', '1.0', metadata='Summary: old\n',
+                          metadata_version='2.2')
+        old = self.im.write_core_metadata(arch, self.im.pkginfo_from_file(arch))
+        assert self.im.write_core_metadata(arch, self.im.pkginfo_from_file(arch)) == old
+
+        arch = make_sdist(self.im.path, 'static', '1.0', metadata='Summary: new\n',
+                          metadata_version='2.2')
+        os.utime(arch, ns=(0, 10 ** 9))
+        new = self.im.write_core_metadata(arch, self.im.pkginfo_from_file(arch))
+        assert new and new != old
+        assert b'Summary: new' in (self.im.path / (arch.name + '.metadata')).bytes()
+
+    def test_leaf_links_hash_and_requires_python(self):
+        self.im = self.make_one()
+        make_sdist(self.im.path, 'pyreq', '1.0', metadata='Requires-Python: >=3.6\n',
+                   metadata_version='1.2')
+        self.im.regenerate_leaf('pyreq')
+        arch = self.im.path / 'pyreq-1.0.tar.gz'
+        html = (self.im.path / 'pyreq' / 'index.html').text()
+        assert 'pyreq-1.0.tar.gz#sha256=%s"' % arch.sha256hex in html
+        assert 'data-requires-python="&gt;=3.6"' in html
+
+        with open(self.im.path / 'pyreq' / 'index.json') as fd:
+            assert json.load(fd)[0]['requires_python'] == '>=3.6'
+
+    def test_json_api(self):
+        self.im = self.make_one()
+        self.im.json_api = True
+        make_sdist(self.im.path, 'pyreq', '1.0', metadata='Requires-Python: >=3.6\n',
+                   metadata_version='1.2')
+        home, leaves = self.im.regenerate_all()
+        arch = self.im.path / 'pyreq-1.0.tar.gz'
+        with open(self.im.path / 'pyreq' / 'index.v1_json') as fd:
+            doc = json.load(fd)
+        assert doc['meta'] == {'api-version': '1.1'}
+        assert doc['name'] == 'pyreq'
+        assert doc['versions'] == ['1.0']
+        entry = doc['files'][0]
+        assert entry['filename'] == 'pyreq-1.0.tar.gz'
+        assert entry['url'].endswith('/pyreq-1.0.tar.gz')
+        assert entry['hashes']['sha256'] == arch.sha256hex
+        assert entry['requires-python'] == '>=3.6'
+        assert entry['size'] == arch.size
+        assert entry['upload-time'].endswith('Z')
+
+        with open(self.im.path / 'index.v1_json') as fd:
+            assert json.load(fd)['projects'] == [{'name': 'dummypackage'}, {'name': 'pyreq'}]
+
+    def test_json_api_off(self):
+        self.im = self.make_one()
+        make_sdist(self.im.path, 'pyreq', '1.0')
+        home, leaves = self.im.regenerate_all()
+        assert (self.im.path / 'pyreq' / 'index.html').exists()
+        assert not (self.im.path / 'index.v1_json').exists()
+        assert not (self.im.path / 'pyreq' / 'index.v1_json').exists()
+
     def test_leafdata(self):
         self.im = self.make_one()
         fpath = here / path('dummypackage2/dist/dummypackage-0.1.tar.gz')
@@ -142,6 +429,8 @@ class IndexTestCase(unittest.TestCase):
         data = self.im.leafdata(fpath, dist)
         assert distinfo == (data['name'], data['version'])
         assert data['md5'] == fpath.md5hex
+        assert data['sha256'] == fpath.sha256hex
+        assert data['requires_python'] is None
         assert data['size'] == fpath.size
         assert data['filename'] == fpath.name
         assert 'mtime' in data
@@ -160,7 +449,9 @@ class IndexTestCase(unittest.TestCase):
         with patch('cheeseprism.index.IndexManager.regenerate_leaf') as rl:
             out = rebuild_leaf(event)
         assert out is not None
-        assert rl.call_args == (('dummypackage',), {})
+        assert rl.call_args == (('dummypackage',), {'refresh': False,
+                                                    'ingested': [event.ingest]})
+        assert event.ingest.pkgdata['name'] == 'dummypackage'
 
     def test_rebuild_leaf_subscriber_existing_leaf(self):
         from cheeseprism.event import PackageAdded
@@ -175,6 +466,90 @@ class IndexTestCase(unittest.TestCase):
 
         assert len(out) == 2
 
+    def test_rebuild_leaf_parses_once(self):
+        """
+        The pkginfo parsed for the event is reused for the root data
+        and the leaf
+        """
+        from cheeseprism.event import PackageAdded
+        from cheeseprism.index import rebuild_leaf
+        self.im = self.make_one()
+        self.im.regenerate_leaf('dummypackage')
+
+        distpath = here / path('dummypackage2/dist/dummypackage-0.1.tar.gz')
+        parse = self.im.at.pkginfo_from_file
+        with patch.object(self.im.at, 'pkginfo_from_file', side_effect=parse) as reparse:
+            with patch('cheeseprism.index.IndexManager.pkginfo_from_file',
+                       side_effect=parse) as pkif:
+                event = PackageAdded(self.im, path=distpath)
+                out = rebuild_leaf(event)
+        assert pkif.call_count == 1
+        assert not reparse.called
+        assert len(out) == 2
+        assert self.im.root_data()[distpath.md5hex] == event.ingest.pkgdata
+
+    def test_forget_archive_subscriber(self):
+        from cheeseprism.event import PackageRemoved
+        from cheeseprism.index import forget_archive
+        self.im = self.make_one()
+        pkgdata, md5 = self.im.register_archive(self.dummypath)
+        self.im.regenerate_leaf('dummypackage')
+        self.dummypath.remove()
+
+        forget_archive(PackageRemoved(self.im, path=self.dummypath, name='dummypackage'))
+        assert md5 not in self.im.data_from_path(self.im.datafile_path)
+        assert self.im.project_map.archives('dummypackage') == []
+        with open(self.im.path / 'dummypackage' / 'index.json') as fd:
+            assert json.load(fd) == []
+
+    def test_rebuild_leaf_debounced(self):
+        """
+        Uploads to one leaf within the debounce window are written once
+        """
+        from cheeseprism.event import PackageAdded
+        from cheeseprism.index import rebuild_leaf
+        from cheeseprism.scheduler import LeafScheduler
+        self.im = self.make_one()
+        self.im.regenerate_leaf('dummypackage')
+        self.im.leaf_scheduler = LeafScheduler(self.im.flush_leaf, 60)
+
+        archs = [make_sdist(self.im.path, 'dummypackage', version) for version in ('0.2', '0.3')]
+        with patch.object(self.im, '_leaf_html', wraps=self.im._leaf_html) as render:
+            for arch in archs:
+                rebuild_leaf(PackageAdded(self.im, path=path(arch)))
+            assert not render.called
+            self.im.leaf_scheduler.flush_all()
+        assert render.call_count == 1
+        assert self.im.leaf_stats['coalesced'] == 1
+
+        with open(self.im.path / 'dummypackage' / 'index.json') as fd:
+            assert len(json.load(fd)) == 3
+
+    def test_add_version_inserts_in_order(self):
+        self.im = self.make_one()
+        leafdir = self.im.path / 'ordered'
+        leafdir.makedirs()
+        (leafdir / 'index.json').write_text('[]')
+        for version in ('1.0', '2.0.dev1', '0.5', '1.0.post1', '2.0'):
+            arch = path(make_sdist(self.im.path, 'ordered', version))
+            self.im.add_version_to_leaf(arch, 'ordered')
+
+        with open(leafdir / 'index.json') as fd:
+            leafdata = json.load(fd)
+        assert [x['version'] for x in leafdata] == ['0.5', '1.0', '1.0.post1', '2.0.dev1', '2.0']
+        assert all(x['sortkey'] for x in leafdata)
+
+    def test_regenerate_leaf_reuses_stored_keys(self):
+        self.im = self.make_one()
+        for version in ('1.0', '0.5'):
+            make_sdist(self.im.path, 'ordered', version)
+        self.im.update_data()
+        with patch('cheeseprism.index.version_key', side_effect=AssertionError):
+            items = dict(self.im.projects_from_archives())
+            leafjson = self.im.write_leaf(self.im.path / 'ordered', items['ordered'])
+        with open(leafjson) as fd:
+            assert [x['version'] for x in json.load(fd)] == ['0.5', '1.0']
+
     def test_html_free_remove_index(self):
         idx = self.make_one()
         home, leaves = idx.regenerate_all()
@@ -263,6 +638,19 @@ class IndexTestCase(unittest.TestCase):
         data = idx.add_version_to_leaf(distpath, name)
         assert len(data) == 2
 
+    def test_add_version_to_leaf_replaced_archive(self):
+        idx = self.make_one()
+        idx.regenerate_leaf('dummypackage')
+        arch = path(make_sdist(idx.path, 'dummypackage', '0.1'))
+        idx.add_version_to_leaf(arch, 'dummypackage')
+
+        arch = path(make_sdist(idx.path, 'dummypackage', '0.1', metadata='Summary: new\n'))
+        data = idx.add_version_to_leaf(arch, 'dummypackage')
+        entries = [x for x in data if x['filename'] == arch.name]
+        assert len(data) == 2
+        assert [x['md5'] for x in entries] == [arch.md5hex]
+        assert [x['sha256'] for x in entries] == [arch.sha256hex]
+
     def test_add_version_to_leaf_w_remove_file_cleans_up_leafdata(self):
         idx = self.make_one()
         idx.write_html = False
@@ -291,6 +679,26 @@ class IndexTestCase(unittest.TestCase):
         leafdata = idx.cleanup_leafdata(leafpath, leafpath / 'index.json')
         assert len(leafdata) == 2
 
+    def test_regenerate_leaf_exact_project(self):
+        """
+        archives of projects sharing a name prefix stay out of the leaf
+        """
+        self.im = self.make_one()
+        make_sdist(self.im.path, 'dummypackage-extras', '1.0')
+        self.im.regenerate_leaf('dummypackage')
+        with open(self.im.path / 'dummypackage' / 'index.json') as fd:
+            data = json.load(fd)
+        assert [x['filename'] for x in data] == [self.dummypath.name]
+        assert self.im.project_map.archives('dummypackage-extras') == \
+               ['dummypackage-extras-1.0.tar.gz']
+
+    def test_regenerate_leaf_uses_project_map(self):
+        self.im = self.make_one()
+        self.im.regenerate_leaf('dummypackage')
+        with patch('cheeseprism.index.path.files') as files:
+            self.im.regenerate_leaf('dummypackage', refresh=False)
+        assert not files.called
+
     def test_regenerate_leaf(self):
         self.im = self.make_one()
         [x for x in self.im.regenerate_all()]
@@ -339,8 +747,9 @@ class IndexTestCase(unittest.TestCase):
         pkg = stuf(name='dummypackage', version='0.1',
                    filename=self.dummy.name)
         pkgs = pkg,
-        index = Mock(name='index')
+        index = Mock(name='index', leaf_stats=Counter())
         index.path = self.im.path
+        index.root_data.return_value = {}
         leaves, archs = bulk_add_pkgs(index, pkgs)
 
         assert len(archs) == 1
@@ -349,6 +758,19 @@ class IndexTestCase(unittest.TestCase):
         assert archs[0].basename() == 'dummypackage-0.0dev.tar.gz'
         assert index.regenerate_leaf.called
 
+    @patch('pyramid.threadlocal.get_current_registry')
+    def test_bulk_add_pkg_from_stored_data(self, getreg):
+        from cheeseprism.index import bulk_add_pkgs
+        self.im = self.make_one()
+        for version in ('1.0', '0.5'):
+            make_sdist(self.im.path, 'stored', version)
+        new_pkgs = self.im.update_data()
+        with patch.object(self.im.at, 'pkginfo_from_file', side_effect=AssertionError):
+            leaves, archs = bulk_add_pkgs(self.im, new_pkgs)
+        assert 'stored' in leaves
+        with open(self.im.path / 'stored' / 'index.json') as fd:
+            assert [x['version'] for x in json.load(fd)] == ['0.5', '1.0']
+
     @patch('pyramid.threadlocal.get_current_registry')
     def test_bulk_add_pkg_regen_error(self, getreg):
         with patch('cheeseprism.index.IndexManager.regenerate_leaf') as rl:
@@ -386,6 +808,38 @@ class ClassOrStaticMethods(unittest.TestCase):
         assert path.rename.called
         assert path.rename.call_args[0][0] == 'errors/_path_'
 
+    def test_extract_metadata_matches_pkginfo(self):
+        import pkginfo
+        from cheeseprism.archiveutil import ArchiveUtil
+        at = ArchiveUtil()
+        dist = here / 'dummypackage' / 'dist'
+        for fp, slow in ((dist / 'dummypackage-0.0dev.tar.gz', pkginfo.sdist.SDist),
+                         (dist / 'dummypackage-0.0dev-py27-none-any.whl', pkginfo.wheel.Wheel)):
+            fast, slow = at.extract_metadata(fp), slow(fp)
+            assert fast is not None
+            assert (fast.name, fast.version) == (slow.name, slow.version)
+            assert fast.read() == slow.read()
+
+    def test_extract_metadata_unsure(self):
+        """
+        A tarball without a top level PKG-INFO is left to pkginfo
+        """
+        import io
+        import tarfile
+        import tempfile
+        from cheeseprism.archiveutil import ArchiveUtil
+        fp = path(tempfile.mkdtemp()) / 'deep-1.0.tar.gz'
+        data = b"Metadata-Version: 1.1\nName: deep\nVersion: 1.0\n"
+        try:
+            with tarfile.open(fp, 'w:gz') as tar:
+                info = tarfile.TarInfo('deep-1.0/deep.egg-info/PKG-INFO')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            assert ArchiveUtil().extract_metadata(fp) is None
+            assert ArchiveUtil().pkginfo_from_file(fp).name == 'deep'
+        finally:
+            fp.parent.rmtree()
+
     def test_pkginfo_from_file_whl(self):
         """
         .pkginfo_from_file: wheel
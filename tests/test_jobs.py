@@ -0,0 +1,49 @@
+from cheeseprism.jobs import Job
+from cheeseprism.jobs import JobQueue
+import pytest
+
+
+def test_job_runs_and_records_stages():
+    jobs = JobQueue(workers=1)
+    seen = []
+
+    def work(job, value):
+        with job.stage('first'):
+            seen.append(value)
+
+    job = jobs.submit(Job('pkg-1.0.tar.gz'), work, 'x')
+    jobs.close()
+    assert seen == ['x']
+    assert jobs.get(job.id) is job
+    out = job.as_dict()
+    assert out['state'] == 'done'
+    assert [name for name, secs in out['stages']] == ['first']
+
+
+def test_job_failure():
+    jobs = JobQueue(workers=1)
+
+    def work(job):
+        raise ValueError('Kaboom')
+
+    job = jobs.submit(Job('pkg-1.0.tar.gz'), work)
+    jobs.close()
+    assert job.state == 'failed'
+    assert job.error == 'Kaboom'
+
+
+def test_queue_bounded():
+    jobs = JobQueue(maxsize=1, workers=0)
+    jobs.submit(Job('one'), lambda job: None)
+    with pytest.raises(JobQueue.Full):
+        jobs.submit(Job('two'), lambda job: None)
+    assert len(jobs.jobs) == 1
+
+
+def test_forget_finished():
+    jobs = JobQueue(workers=1, keep=1)
+    first = jobs.submit(Job('one'), lambda job: None)
+    second = jobs.submit(Job('two'), lambda job: None)
+    jobs.close()
+    assert jobs.get(first.id) is None
+    assert jobs.get(second.id) is second
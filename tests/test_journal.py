@@ -0,0 +1,74 @@
+from cheeseprism.utils import path
+from mock import patch
+import json
+import tempfile
+import unittest
+
+
+class DataJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = path(tempfile.mkdtemp())
+        self.snapshot = self.dir / 'index.json'
+        self.snapshot.write_text(json.dumps({'abc': {'name': 'one'}}))
+
+    def tearDown(self):
+        self.dir.rmtree_p()
+
+    def make_one(self, **kw):
+        from cheeseprism.journal import DataJournal
+        return DataJournal(self.snapshot, **kw)
+
+    def test_append_and_replay(self):
+        journal = self.make_one()
+        journal.append(xyz={'name': 'two'})
+        assert len(journal) == 1
+        assert json.loads(self.snapshot.text()) == {'abc': {'name': 'one'}}
+        assert set(journal.load()) == set(('abc', 'xyz'))
+
+    def test_replay_skips_partial_entry(self):
+        journal = self.make_one()
+        journal.append(xyz={'name': 'two'})
+        with open(journal.path, 'a') as stream:
+            stream.write('{"broken": ')
+        assert set(journal.load()) == set(('abc', 'xyz'))
+
+    def test_replay_removes(self):
+        journal = self.make_one()
+        journal.append(xyz={'name': 'two'})
+        journal.append(abc=None, xyz=None)
+        assert journal.load() == {}
+
+    def test_compact(self):
+        journal = self.make_one(compact_every=2)
+        journal.append(xyz={'name': 'two'})
+        assert not journal.needs_compaction
+        journal.append(xyz={'name': 'three'})
+        assert journal.needs_compaction
+        journal.compact()
+        assert len(journal) == 0
+        assert journal.path.text() == ''
+        assert json.loads(self.snapshot.text())['xyz'] == {'name': 'three'}
+
+    def test_entries_counted_on_open(self):
+        self.make_one().append(xyz={'name': 'two'})
+        assert len(self.make_one()) == 1
+
+    def test_read_during_compaction(self):
+        from cheeseprism.journal import DataJournal
+        journal = self.make_one()
+        journal.append(xyz={'name': 'two'})
+        compacted = journal.load()
+        replay = DataJournal.replay
+        calls = []
+
+        def compacting_replay(snapshot, data):
+            # compacted after the old snapshot was read
+            if not calls:
+                journal.compact(compacted)
+            calls.append(snapshot)
+            return replay(snapshot, data)
+
+        with patch.object(DataJournal, 'replay', side_effect=compacting_replay):
+            assert set(DataJournal.read(self.snapshot)) == set(('abc', 'xyz'))
+        assert len(calls) == 2
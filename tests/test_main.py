@@ -13,7 +13,48 @@ def test_main():
                             'cheeseprism.file_root': testdir,
                             'cheeseprism.data_json': 'data.json'})
     assert app
+    from cheeseprism.index import IndexManager
+    index = app.registry['cp.index']
+    assert IndexManager.for_registry(app.registry) is index
+    assert index.template_env is app.registry['cp.index_templates']
+
+
+def test_index_reload():
+    from cheeseprism.index import IndexManager
+    reg = DummyRegistry(**{'cheeseprism.file_root': testdir})
+    reg['cp.executor'] = None
+    reg['cp.index_templates'] = None
+    index = IndexManager.for_registry(reg)
+    assert IndexManager.for_registry(reg) is index
+    assert IndexManager.reload(reg) is not index
+    assert reg['cp.index'] is not index
 
 def teardown():
     if testdir.exists():
         testdir.rmtree()
+
+
+class DummyRegistry(dict):
+    def __init__(self, **settings):
+        self.settings = settings
+
+
+def test_setup_workers_thread():
+    from cheeseprism.wsgiapp import setup_workers
+    reg = DummyRegistry()
+    setup_workers(reg)
+    assert reg['cp.executor_type'] == 'thread'
+    assert reg['cp.io_executor'] is reg['cp.executor']
+    reg['cp.executor'].shutdown()
+
+
+def test_setup_workers_process():
+    import futures
+    from cheeseprism.wsgiapp import setup_workers
+    reg = DummyRegistry(**{'cheeseprism.futures.type': 'process',
+                           'cheeseprism.futures.workers': '2'})
+    setup_workers(reg)
+    assert isinstance(reg['cp.executor'], futures.ProcessPoolExecutor)
+    assert isinstance(reg['cp.io_executor'], futures.ThreadPoolExecutor)
+    reg['cp.executor'].shutdown()
+    reg['cp.io_executor'].shutdown()
@@ -1,3 +1,4 @@
+from . import serve_directory
 from cheeseprism.utils import path
 from cheeseprism.utils import resource_spec
 from cheeseprism.archiveutil import ArchiveUtil
@@ -12,6 +13,7 @@ from pprint import pformat as pp
 from urllib.error import HTTPError
 import logging
 import pkginfo
+import tempfile
 import unittest
 
 logger = logging.getLogger(__name__)
@@ -74,13 +76,14 @@ class TestReqDownloader(PipExtBase):
         self.download_dir = ''
         rd = self.makeone()
 
-    @patch('requests.get')
-    def test_download_url(self, mockget):
-        mockget.return_value = Mock()
-        mockget.return_value.content = self.dists['dp'].bytes()
+    def test_download_url(self):
+        dist = self.dists['dp']
         rd = self.makeone()
-        pinfo, outfile = rd.download_url(Link('http://fakeurl.com/dummypackage.tar.gz#egg=dummypackage'))
+        with serve_directory(dist.parent) as base:
+            link = Link('%s/%s#md5=%s' % (base, dist.name, dist.md5hex))
+            pinfo, outfile = rd.download_url(link)
         assert outfile.exists()
+        assert outfile.md5hex == dist.md5hex
         assert pinfo.name == 'dummypackage'
 
     def test_readzip(self):
@@ -92,11 +95,83 @@ class TestReqDownloader(PipExtBase):
         assert method == 'read'
         assert args == (name,)
 
-    @patch('zipfile.ZipFile')
-    def test_depinfo_for_zip(self, zfmock):
+    def test_depinfo_for_zip(self):
         from cheeseprism import pipext
-        zfmock.return_value = ZFMock()
-        assert pipext.RequirementDownloader.depinfo_for_file('fake.zip') == ([], [])
+        import zipfile
+        fp = path(tempfile.mkdtemp()) / 'zipped-1.0.zip'
+        try:
+            with zipfile.ZipFile(fp, 'w') as zf:
+                zf.writestr('zipped-1.0/zipped.egg-info/requires.txt',
+                            'dep>=1.0\n\n[extra]\n')
+                zf.writestr('zipped-1.0/zipped.egg-info/dependency_links.txt',
+                            'http://links\n')
+            depinfo = pipext.RequirementDownloader.depinfo_for_file(fp)
+            assert depinfo == (['http://links'], ['dep>=1.0'])
+        finally:
+            fp.parent.rmtree()
+
+    def test_depinfo_for_sdist(self):
+        deplinks, requires = self.at.depinfo_for_file(self.dists['dp2'])
+        assert requires == ['something_else']
+
+    def test_depinfo_stored_at_ingestion(self):
+        pkgdata = self.at.arch_to_add_map(self.dists['dp2'])
+        assert pkgdata['requires'] == ['something_else']
+        assert self.at.depinfo_from_pkgdata(pkgdata) == (pkgdata['dependency_links'],
+                                                         ['something_else'])
+
+    def test_depinfo_gathered_with_metadata(self):
+        # the sdist is read once: dependencies come from the same pass
+        with patch.object(self.at, 'depinfo_for_file', side_effect=AssertionError):
+            pkgdata = self.at.arch_to_add_map(self.dists['dp2'])
+        assert pkgdata['requires'] == ['something_else']
+
+    def test_depinfo_from_requires_dist(self):
+        """
+        An sdist without egg-info is read only up to its PKG-INFO
+        """
+        import io
+        import tarfile
+        fp = path(tempfile.mkdtemp()) / 'noegg-1.0.tar.gz'
+        data = (b"Metadata-Version: 2.1\nName: noegg\nVersion: 1.0\n"
+                b"Requires-Dist: dep (>=1.0)\nRequires-Dist: other; extra == 'test'\n")
+        try:
+            with tarfile.open(fp, 'w:gz') as tar:
+                info = tarfile.TarInfo('noegg-1.0/PKG-INFO')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                for i in range(2000):
+                    tar.addfile(tarfile.TarInfo('noegg-1.0/noegg/mod%s.py' % i), io.BytesIO())
+
+            members = []
+            next_member = tarfile.TarFile.next
+            with patch.object(tarfile.TarFile, 'next', autospec=True,
+                              side_effect=lambda tar: members.append(1) or next_member(tar)), \
+                 patch.object(self.at, 'depinfo_for_file', side_effect=AssertionError):
+                pkgdata = self.at.arch_to_add_map(fp)
+            assert len(members) <= 2
+            assert pkgdata['requires'] == ['dep>=1.0']
+        finally:
+            fp.parent.rmtree()
+
+    def test_requires_from_dist(self):
+        requires = self.at.requires_from_dist(["foo (>=1.0)",
+                                               "bar; python_version < '3'",
+                                               "baz; extra == 'test'",
+                                               "qux; python_version >= '3'"])
+        assert requires == ['foo>=1.0', 'qux']
+
+    def test_dependencies_cached(self):
+        rd = self.makeone()
+        rd.depcache['12345'] = dict(requires=['dep'], dependency_links=[])
+        with patch.object(self.at, 'depinfo_for_file', side_effect=AssertionError):
+            assert rd.dependencies('12345', self.dists['dp2']) == ([], ['dep'])
+
+    def test_dist_key(self):
+        from cheeseprism.pipext import RequirementDownloader
+        dk = RequirementDownloader.dist_key
+        assert dk('Some_Thing', 'Some_Thing-1.0.tar.gz') == ('some-thing', '1.0')
+        assert dk('some-thing', 'Some_Thing-1.0-py3-none-any.whl') == ('some-thing', '1.0')
 
     def test_package_finder_cm(self):
         from cheeseprism import pipext
@@ -106,11 +181,6 @@ class TestReqDownloader(PipExtBase):
         assert finder.index_urls == ['https://pypi.python.org/simple', 'an index_url']
 
 
-class ZFMock(Mock):
-    namelist = lambda self: []
-    read = lambda self, name : ""
-
-
 @patch('cheeseprism.pipext.RequirementDownloader.download_url')
 class TestReqDownloaderHandler(PipExtBase):
 
@@ -211,6 +281,33 @@ class TestReqDownloaderHandler(PipExtBase):
         assert path_to_sdist == self.dists['dp2']
         assert list(deps.requirements.keys()) == ['something-else'], list(deps.requirements.keys())
 
+    def test_skip_follows_cached_deps(self, download_url):
+        rd, req = self.basic_prep(download_url)
+        finder = self.mock_finder
+        rd.seen.add(self.link.hash)
+        rd.depcache[self.link.hash] = dict(requires=['something_else'], dependency_links=[])
+        pkginfo, outfile, deps = rd.handle_requirement(req, finder)
+        assert pkginfo is None
+        assert list(deps.requirements.keys()) == ['something-else']
+        assert not download_url.called
+
+    def test_cached_dependency_cycle_ends(self, download_url):
+        rd, req = self.basic_prep(download_url)
+        finder = self.mock_finder
+        rd.seen.add(self.link.hash)
+        # the archive requires itself (A -> A), as A -> B -> A would
+        rd.depcache[self.link.hash] = dict(requires=[req.name], dependency_links=[])
+        pkginfo, outfile, deps = rd.handle_requirement(req, finder)
+        cycled = list(deps.requirements.values()).pop()
+        assert rd.handle_requirement(cycled, finder) is None
+        assert not download_url.called
+
+    def test_claimed_once(self, download_url):
+        rd, req = self.basic_prep(download_url)
+        assert rd.handle_requirement(req, self.mock_finder) is not None
+        assert rd.handle_requirement(req, self.mock_finder) is None
+        assert download_url.call_count == 1
+
     def test_handle_requirement_w_whl(self, download_url):
         rd = self.makeone()
         req = list(rd.req_set.requirements.values()).pop()
@@ -256,5 +353,26 @@ class TestReqDownloaderAll(PipExtBase):
         handle.return_value = marker2, marker2, None,
         assert next(out_gen) == (marker2, marker2)
 
+    def test_download_breadth_first(self, handle):
+        deps = Mock(requirements=dict(a='a', b='b'))
+        results = dict(top=('top', 'top.tar.gz', deps),
+                       a=('a', 'a.tar.gz', None),
+                       b=None)
+        handle.side_effect = lambda req, finder=None: results[req]
+        rd = self.makeone()
+        rd.req_set = Mock(requirements=dict(top='top'))
+        output = list(rd.download_all(rd.req_set, finder=Mock()))
+        assert output[0] == ('top', 'top.tar.gz')
+        assert sorted(output[1:]) == [('a', 'a.tar.gz')]
+
+    def test_download_skipped_deps_followed(self, handle):
+        deps = Mock(requirements=dict(a='a'))
+        results = dict(top=(None, None, deps), a=('a', 'a.tar.gz', None))
+        handle.side_effect = lambda req, finder=None: results[req]
+        rd = self.makeone()
+        output = list(rd.download_all(Mock(requirements=dict(top='top')), finder=Mock()))
+        assert output == [('a', 'a.tar.gz')]
+
+
 class RSMock(Mock):
     requirements = dict(something_else="something_else_requirement")
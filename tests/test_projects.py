@@ -0,0 +1,39 @@
+from cheeseprism.utils import path
+
+
+def pkgdata(name, filename):
+    return dict(name=name, filename=filename, version='1.0')
+
+
+def test_build_only_present():
+    from cheeseprism.projects import ProjectMap
+    data = dict(a=pkgdata('foo', 'foo-1.0.tar.gz'),
+                b=pkgdata('foo', 'foo-1.1.tar.gz'),
+                c=pkgdata('foo-bar', 'foo-bar-1.0.tar.gz'))
+    pmap = ProjectMap().build(data, [path('foo-1.0.tar.gz'), path('foo-bar-1.0.tar.gz')])
+    assert pmap.built
+    assert pmap.archives('foo') == ['foo-1.0.tar.gz']
+    assert pmap.archives('foo-bar') == ['foo-bar-1.0.tar.gz']
+    assert pmap.names() == ['foo', 'foo-bar']
+
+
+def test_add_remove():
+    from cheeseprism.projects import ProjectMap
+    pmap = ProjectMap()
+    pmap.add('foo', 'foo-1.0.tar.gz')
+    pmap.add('foo', 'foo-1.1.tar.gz')
+    assert 'foo' in pmap
+    assert pmap.project_of('foo-1.1.tar.gz') == 'foo'
+    pmap.remove('foo', 'foo-1.0.tar.gz')
+    assert pmap.archives('foo') == ['foo-1.1.tar.gz']
+    pmap.remove(None, 'foo-1.1.tar.gz')
+    assert 'foo' not in pmap
+
+
+def test_unknown_prunes_missing():
+    from cheeseprism.projects import ProjectMap
+    pmap = ProjectMap()
+    pmap.add('foo', 'foo-1.0.tar.gz')
+    pmap.add('bar', 'bar-1.0.tar.gz')
+    assert pmap.unknown(['foo-1.0.tar.gz', 'baz-1.0.tar.gz']) == ['baz-1.0.tar.gz']
+    assert 'bar' not in pmap
@@ -0,0 +1,82 @@
+from cheeseprism.archiveutil import ArchiveLimitExceeded
+from cheeseprism.archiveutil import ArchiveUtil
+from cheeseprism.sandbox import SandboxedArchiveUtil
+from cheeseprism.utils import path
+from mock import Mock
+from mock import patch
+import pytest
+import time
+
+here = path(__file__).parent
+sdist = here / 'dummypackage' / 'dist' / 'dummypackage-0.0dev.tar.gz'
+
+
+def test_inspects_in_child():
+    info = SandboxedArchiveUtil().pkginfo_from_file(sdist)
+    assert (info.name, info.version) == ('dummypackage', '0.0dev')
+
+
+def sleepy(conn, *args):
+    time.sleep(10)
+
+
+def test_started_without_forking_the_app():
+    assert SandboxedArchiveUtil.context.get_start_method() in ('forkserver', 'spawn')
+
+
+def test_wall_clock_limit():
+    sat = SandboxedArchiveUtil(wall_seconds=0.5)
+    sat.inspect = sleepy
+    handle_error = Mock(return_value=None)
+    start = time.time()
+    assert sat.pkginfo_from_file(sdist, handle_error=handle_error) is None
+    assert time.time() - start < 5
+    assert sat.killed == 1
+    exc, arch = handle_error.call_args[0]
+    assert isinstance(exc, ArchiveLimitExceeded)
+    assert arch == sdist
+
+
+def test_expansion_limit():
+    sat = SandboxedArchiveUtil(max_bytes=10)
+    with pytest.raises(ArchiveLimitExceeded):
+        sat.pkginfo_from_file(sdist)
+    assert sat.killed == 1
+
+
+def test_other_errors_not_counted():
+    sat = SandboxedArchiveUtil()
+    with pytest.raises(RuntimeError):
+        sat.pkginfo_from_file(here / 'nope-1.0.tar.gz')
+    assert sat.killed == 0
+
+
+def test_from_settings():
+    assert SandboxedArchiveUtil.from_settings({}) is None
+    sat = SandboxedArchiveUtil.from_settings({'cheeseprism.sandbox': 'true',
+                                              'cheeseprism.sandbox.max_mb': '1'})
+    assert sat.max_bytes == 1024 ** 2
+
+
+def test_child_gathers_depinfo():
+    import multiprocessing
+    from cheeseprism.sandbox import inspect
+    dp2 = here / 'dummypackage2' / 'dist' / 'dummypackage-0.1.tar.gz'
+    parent, child = multiprocessing.Pipe(duplex=False)
+    # no rlimits: run in process, on the pkginfo fallback path
+    with patch.object(ArchiveUtil, 'extract_metadata', return_value=None):
+        inspect(child, str(dp2), 0, 0, None)
+    status, info = parent.recv()
+    assert status == 'ok'
+    assert info.depinfo == ([], ['something_else'])
+
+    with patch.object(ArchiveUtil, 'depinfo_for_file', side_effect=AssertionError):
+        pkgdata = SandboxedArchiveUtil().pkginfo_to_pkgdata(dp2, info)
+    assert pkgdata['requires'] == ['something_else']
+
+
+def test_depinfo_expansion_limit():
+    at = ArchiveUtil()
+    at.max_bytes = 10
+    with pytest.raises(ArchiveLimitExceeded):
+        at.depinfo_for_file(here / 'dummypackage2' / 'dist' / 'dummypackage-0.1.tar.gz')
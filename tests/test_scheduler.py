@@ -0,0 +1,68 @@
+from cheeseprism.scheduler import LeafScheduler
+from mock import patch
+import threading
+
+
+def test_burst_coalesced():
+    flushed = []
+    sched = LeafScheduler(lambda name, items: flushed.append((name, items)), 60)
+    assert sched.schedule('pkg', 1) is True
+    assert sched.schedule('pkg', 2) is False
+    assert sched.schedule('other', 3) is True
+    assert not flushed
+
+    sched.flush_all()
+    assert sorted(flushed) == [('other', [3]), ('pkg', [1, 2])]
+    assert sched.coalesced == 1
+    assert sched.flushes == 2
+    assert len(sched) == 0
+
+
+def test_flush_after_window():
+    done = threading.Event()
+    flushed = []
+
+    def flush(name, items):
+        flushed.append((name, items))
+        done.set()
+
+    sched = LeafScheduler(flush, 0.01)
+    sched.schedule('pkg', 1)
+    sched.schedule('pkg', 2)
+    assert done.wait(5)
+    assert flushed == [('pkg', [1, 2])]
+    assert sched.flush_all() == []
+
+
+def test_flush_error_logged():
+    def flush(name, items):
+        raise ValueError('Kaboom')
+
+    sched = LeafScheduler(flush, 60)
+    sched.schedule('pkg', 1)
+    assert sched.flush_all() == [None]
+
+
+def test_flush_all_waits_for_running_flush():
+    started, release = threading.Event(), threading.Event()
+    flushed = []
+
+    def flush(name, items):
+        started.set()
+        release.wait(5)
+        flushed.append((name, items))
+
+    sched = LeafScheduler(flush, 0.01)
+    sched.schedule('pkg', 1)
+    assert started.wait(5)
+    threading.Timer(0.05, release.set).start()
+    sched.flush_all()
+    assert flushed == [('pkg', [1])]
+
+
+def test_close_unregisters_exit_hook():
+    with patch('cheeseprism.scheduler.atexit') as atexit:
+        sched = LeafScheduler(lambda name, items: None, 60)
+        sched.close()
+    atexit.register.assert_called_once_with(sched.flush_all)
+    atexit.unregister.assert_called_once_with(sched.flush_all)
@@ -1,4 +1,147 @@
+from . import make_sdist
+from cheeseprism.archiveutil import ArchiveUtil
+from cheeseprism.utils import path
 from mock import Mock
+from mock import patch
+from mock import PropertyMock
+import futures
+import tempfile
+import unittest
 
 
+def test_changed():
+    from cheeseprism.reconcile import Reconciler
+    reconciler = Reconciler(Mock(name='index'))
+    fpath = Mock(size=10, mtime=100, md5hex='abc')
+    assert reconciler.changed(fpath, 'abc', dict(size=11, added=200))
+    assert not reconciler.changed(fpath, 'def', dict(size=10, added=200))
+    assert not reconciler.changed(fpath, 'def', dict(size=10))
+    assert not reconciler.changed(fpath, 'abc', dict(size=10, added=50))
+    assert reconciler.changed(fpath, 'def', dict(size=10, added=50))
 
+
+def test_touched_archive_hashed_once():
+    from cheeseprism.reconcile import Reconciler
+    fpath = Mock(size=10, mtime=100)
+    md5hex = PropertyMock(return_value='abc')
+    type(fpath).md5hex = md5hex
+    for i in range(3):
+        assert not Reconciler(Mock(name='index')).changed(fpath, 'abc', dict(size=10, added=50))
+    assert md5hex.call_count == 1
+
+    fpath.mtime = 150
+    assert not Reconciler(Mock(name='index')).changed(fpath, 'abc', dict(size=10, added=50))
+    assert md5hex.call_count == 2
+
+
+def test_index_watch_reconciles():
+    from cheeseprism import sync
+    from cheeseprism.reconcile import IndexDiff
+    diff = IndexDiff(added=[Mock()])
+    index = Mock(name='index')
+
+    def dowatch(index, reg, pdc):
+        raise sync.Inconsistent(diff)
+
+    with patch('cheeseprism.sync.time.sleep', side_effect=[None, KeyboardInterrupt]), \
+         patch('cheeseprism.sync.Reconciler') as reconciler:
+        try:
+            sync.index_watch(index, Mock(name='registry'), dowatch=dowatch)
+        except KeyboardInterrupt:
+            pass
+    reconciler.assert_called_once_with(index)
+    reconciler.return_value.reconcile.assert_called_once_with(diff)
+
+
+def test_dowatch_with_catalog():
+    from cheeseprism import sync
+    from cheeseprism.reconcile import IndexDiff
+    index = Mock(name='index')
+    index.datafile_path.exists.return_value = False
+    with patch('cheeseprism.sync.Reconciler') as reconciler:
+        reconciler.return_value.diff.return_value = IndexDiff()
+        sync.dowatch(index, Mock(name='registry'), None)
+    reconciler.assert_called_once_with(index)
+
+
+def test_target_name():
+    from cheeseprism.sync import SourceManifest
+    assert SourceManifest.target_name('/cache/http%3A%2F%2Fpypi%2Fpackages%2Fpkg-1.0%2Blocal.tar.gz') \
+           == 'pkg-1.0+local.tar.gz'
+    assert SourceManifest.target_name('/wheels/ab/cd/pkg-1.0-py3-none-any.whl') \
+           == 'pkg-1.0-py3-none-any.whl'
+
+
+class SyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = path(tempfile.mkdtemp())
+        self.legacy = self.dir / 'legacy'
+        self.wheels = self.dir / 'wheels'
+        (self.wheels / 'ab' / 'cd').makedirs()
+        self.legacy.mkdir()
+        make_sdist(self.legacy, 'one', '1.0').rename(self.legacy / 'http%3A%2F%2Fpypi%2Fone-1.0.tar.gz')
+        (self.legacy / 'http%3A%2F%2Fpypi%2Fone-1.0.tar.gz.content-type').write_text('x')
+        make_sdist(self.wheels / 'ab' / 'cd', 'two', '1.0')
+
+    def tearDown(self):
+        self.dir.rmtree_p()
+
+    def index(self):
+        index = Mock(name='index')
+        index.path = self.dir / 'index'
+        index.path.mkdir_p()
+        index.archive_tool = ArchiveUtil()
+        index.io_executor = futures.ThreadPoolExecutor(2)
+        index.root_data.return_value = {}
+        index.files = []
+        return index
+
+    def test_manifest_hashes_changes_only(self):
+        from cheeseprism.sync import SourceManifest
+        store = self.dir / 'manifest.json'
+        manifest = SourceManifest(self.legacy, store, ArchiveUtil.EXTS)
+        found = manifest.scan()
+        assert [x.name for x, md5 in found] == ['http%3A%2F%2Fpypi%2Fone-1.0.tar.gz']
+        assert manifest.hashed == 1
+
+        manifest = SourceManifest(self.legacy, store, ArchiveUtil.EXTS)
+        assert manifest.scan() == found
+        assert manifest.hashed == 0
+
+        make_sdist(self.legacy, 'three', '1.0')
+        manifest = SourceManifest(self.legacy, store, ArchiveUtil.EXTS)
+        assert len(manifest.scan()) == 2
+        assert manifest.hashed == 1
+
+    def test_sync_folder(self):
+        from cheeseprism.sync import sync_folder
+        index = self.index()
+        known = make_sdist(self.wheels, 'known', '1.0')
+        index.root_data.return_value = {known.md5hex: dict(filename=known.name)}
+
+        copied = sync_folder(index, [self.legacy, self.wheels])
+        assert sorted(x.name for x in copied) == ['one-1.0.tar.gz', 'two-1.0.tar.gz']
+        assert all(x.exists() and x.parent == index.path for x in copied)
+        assert len(index.path.glob('.sync-*.json')) == 2
+
+        index.files = copied
+        assert sync_folder(index, [self.legacy, self.wheels]) == []
+
+    @patch('cheeseprism.sync.update_index')
+    def test_sync_cache_feeds_copies_to_bulk_update(self, update_index):
+        from cheeseprism.sync import sync_cache
+        index = self.index()
+        registry = Mock(settings={'cheeseprism.pipcache_mirror.folders':
+                                  '%s\n%s' % (self.legacy, self.wheels)})
+        copied = sync_cache(index, registry)
+        update_index.assert_called_once_with(index, registry, copied)
+        assert len(copied) == 2
+
+
+def test_source_folders():
+    from cheeseprism.sync import source_folders
+    assert source_folders({}, {}) == []
+    assert source_folders({}, {'PIP_DOWNLOAD_CACHE': '/tmp/pdc'}) == ['/tmp/pdc']
+    assert source_folders({'cheeseprism.pipcache_mirror.folders': '/a\n/b'},
+                          {'PIP_DOWNLOAD_CACHE': '/tmp/pdc'}) == ['/a', '/b']
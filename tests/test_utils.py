@@ -1,4 +1,114 @@
+from mock import patch
+import hashlib
+import tempfile
+import unittest
+
+
 def test_strip_master():
     from cheeseprism.utils import strip_master
     assert strip_master('wat-10.1-master.tar.gz') == 'wat-10.1.tar.gz'
     assert strip_master('wat-10.1.tar.gz') == 'wat-10.1.tar.gz' 
+
+
+class DigestCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from cheeseprism.utils import DigestCache
+        from cheeseprism.utils import path
+        self.dir = path(tempfile.mkdtemp())
+        self.cache = DigestCache(self.dir / 'digests.db')
+        self.arch = self.dir / 'pkg-1.0.tar.gz'
+        self.arch.write_bytes(b'some bytes')
+
+    def tearDown(self):
+        from cheeseprism.utils import path
+        path.digest_cache = None
+        self.dir.rmtree_p()
+
+    def test_md5hex_uses_cache(self):
+        from cheeseprism.utils import path
+        path.digest_cache = self.cache
+        md5 = path(self.arch).md5hex
+        assert md5 == hashlib.md5(b'some bytes').hexdigest()
+        with patch.object(path, 'compute_digests') as cd:
+            assert path(self.arch).md5hex == md5
+            assert not cd.called
+
+    def test_cache_key_changes_with_file(self):
+        from cheeseprism.utils import path
+        path.digest_cache = self.cache
+        path(self.arch).md5hex
+        self.arch.write_bytes(b'other bytes and more')
+        assert path(self.arch).md5hex == hashlib.md5(b'other bytes and more').hexdigest()
+
+    def test_verify(self):
+        key = self.cache.key(self.arch)
+        self.cache.set(key, dict(md5='bogus', sha256='bogus'))
+        bad = self.cache.verify([self.arch], sample=1)
+        assert bad == [self.arch]
+        assert self.cache.get(key) is None
+
+
+def test_digests_single_pass():
+    from cheeseprism.utils import path
+    fp = path(tempfile.mkdtemp()) / 'pkg-1.0.tar.gz'
+    data = b'x' * 2500
+    fp.write_bytes(data)
+    try:
+        with patch.object(path, 'chunk_size', 1000):
+            digests = path(fp).digests
+        assert digests == dict(md5=hashlib.md5(data).hexdigest(),
+                               sha256=hashlib.sha256(data).hexdigest(),
+                               size=2500)
+        assert path(fp).md5hex == digests['md5']
+        assert path(fp).read_md5_fast() == hashlib.md5(data).digest()
+    finally:
+        fp.parent.rmtree()
+
+
+def test_write_stream():
+    import io
+    from cheeseprism.utils import write_stream
+    from cheeseprism.utils import path
+    data = b'y' * 2500
+    root = path(tempfile.mkdtemp())
+    try:
+        fp = write_stream(root / 'pkg-1.0.tar.gz', io.BytesIO(data), chunk_size=1000)
+        assert fp.bytes() == data
+        assert root.files() == [fp]
+        with patch.object(path, 'compute_digests') as cd:
+            assert fp.sha256hex == hashlib.sha256(data).hexdigest()
+            assert fp.md5hex == hashlib.md5(data).hexdigest()
+            assert not cd.called
+    finally:
+        root.rmtree()
+
+
+def test_version_key_matches_parse_version():
+    import json
+    import pkg_resources
+    from cheeseprism.utils import version_key
+    versions = ['1.0', '1.0.dev1', '1.0a1', '1.0a1.dev2', '1.0rc1', '1.0.post1',
+                '1.0.post1.dev3', '1.0+local.7', '1.0+local.abc', '1.0+5', '1!0.1',
+                '0.9', '1.1.dev0', '10.0']
+    by_key = sorted(versions, key=lambda v: json.loads(json.dumps(version_key(v))))
+    assert by_key == sorted(versions, key=pkg_resources.parse_version)
+
+
+def test_write_precompressed():
+    import gzip
+    from cheeseprism.utils import path
+    from cheeseprism.utils import write_precompressed
+    target = path(tempfile.mkdtemp()) / 'index.html'
+    try:
+        write_precompressed(target, u'<html></html>')
+        assert target.text() == '<html></html>'
+        assert gzip.decompress((target + '.gz').bytes()) == b'<html></html>'
+
+        write_precompressed(target, u'<html>new</html>', compress=False)
+        assert target.text() == '<html>new</html>'
+        assert not (target + '.gz').exists()
+        assert not (target + '.br').exists()
+        assert [x.name for x in target.parent.files()] == ['index.html']
+    finally:
+        target.parent.rmtree()
@@ -1,5 +1,6 @@
 from cheeseprism import index
 from cheeseprism import utils
+from cheeseprism import views
 from cheeseprism.resources import App
 from cheeseprism.utils import path
 from contextlib import contextmanager
@@ -10,9 +11,14 @@ from pyramid.decorator import reify
 from pyramid.events import subscriber
 from pyramid.httpexceptions import HTTPFound
 from stuf import stuf
+from . import serve_directory
 from .test_pipext import PipExtBase
 import futures
+import hashlib
+import io
 import itertools
+import json
+import requests
 import unittest
 
 here = path(__file__).parent
@@ -103,49 +109,63 @@ class ViewTests(unittest.TestCase):
         from_pypi: test catching httperror
         """
         request = self.package_request(pd)
-        with patch('requests.get') as get:
-            from cheeseprism import views; reload(views)
-            get.side_effect = views.HTTPError('http://boto', 500, 'KABOOM', dict(), None)
+        with patch('cheeseprism.views.fetch') as fetch:
+            fetch.side_effect = requests.HTTPError('500 Server Error: KABOOM')
             out = views.package(request)
         assert isinstance(out, HTTPFound)
+        assert out.location == '/find-packages'
 
     @patch('cheeseprism.rpc.PyPi.release_urls')
     def test_package_urlerror(self, pd):
         """
-        from_pypi: test catching urlerror
+        from_pypi: test catching connection errors
         """
         request = self.package_request(pd)
-        with patch('requests.get') as get:
-            from cheeseprism import views; reload(views)
-            get.side_effect = views.URLError('kaboom')
+        with patch('cheeseprism.views.fetch') as fetch:
+            fetch.side_effect = requests.ConnectionError('kaboom')
             out = views.package(request)
         assert isinstance(out, HTTPFound)
         assert out.location == '/find-packages'
 
+    def served_dist(self, pd, base, md5=None):
+        dist = PipExtBase.dists['dp']
+        td = dict(name='boto',
+                  version='1.2.3',
+                  md5_digest=md5 or dist.md5hex,
+                  url='%s/%s' % (base, dist.name),
+                  filename='boto-1.2.3.tar.gz')
+        return self.package_request(pd, td)
+
     @patch('cheeseprism.rpc.PyPi.release_urls')
     def test_package_good(self, pd):
         """
-        from_pypi: test catching urlerror
+        from_pypi: archive streamed from a (local) server
         """
-        request = self.package_request(pd)
-        with patch('requests.get') as get:
-            resp = get.return_value = Mock('response')
-            resp.content = PipExtBase.dists['dp'].bytes()
-            from cheeseprism import views; reload(views)
+        with serve_directory(PipExtBase.dists['dp'].parent) as base:
+            request = self.served_dist(pd, base)
             out = views.package(request)
         assert isinstance(out, HTTPFound)
         assert out.location == '/index/boto'
+        assert (request.file_root / 'boto-1.2.3.tar.gz').exists()
+
+    @patch('cheeseprism.rpc.PyPi.release_urls')
+    def test_package_digest_mismatch(self, pd):
+        """
+        from_pypi: a download not matching the upstream md5 is dropped
+        """
+        with serve_directory(PipExtBase.dists['dp'].parent) as base:
+            request = self.served_dist(pd, base, md5='0' * 32)
+            out = views.package(request)
+        assert out.location == '/find-packages'
+        assert not (request.file_root / 'boto-1.2.3.tar.gz').exists()
 
     @patch('cheeseprism.rpc.PyPi.release_urls')
     def test_package_downloads_ok_but_bad(self, pd):
         """
-        from_pypi: test catching urlerror
+        from_pypi: test catching errors adding the archive
         """
-        request = self.package_request(pd)
-        with patch('requests.get') as get:
-            resp = get.return_value = Mock('response')
-            resp.content = PipExtBase.dists['dp'].bytes()
-            from cheeseprism import views; reload(views)
+        with serve_directory(PipExtBase.dists['dp'].parent) as base:
+            request = self.served_dist(pd, base)
             with patch('cheeseprism.index.IndexManager.pkginfo_from_file') as pkff:
                 pkff.side_effect = ValueError("KABOOM")
                 out = views.package(request)
@@ -164,6 +184,16 @@ class ViewTests(unittest.TestCase):
         request.matchdict.update(td)
         return request
 
+    def test_index_view_from_project_map(self):
+        from cheeseprism.views import index_view
+        context, request = self.base_cr
+        idx = request.index
+        idx.project_map.add('dummypackage', 'dummypackage-0.0dev.tar.gz')
+        with patch('cheeseprism.index.IndexManager.projects_from_archives') as pfa:
+            out = index_view(context, request)
+        assert not pfa.called
+        assert [x['name'] for x in out['packages']] == ['dummypackage']
+
     def test_index_view(self):
         from cheeseprism.views import upload as index
         request = testing.DummyRequest()
@@ -212,12 +242,10 @@ class ViewTests(unittest.TestCase):
         request.POST['content'] = FakeFS(path('dummypackage2/dist/dummypackage-0.1.tar.gz'))
         with patch('cheeseprism.views.event.PackageAdded',
                    side_effect=RuntimeError('Kaboom')):
-            with patch('path.path.write_bytes'):
-                with self.assertRaises(RuntimeError):
-                    upload(context, request)
+            with self.assertRaises(RuntimeError):
+                upload(context, request)
 
-    @patch('path.path.write_bytes')
-    def test_upload(self, wb):
+    def test_upload(self):
         from cheeseprism.views import upload
         self.setup_event()
         context, request = self.base_cr
@@ -231,6 +259,67 @@ class ViewTests(unittest.TestCase):
             assert self.event_results['PackageAdded'][0].name == pkif.return_value.name
         assert res.headers == {'X-Swalow-Status': 'SUCCESS'}
 
+        dest = self.event_results['PackageAdded'][0].path
+        assert dest.bytes() == b"Some gzip binary"
+        # hashed while streamed to disk, not reread
+        assert dest.__dict__['digests'] == dict(md5=hashlib.md5(b"Some gzip binary").hexdigest(),
+                                                sha256=hashlib.sha256(b"Some gzip binary").hexdigest(),
+                                                size=16)
+
+    def test_upload_async(self):
+        from cheeseprism.jobs import JobQueue
+        from cheeseprism.views import job_status
+        from cheeseprism.views import upload
+        self.setup_event()
+        context, request = self.base_cr
+        jobs = request.registry[JobQueue.registry_key] = JobQueue(registry=request.registry)
+        request.method = 'POST'
+        request.POST['content'] = FakeFS(path('dummypackage/dist/dummypackage-0.0dev.tar.gz'))
+        ep = Mock(name='entry point')
+        try:
+            with patch('cheeseprism.index.IndexManager.pkginfo_from_file',
+                       return_value=stuf(name='dummycode', version='0.0dev')), \
+                 patch('pkg_resources.iter_entry_points', return_value=[ep]):
+                res = upload(context, request)
+                jobs.close()
+        finally:
+            del request.registry[JobQueue.registry_key]
+        # the request is done with by the time the job runs
+        dest = self.event_results['PackageAdded'][0].path
+        ep.load.return_value.assert_called_once_with(None, None, dest)
+        assert res.status_int == 202
+        assert res.headers['X-Swalow-Status'] == 'QUEUED'
+        job_id = json.loads(res.text)['id']
+        assert res.headers['Location'].endswith('/jobs/%s' % job_id)
+        assert 'PackageAdded' in self.event_results
+
+        request.subpath = (job_id,)
+        request.registry[JobQueue.registry_key] = jobs
+        try:
+            status = job_status(context, request)
+        finally:
+            del request.registry[JobQueue.registry_key]
+        assert status['state'] == 'done'
+        assert [name for name, secs in status['stages']] == ['store', 'parse', 'index', 'on_upload']
+
+    def test_upload_async_queue_full(self):
+        from cheeseprism.jobs import JobQueue
+        from cheeseprism.views import upload
+        context, request = self.base_cr
+        jobs = request.registry[JobQueue.registry_key] = JobQueue(maxsize=1, workers=0)
+        jobs.queue.put_nowait(None)
+        existing = path(request.file_root) / 'dummypackage-0.0dev.tar.gz'
+        existing.write_bytes(b"Indexed gzip binary")
+        request.method = 'POST'
+        request.POST['content'] = FakeFS(path('dummypackage/dist/dummypackage-0.0dev.tar.gz'))
+        try:
+            res = upload(context, request)
+        finally:
+            del request.registry[JobQueue.registry_key]
+        assert res.status_int == 503
+        assert existing.bytes() == b"Indexed gzip binary"
+        assert not path(request.file_root).files('.dummypackage*')
+
     def test_upload_w_rename(self):
         from cheeseprism.views import upload
         self.setup_event()
@@ -280,6 +369,7 @@ def mock_downloader():
         outf.filename = 'outfile'
         pkgi.name = "dummyfile"
         dler.download_all.return_value = (pkgi, outf),
+        dler.dependencies.return_value = ([], ['somedep'])
         dler.skip = (outf,)
         dler.errors = ('error',)
         dl.req_set_from_file.return_value = (dl, Mock(name='finder'))
@@ -292,10 +382,9 @@ class DummyResponse(object):
 
 
 class FakeFS(object):
-    def __init__(self, path, body="Some gzip binary"):
+    def __init__(self, path, body=b"Some gzip binary"):
         self.filename = path.name
-        self.file = Mock()
-        self.file.read.return_value = body
+        self.file = isinstance(body, bytes) and io.BytesIO(body) or io.StringIO(body)
 
 
 class CPDummyRequest(testing.DummyRequest):
@@ -0,0 +1,102 @@
+from cheeseprism import event
+from cheeseprism.archiveutil import ArchiveUtil
+from cheeseprism.projects import ProjectMap
+from cheeseprism.utils import path
+from cheeseprism.watch import FileRootWatcher
+from cheeseprism.watch import IN_CLOSE_WRITE
+from cheeseprism.watch import IN_DELETE
+from cheeseprism.watch import IN_ISDIR
+from cheeseprism.watch import IN_MOVED_FROM
+from cheeseprism.watch import IN_MOVED_TO
+from cheeseprism.watch import Inotify
+from mock import Mock
+from mock import patch
+import pytest
+import tempfile
+
+
+@pytest.fixture
+def index():
+    index = Mock(name='index')
+    index.path = path(tempfile.mkdtemp())
+    index.archive_tool = ArchiveUtil()
+    index.project_map = ProjectMap()
+    index.write_html = True
+    with patch('cheeseprism.watch.IndexManager.for_registry', return_value=index):
+        yield index
+    index.path.rmtree()
+
+
+@pytest.mark.skipif(not Inotify.available(), reason="needs inotify")
+def test_inotify_events():
+    root = path(tempfile.mkdtemp())
+    inotify = Inotify(root)
+    try:
+        (root / 'dummy-1.0.tar.gz').write_bytes(b'x')
+        (root / 'dummy-1.0.tar.gz').rename(root / 'dummy-1.1.tar.gz')
+        (root / 'dummy-1.1.tar.gz').remove()
+        events = inotify.read(1)
+    finally:
+        inotify.close()
+        root.rmtree()
+
+    assert [(mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE), name) \
+            for mask, name in events] == [(IN_CLOSE_WRITE, 'dummy-1.0.tar.gz'),
+                                          (IN_MOVED_FROM, 'dummy-1.0.tar.gz'),
+                                          (IN_MOVED_TO, 'dummy-1.1.tar.gz'),
+                                          (IN_DELETE, 'dummy-1.1.tar.gz')]
+
+
+def test_changes_collapsed(index):
+    watcher = FileRootWatcher(Mock(name='registry'))
+    changes = watcher.changes([(IN_CLOSE_WRITE, 'a-1.0.tar.gz'),
+                               (IN_MOVED_TO, 'b-1.0.zip'),
+                               (IN_DELETE, 'a-1.0.tar.gz'),
+                               (IN_CLOSE_WRITE, 'index.html.gz'),
+                               (IN_CLOSE_WRITE, '.b-1.0.zip.k2j3h'),
+                               (IN_MOVED_TO | IN_ISDIR, 'c-1.0.tar.gz'),
+                               (IN_CLOSE_WRITE, 'index.json')])
+    assert list(changes.items()) == [('b-1.0.zip', True), ('a-1.0.tar.gz', False)]
+
+
+def test_apply_targets_changed_archives(index):
+    for name in ('known-1.0.tar.gz', 'new-1.0.tar.gz'):
+        (index.path / name).write_bytes(b'x')
+    index.project_map.add('known', 'known-1.0.tar.gz')
+    index.project_map.add('gone', 'gone-1.0.tar.gz')
+    info = Mock(version='1.0')
+    info.name = 'new'
+    index.pkginfo_from_file.return_value = info
+
+    registry = Mock(name='registry')
+    registry.notify.side_effect = lambda ev: isinstance(ev, event.PackageRemoved) \
+                                  and index.project_map.remove(ev.name, ev.path.name)
+    watcher = FileRootWatcher(registry)
+    with patch('cheeseprism.watch.Reconciler') as reconciler:
+        notified = watcher.apply({'known-1.0.tar.gz': True,
+                                  'new-1.0.tar.gz': True,
+                                  'gone-1.0.tar.gz': False,
+                                  'unknown-1.0.tar.gz': False})
+    reconciler.assert_called_once_with(index)
+    reconciler.return_value.diff_written.assert_called_once_with([index.path / 'known-1.0.tar.gz'])
+    reconciler.return_value.reconcile.assert_called_once_with(
+        reconciler.return_value.diff_written.return_value)
+
+    added, removed = notified
+    assert isinstance(added, event.PackageAdded)
+    assert (added.name, added.path.name) == ('new', 'new-1.0.tar.gz')
+    assert added.ingest.pkginfo is info
+    assert isinstance(removed, event.PackageRemoved)
+    assert (removed.name, removed.path.name) == ('gone', 'gone-1.0.tar.gz')
+    index.pkginfo_from_file.assert_called_once_with(index.path / 'new-1.0.tar.gz',
+                                                    index.move_on_error)
+    assert index.write_index_home.called
+
+
+def test_apply_skips_unreadable(index):
+    (index.path / 'bad-1.0.tar.gz').write_bytes(b'x')
+    index.pkginfo_from_file.return_value = None
+    registry = Mock(name='registry')
+    assert FileRootWatcher(registry).apply({'bad-1.0.tar.gz': True}) == []
+    assert not registry.notify.called
+    assert not index.write_index_home.called